@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Накладные расходы фреймворка на синтетических проектах: загрузка конфигов, поиск образцов, генерация команд, \
+    фиксация результатов, оценка времени и файл состояния, запись YAML-логов, вывод в консоль. Команды образцов - \
+    true/touch, поэтому почти всё измеренное время - время самого пайплайна.
+Время фаз - время по часам, в течение которого фаза выполнялась хотя бы в одном потоке; сумма по потокам \
+    (для фаз, выполняемых в потоках образцов) сохраняется в результатах как thread_timings.
+
+Каждый масштаб запускается в отдельном процессе (пиковая память не накапливается между запусками). \
+    Результаты сравниваются с сохранёнными базовыми значениями (benchmarks/baselines/pipeline.json): \
+    фазы, ставшие медленнее более чем на --tolerance, отмечаются как регрессии. Кроме того, время на образец \
+    на крупных масштабах сравнивается с масштабом SCALING_FROM: рост более чем в --max-growth раз означает, что \
+    затраты растут быстрее числа образцов.
+
+Масштаб 10000 - уменьшенная замена 50000 образцов (около 12 минут), который запускается явно (--scales 50000) \
+    и сравнивается с базой, только если она сохранена для него.
+
+Запуск: python benchmarks/bench_pipeline.py [--scales 10 1000 10000] [--save-baseline] [--check]
+"""
+import argparse
+import functools
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baselines', 'pipeline.json')
+# Фазы в порядке вывода; progress - оценка времени выполнения, вывод прогресса и файл состояния
+PHASES = ['config', 'discovery', 'generate', 'order', 'commands', 'commit', 'progress', 'yaml', 'export', 'print', 'total']
+# Масштаб, с которым сравнивается время на образец крупных масштабов: на меньших преобладают постоянные затраты
+SCALING_FROM = 1000
+
+
+def write_project(path:str, samples:int, parallel:int):
+    """
+    Создаёт синтетический проект: два модуля (prepare -> check), второй обрабатывает результаты первого.
+    """
+    config = os.path.join(path, 'config')
+    input_dir = os.path.join(path, 'in')
+    os.makedirs(config)
+    os.makedirs(input_dir)
+    machines = {'bench': {'binaries': {}, 'max_parallel_samples': parallel, 'cache': False, 'history_runs': 0}}
+    modules = {
+        'sequence': ['prepare', 'check'],
+        'prepare': {'folders': {'input_dir': {}, 'output_dir': {'prepared': 'prepared'}}, 'source_extensions': ['.fastq'],
+                    'subfolders': False, 'module_before': '', 'result_dir': 'prepared',
+                    'filenames': {'basename': "f'{os.path.basename(sample).split(\".\")[0]}'", 'src': "f'{sample}'",
+                                  'out': "f'{folders[\"prepared\"]}{filenames[\"basename\"]}.txt'"},
+                    'commands': {'before_batch': ['noop'], 'sample_level': ['noop', 'touch'], 'after_batch': ['noop']}},
+        'check': {'folders': {'input_dir': {}, 'output_dir': {'checked': 'checked'}}, 'source_extensions': ['.txt'],
+                  'module_before': 'prepare', 'result_dir': 'checked',
+                  'filenames': {'basename': "f'{os.path.basename(sample).split(\".\")[0]}'", 'src': "f'{sample}'"},
+                  'commands': {'before_batch': [], 'sample_level': ['noop'], 'after_batch': []}},
+    }
+    commands = {'noop': 'true', 'touch': "f'touch {filenames[\"out\"]}'"}
+    import yaml
+    for name, data in [('machines_template', machines), ('modules_template', modules), ('cmds_template', commands)]:
+        with open(os.path.join(config, f'{name}.yaml'), 'w') as file:
+            yaml.safe_dump(data, file, sort_keys=False)
+    for i in range(samples):
+        open(os.path.join(input_dir, f'sample_{i:06d}.fastq'), 'w').close()
+
+
+class PhaseTimer:
+    """
+    Время фаз: wall - время по часам, в течение которого фаза выполнялась хотя бы в одном потоке; threads - сумма \
+        по потокам. Вложенные вызовы функций одной фазы в одном потоке учитываются один раз.
+    """
+    def __init__(self):
+        self.wall = {phase: 0.0 for phase in PHASES}
+        self.threads = {phase: 0.0 for phase in PHASES}
+        # Количество потоков, выполняющих фазу, и время, с которого она выполняется хотя бы в одном потоке
+        self.active = {phase: 0 for phase in PHASES}
+        self.since = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def timed(self, phase:str, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            depth = self.local.__dict__.setdefault(phase, 0)
+            self.local.__dict__[phase] = depth + 1
+            start = time.perf_counter()
+            if not depth:
+                with self.lock:
+                    if not self.active[phase]:
+                        self.since[phase] = start
+                    self.active[phase] += 1
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.local.__dict__[phase] = depth
+                if not depth:
+                    end = time.perf_counter()
+                    with self.lock:
+                        self.threads[phase] += end - start
+                        self.active[phase] -= 1
+                        if not self.active[phase]:
+                            self.wall[phase] += end - self.since[phase]
+        return wrapper
+
+
+class TimedStdout:
+    """
+    Поток вывода, который отбрасывает текст и считает время, потраченное на вывод.
+    """
+    def __init__(self, timer:PhaseTimer):
+        self.sink = open(os.devnull, 'w')
+        self.write = timer.timed('print', self.sink.write)
+
+    def flush(self):
+        self.sink.flush()
+
+
+def instrument(timer:PhaseTimer):
+    """
+    Оборачивает функции пайплайна, время которых относится к фазам.
+    """
+    from src import pipeline_manager, module_runner, stream_runner, command_executor, eta
+    patches = [(module_runner, 'generate_sample_list', 'discovery'), (module_runner, 'generate_cmd_data', 'generate'),
+               (module_runner.ModuleRunner, 'order_batch', 'order'), (command_executor, 'run_cmds', 'commands'),
+               (command_executor.CommandExecutor, 'commit_sample', 'commit'), (pipeline_manager, 'export_yaml', 'export')]
+    patches += [(module, 'save_yaml', 'yaml') for module in [pipeline_manager, module_runner, stream_runner]]
+    patches += [(eta.EtaTracker, name, 'progress') for name in ['start_module', 'add_samples', 'sample_done',
+                                                                 'finish_module', 'format_progress', 'write_status']]
+    for owner, name, phase in patches:
+        setattr(owner, name, timer.timed(phase, getattr(owner, name)))
+    return pipeline_manager.PipelineManager
+
+
+def run_scale(samples:int, parallel:int, workdir:str, trace_memory:bool=False) -> dict:
+    """
+    Выполняет синтетический проект в текущем процессе и возвращает время фаз и пиковую память.
+
+    :param trace_memory: Измерять пик памяти объектов Python (tracemalloc; заметно замедляет все фазы).
+    """
+    project = os.path.join(workdir, 'project')
+    write_project(project, samples=samples, parallel=parallel)
+    timer = PhaseTimer()
+    PipelineManager = instrument(timer)
+    args = {'project_path': project, 'modules': ['prepare', 'check'], 'input_dir': os.path.join(project, 'in'),
+            'output_dir': os.path.join(project, 'out'), 'machine': 'bench', 'include_samples': [],
+            'exclude_samples': [], 'debug': [], 'subfolders': False, 'resume': '', 'worker': False, 'watch': False}
+    stdout = sys.stdout
+    sys.stdout = TimedStdout(timer)
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        pipeline = timer.timed('config', PipelineManager)(args)
+        pipeline.run_pipeline()
+    finally:
+        timer.wall['total'] = timer.threads['total'] = time.perf_counter() - start
+        sys.stdout = stdout
+    peak_traced = 0
+    if trace_memory:
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {'samples': samples, 'timings': {phase: round(value, 4) for phase, value in timer.wall.items()},
+            'thread_timings': {phase: round(value, 4) for phase, value in timer.threads.items()},
+            'peak_python_bytes': peak_traced, 'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def format_report(results:list, baseline:dict, tolerance:float) -> tuple:
+    """
+    Формирует таблицу результатов и список регрессий относительно базовых значений.
+    """
+    lines = [f'{"samples":>8} ' + ' '.join(f'{phase:>10}' for phase in PHASES) + f' {"peak py":>10} {"max rss":>10}']
+    regressions = []
+    for result in results:
+        base = baseline.get(str(result['samples']))
+        cells = []
+        for phase in PHASES:
+            value = result['timings'][phase]
+            mark = ''
+            # Отличия меньше 0.2 с не считаются регрессией: время коротких фаз определяется шумом
+            base_value = base['timings'].get(phase, 0) if base else 0
+            if base and value > base_value * (1 + tolerance) and value - base_value > 0.2:
+                mark = '!'
+                regressions.append(f'{result["samples"]} samples, {phase}: {value:.3f} s (baseline {base_value:.3f} s)')
+            cells.append(f'{value:>9.3f}{mark or " "}')
+        if base and result['max_rss_bytes'] > base['max_rss_bytes'] * (1 + tolerance):
+            regressions.append(f'{result["samples"]} samples, max rss: {result["max_rss_bytes"] // 2**20} MB '
+                               f'(baseline {base["max_rss_bytes"] // 2**20} MB)')
+        lines.append(f'{result["samples"]:>8} ' + ' '.join(cells) +
+                     f' {result["peak_python_bytes"] / 2**20:>8.1f}MB {result["max_rss_bytes"] / 2**20:>8.1f}MB')
+    return ('\n'.join(lines), regressions)
+
+
+def scaling_regressions(results:list, max_growth:float) -> list:
+    """
+    Фазы, время на образец которых на крупных масштабах выросло более чем в max_growth раз относительно \
+        наименьшего масштаба не меньше SCALING_FROM (затраты растут быстрее числа образцов).
+    """
+    scaled = sorted((result for result in results if result['samples'] >= SCALING_FROM), key=lambda result: result['samples'])
+    regressions = []
+    for result in scaled[1:]:
+        base = scaled[0]
+        factor = result['samples'] / base['samples']
+        for phase in PHASES:
+            value = result['timings'][phase]
+            expected = base['timings'][phase] * factor
+            # Отличия меньше секунды не считаются: время коротких фаз определяется шумом
+            if value > expected * max_growth and value - expected > 1:
+                regressions.append(f'{result["samples"]} samples, {phase}: {value:.3f} s, '
+                                   f'{value / expected:.1f}x of linear growth from {base["samples"]} samples')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк накладных расходов пайплайна")
+    parser.add_argument('--scales', type=int, nargs='+', default=[10, 1000, 10000], help="Количества образцов")
+    parser.add_argument('--parallel', type=int, default=8, help="max_parallel_samples синтетической машины")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Допустимое замедление относительно базовых значений")
+    parser.add_argument('--max-growth', type=float, default=3.0,
+                        help="Допустимый рост времени на образец относительно масштаба SCALING_FROM")
+    parser.add_argument('--save-baseline', action='store_true', help="Сохранить результаты как базовые значения")
+    parser.add_argument('--check', action='store_true', help="Завершиться с ошибкой при регрессии")
+    parser.add_argument('--trace-memory', action='store_true', help="Измерять пик памяти объектов Python (tracemalloc)")
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        # Дочерний процесс: один масштаб, результат - JSON в stdout
+        workdir = tempfile.mkdtemp(prefix='bench_pipeline_')
+        try:
+            result = run_scale(samples=args.run, parallel=args.parallel, workdir=workdir, trace_memory=args.trace_memory)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(json.dumps(result))
+        return
+
+    results = []
+    for samples in args.scales:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', str(samples),
+                                  '--parallel', str(args.parallel)] + (['--trace-memory'] if args.trace_memory else []),
+                                 capture_output=True, text=True)
+        if process.returncode != 0:
+            raise SystemExit(f'Запуск на {samples} образцах завершился с ошибкой:\n{process.stderr}')
+        results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+        print(f'{samples} samples: {results[-1]["timings"]["total"]:.2f} s', file=sys.stderr)
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE, 'r') as file:
+            baseline = json.load(file)
+    report, regressions = format_report(results, baseline=baseline, tolerance=args.tolerance)
+    regressions += scaling_regressions(results, max_growth=args.max_growth)
+    print(report)
+    missing = [str(result['samples']) for result in results if str(result['samples']) not in baseline]
+    if missing:
+        # Масштабы без базовых значений не проверяются на регрессии
+        print(f'\nНет базовых значений для масштабов: {", ".join(missing)} (сохраняются с --save-baseline)')
+    if regressions:
+        print('\nРегрессии относительно базовых значений:')
+        for regression in regressions:
+            print(f'  {regression}')
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(BASELINE), exist_ok=True)
+        baseline.update({str(result['samples']): result for result in results})
+        with open(BASELINE, 'w') as file:
+            json.dump(baseline, file, indent=2)
+        print(f'Базовые значения сохранены: {BASELINE}')
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
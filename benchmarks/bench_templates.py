@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Сравнение генерации команд: прежний путь (eval() исходной строки для каждого ключа и образца) \
+    и скомпилированные шаблоны (src.templates).
+
+Запуск: python benchmarks/bench_templates.py [--samples 10000] [--commands 20]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.utils import generate_cmd_data
+
+
+def legacy_generate(folders:dict, filenames:dict, commands:dict, cmd_list:list, samples:list) -> dict:
+    """
+    Генерация команд так, как это делалось до компиляции шаблонов.
+    """
+    context = {'programms': {}, 'folders': folders, 'args': {}, 'os': os}
+    batch = {}
+    for sample in samples:
+        generated_filenames = {}
+        fn_context = {'folders': folders, 'sample': sample, 'filenames': generated_filenames, 'os': os}
+        for key, instruction in filenames.items():
+            instruction = instruction.replace('{{', '{').replace('}}', '}')
+            fn_context['filenames'][key] = eval(instruction, fn_context)
+        context['filenames'] = generated_filenames
+        batch[generated_filenames['basename']] = {key: [eval(commands[key], context), 0] for key in cmd_list}
+    return batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк генерации команд")
+    parser.add_argument('--samples', type=int, default=10000)
+    parser.add_argument('--commands', type=int, default=20)
+    args = parser.parse_args()
+
+    folders = {'input_dir': '/data/in/', 'output_dir': '/data/out/', 'bam': '/data/out/bam/', 'vcf': '/data/out/vcf/'}
+    filenames = {
+        'basename': "f'{os.path.basename(sample).split(\".\")[0]}'",
+        'fastq': "f'{sample}'",
+        'bam': "f'{folders[\"bam\"]}{filenames[\"basename\"]}.bam'",
+        'vcf': "f'{folders[\"vcf\"]}{filenames[\"basename\"]}.vcf.gz'",
+        'stats': "f'{folders[\"bam\"]}{filenames[\"basename\"]}.stats.txt'",
+    }
+    commands = {f'cmd_{i}': f"f'tool_{i} --in {{filenames[\"bam\"]}} --ref {{folders[\"input_dir\"]}}ref.fa " \
+                            f"--out {{filenames[\"vcf\"]}}.{i} --stats {{filenames[\"stats\"]}}'"
+                for i in range(args.commands)}
+    cmd_list = list(commands)
+    samples = [f'/data/in/sample_{i}.fastq.gz' for i in range(args.samples)]
+
+    start = time.perf_counter()
+    legacy = legacy_generate(folders=folders, filenames=filenames, commands=commands, cmd_list=cmd_list, samples=samples)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compiled = generate_cmd_data(args={}, folders=folders, executables={}, filenames=filenames, commands=commands,
+                                 cmds_dict={'before_batch': [], 'sample_level': cmd_list, 'after_batch': []},
+                                 samples=samples)['batch']
+    compiled_time = time.perf_counter() - start
+
+    if compiled != legacy:
+        raise SystemExit('Результаты генерации не совпадают!')
+    print(f'{args.samples} samples x {args.commands} commands')
+    print(f'eval of source strings: {legacy_time:.2f} s')
+    print(f'compiled templates:     {compiled_time:.2f} s ({legacy_time / compiled_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
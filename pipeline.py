@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
-from src import pipeline_manager, main_parser
+from src import pipeline_manager, main_parser, work_queue
 
 def main():
     # Парсинг аргументов командной строки
     args = main_parser.parse_args()
+    # Рабочий процесс распределённого режима: выполняет задачи из очереди, пайплайн не запускает
+    if args.get('worker'):
+        work_queue.run_worker(args)
+        return
     # Инициализация пайплайна
     pipeline = pipeline_manager.PipelineManager(args)
     #Запуск пайплайна
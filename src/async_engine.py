@@ -0,0 +1,387 @@
+import asyncio
+import os
+import subprocess
+import time
+from datetime import datetime
+from src.utils import (get_cmd_dependencies, get_failed_dependencies, save_cmd_result, format_cmd_status,
+                       skipped_result, parse_size, prepare_cmd_output, make_cmd_result, start_command, kill_process,
+                       output_writer, failed_result, failed_unit, interrupt_running_commands, DiskSpaceError,
+                       INTERRUPT_EVENT, RUNNING_PROCESSES, RUNNING_PROCESSES_LOCK)
+from src.scheduler import ResourcePool, UNIT_DISK_RESERVATION
+from src.backends import BatchBackend
+
+
+class AsyncResourcePool:
+    """
+    Пул ресурсов машины для команд, выполняемых в цикле событий (аналог ResourcePool без блокировки потоков).
+    """
+    def __init__(self, resources:ResourcePool=None):
+        """
+        :param resources: Пул ресурсов машины, из которого берутся лимиты (None - без ограничения).
+        """
+        self.resources = resources or ResourcePool()
+        self.used_threads = 0
+        self.used_memory = 0
+        self.condition = asyncio.Condition()
+
+    def fits(self, threads:int, memory:int) -> bool:
+        return (not self.resources.threads or self.used_threads + threads <= self.resources.threads) and \
+               (not self.resources.memory or self.used_memory + memory <= self.resources.memory)
+
+    async def acquire(self, threads:int, memory:int) -> tuple:
+        """
+        Ожидает, пока объявленные командой ресурсы не освободятся, и занимает их.
+
+        :return: Занятые ресурсы (threads, memory) - запрос, ограниченный лимитами машины.
+        """
+        threads, memory = self.resources.clamp(threads, memory)
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.fits(threads, memory))
+            self.used_threads += threads
+            self.used_memory += memory
+        return (threads, memory)
+
+    async def release(self, threads:int, memory:int):
+        async with self.condition:
+            self.used_threads -= threads
+            self.used_memory -= memory
+            self.condition.notify_all()
+
+
+class AsyncEngine(BatchBackend):
+    """
+    Выполнение образцов стадии batch в одном цикле событий asyncio вместо пула потоков.
+    Каждая команда - сопрограмма: ожидание завершения процесса (pidfd), таймаут и чтение каналов вывода \
+        не занимают отдельных потоков, поэтому одновременно могут выполняться сотни коротких команд.
+    Код выхода, ресурсы (wait4), файлы вывода, кэш и контрольные точки - те же, что у run_command и run_cmd_node.
+    """
+    def __init__(self, max_commands:int=256):
+        """
+        :param max_commands: Максимальное количество одновременно выполняемых команд.
+        """
+        self.max_commands = max(1, int(max_commands))
+
+    def run_batch(self, executor, module_stage:str, module_result_dict:dict, timeout_behavior:str,
+                  max_parallel_samples:int=1, resources:ResourcePool=None) -> bool:
+        samples = list(executor.cmd_data[module_stage].keys())
+        print(f'\t\tSamples: {len(samples)}, parallel: {min(max(1, int(max_parallel_samples)), len(samples))}, '
+              f'commands in flight: {self.max_commands}')
+        interruption = asyncio.run(self.run_samples(executor=executor, module_stage=module_stage, samples=samples,
+                                                    module_result_dict=module_result_dict,
+                                                    timeout_behavior=timeout_behavior,
+                                                    max_parallel_samples=max_parallel_samples, resources=resources))
+        self.order_results(module_stage=module_stage, module_result_dict=module_result_dict, samples=samples)
+        return interruption
+
+    async def run_samples(self, executor, module_stage:str, samples:list, module_result_dict:dict,
+                          timeout_behavior:str, max_parallel_samples:int, resources:ResourcePool) -> bool:
+        """
+        Выполняет образцы и фиксирует их результаты по мере завершения.
+        Ctrl-C отменяет эту сопрограмму (asyncio.run): запущенные команды останавливаются и получают код INTERRUPTED, \
+            образцы, которые ещё не начали выполняться, не запускаются.
+
+        :return: Флаг прерывания.
+        """
+        self.command_slots = asyncio.Semaphore(self.max_commands)
+        self.resources = AsyncResourcePool(resources)
+        sample_slots = asyncio.Semaphore(max(1, int(max_parallel_samples)))
+        start_time = time.time()
+        progress = {'done': 0, 'interruption': False}
+
+        async def run_sample(sample:str):
+            async with sample_slots:
+                if INTERRUPT_EVENT.is_set():
+                    return
+                cmds = executor.cmd_data[module_stage][sample]
+                footprint = executor.sample_footprint(sample) if resources and resources.disk else 0
+                try:
+                    reservation = await self.reserve_disk(path=executor.disk_footprint['path'], size=footprint,
+                                                          label=sample) if footprint else None
+                except DiskSpaceError as e:
+                    reservation = None
+                    unit_result, exit_codes, _status, interruption = failed_unit(cmds=cmds, exit_code='NO_SPACE',
+                                                                                 message=str(e))
+                else:
+                    if footprint and not reservation:
+                        return
+                    checkpoint = executor.checkpoint.unit(executor.module, module_stage, sample) \
+                        if executor.checkpoint else None
+                    # Задачи команд, создаваемые в run_cmds, наследуют резерв образца (см. UNIT_DISK_RESERVATION)
+                    token = UNIT_DISK_RESERVATION.set(reservation)
+                    try:
+                        unit_result, exit_codes, _status, interruption = await self.run_cmds(
+                            cmds=cmds, debug=executor.debug, timeout_behavior=timeout_behavior, sample=sample,
+                            output_dir=executor.output_dir(module_stage, sample), capture=executor.capture,
+                            cache=executor.cache, checkpoint=checkpoint)
+                    finally:
+                        UNIT_DISK_RESERVATION.reset(token)
+                        if reservation:
+                            resources.disk.release(reservation)
+            executor.commit_sample(module_stage=module_stage, sample=sample, module_result_dict=module_result_dict,
+                                   unit_result=unit_result, exit_codes=exit_codes)
+            progress['done'] += 1
+            if interruption:
+                progress['interruption'] = True
+                INTERRUPT_EVENT.set()
+                interrupt_running_commands()
+                return
+            executor.report_progress(sample=sample, unit_result=unit_result, k=progress['done'], total=len(samples),
+                                     start_time=start_time)
+
+        tasks = [asyncio.create_task(run_sample(sample)) for sample in samples]
+        try:
+            await asyncio.wait(tasks)
+        except asyncio.CancelledError:
+            print('INTERRUPTED')
+            progress['interruption'] = True
+            interrupt_running_commands()
+            # Дожидаемся остановки запущенных команд и фиксируем всё, что успело выполниться
+            await asyncio.wait(tasks)
+        return progress['interruption']
+
+    async def run_cmds(self, cmds:dict, debug:str, timeout_behavior:str, sample:str, **node_kwargs) -> tuple:
+        """
+        Выполняет набор команд образца с той же семантикой, что run_cmds: последовательно, если ни для одной команды \
+            не указан depends_on, иначе - по графу зависимостей (см. run_cmd_graph).
+
+        :return: Кортеж (результаты, коды выхода, статус, флаг прерывания).
+        """
+        RED = "\033[31m"
+        YELLOW = "\033[33m"
+        WHITE ="\033[37m"
+
+        prefix = f'\t\t\t{YELLOW}{sample}{WHITE} | '
+        unit_result = {'log':{},
+                        'stdout':{},
+                        'stderr':{}}
+        exit_codes = {}
+        status = True
+
+        def save(title:str, run_result:dict, note:str='') -> bool:
+            nonlocal status
+            status = save_cmd_result(unit_result=unit_result, exit_codes=exit_codes, title=title,
+                                     run_result=run_result) and status
+            # Строка выводится одной записью, чтобы не перемешиваться с выводом других образцов
+            print(f'{prefix}{title}:{format_cmd_status(run_result, note)}\n', end='')
+            return exit_codes[title] == 'INTERRUPTED'
+
+        if not any('depends_on' in cmd_opts[2] for cmd_opts in cmds.values() if len(cmd_opts) > 2):
+            for title, cmd_opts in cmds.items():
+                run_result, note = await self.run_node(title=title, cmd_opts=cmd_opts, debug=debug, **node_kwargs)
+                if save(title, run_result, note):
+                    return (unit_result, exit_codes, status, True)
+                if exit_codes[title] == 'TIMEOUT' and timeout_behavior != 'next':
+                    break
+            return (unit_result, exit_codes, status, False)
+
+        dependencies = get_cmd_dependencies(cmds)
+        nodes = {}
+
+        async def run_graph_node(title:str) -> bool:
+            # Команда ждёт завершения своих зависимостей; каждая зависимость выполняется одной задачей
+            await asyncio.gather(*(nodes[dep] for dep in dependencies[title]))
+            # Ошибки зависимостей обрабатываются так же, как в run_cmd_graph
+            failed = get_failed_dependencies(cmds=cmds, title=title, dependencies=dependencies, exit_codes=exit_codes,
+                                             timeout_behavior=timeout_behavior)
+            if failed:
+                save_cmd_result(unit_result=unit_result, exit_codes=exit_codes, title=title,
+                                run_result={'log': {'status': 'SKIPPED', 'exit_code': 'SKIPPED', 'skipped_by': failed},
+                                            'stdout': '', 'stderr': ''})
+                print(f'{prefix}{title}: {RED}SKIPPED{WHITE} ({", ".join(failed)} failed).\n', end='')
+                return False
+            run_result, note = await self.run_node(title=title, cmd_opts=cmds[title], debug=debug, **node_kwargs)
+            return save(title, run_result, note)
+
+        # Зависимости указаны только на команды, объявленные раньше (см. compile_module_templates)
+        for title in cmds:
+            nodes[title] = asyncio.ensure_future(run_graph_node(title))
+        interrupted = await asyncio.gather(*nodes.values())
+        return (unit_result, exit_codes, status, any(interrupted))
+
+    async def reserve_disk(self, path:str, size:int, io:bool=False, label:str='') -> tuple:
+        """
+        Резервирует место на диске (см. DiskAdmission) без блокировки цикла событий: ожидание - периодический опрос.
+
+        :return: Резерв либо None, если ожидание прервано остановкой пайплайна.
+        :raises DiskSpaceError: Место не может быть зарезервировано (см. DiskAdmission.check_unreserved).
+        """
+        disk = self.resources.resources.disk
+        reservation = disk.try_acquire(path, size=size, io=io)
+        waiting_since = time.time()
+        if not reservation:
+            disk.check_unreserved(path, size=size, label=label, waiting_since=waiting_since)
+            print(disk.waiting_message(path, size=size, io=io, label=label), end='')
+        while not reservation:
+            await asyncio.sleep(min(1, disk.poll))
+            if INTERRUPT_EVENT.is_set():
+                return None
+            reservation = disk.try_acquire(path, size=size, io=io)
+            if not reservation:
+                disk.check_unreserved(path, size=size, label=label, waiting_since=waiting_since)
+        return reservation
+
+    async def run_node(self, title:str, cmd_opts:list, debug:str, output_dir:str='', capture:dict=None,
+                       cache=None, checkpoint=None) -> tuple:
+        """
+        Выполняет одну команду с учётом журнала контрольных точек, кэша результатов и ресурсов машины (см. run_cmd_node).
+
+        :return: Кортеж (результат в формате run_command, отметка о пропуске выполнения для строки вывода).
+        """
+        GREEN = "\033[32m"
+        WHITE ="\033[37m"
+
+        cmd = cmd_opts[0]
+        timeout = cmd_opts[1]
+        options = cmd_opts[2] if len(cmd_opts) > 2 else {}
+
+        if checkpoint and checkpoint.is_completed(title=title, cmd=cmd):
+            return (skipped_result(resumed=True), f' {GREEN}DONE{WHITE} (resumed).')
+        # Ключ кэша может требовать хэширования входных файлов, поэтому вычисляется вне цикла событий
+        cache_key = await asyncio.to_thread(cache.key, cmd=cmd, options=options) if cache else None
+        run_result = await asyncio.to_thread(cache.lookup, key=cache_key, options=options) if cache_key else None
+        if run_result:
+            if checkpoint:
+                checkpoint.record(title=title, cmd=cmd, run_result=run_result)
+            return (run_result, f' {GREEN}CACHED{WHITE}.')
+
+        # Место на диске резервируется до занятия потоков и памяти (см. run_cmd_node)
+        reservation = None
+        if self.resources.resources.disk and (options.get('disk') or options.get('io')):
+            try:
+                reservation = await self.reserve_disk(path=options['disk_path'], size=options['disk'],
+                                                      io=options.get('io', False), label=title)
+            except DiskSpaceError as e:
+                return (failed_result(exit_code='NO_SPACE', message=str(e)), '')
+        # Команды без объявленных ресурсов занимают один поток
+        demand = await self.resources.acquire(threads=options.get('threads', 1), memory=options.get('memory', 0))
+        try:
+            async with self.command_slots:
+                run_result = await run_command_async(cmd=cmd, timeout=timeout, debug=debug, capture=capture,
+                                                     output_prefix=os.path.join(output_dir, title) if output_dir else '')
+        finally:
+            await self.resources.release(*demand)
+            if reservation:
+                self.resources.resources.disk.release(reservation)
+        if cache_key and run_result['log']['exit_code'] == 0:
+            await asyncio.to_thread(cache.store, key=cache_key, cmd=cmd, run_result=run_result)
+        if checkpoint:
+            checkpoint.record(title=title, cmd=cmd, run_result=run_result)
+        return (run_result, '')
+
+
+async def run_command_async(cmd:str, timeout:int, debug:str, output_prefix:str='', capture:dict=None) -> dict:
+    """
+    Выполняет команду в bash так же, как run_command, но ожидает её в цикле событий.
+    Прерывание пайплайна (INTERRUPT_EVENT, отмена сопрограммы) останавливает команду с кодом INTERRUPTED, \
+        истечение таймаута - с кодом TIMEOUT.
+    """
+    started = (time.time(), time.process_time(), datetime.now().strftime("%d.%m.%Y %H:%M:%S"))
+    capture = capture or {}
+    max_bytes = parse_size(capture.get('max_bytes', 0))
+    excerpt_bytes = parse_size(capture.get('excerpt_bytes', 4096))
+    echo = {'stdout': debug in ['info', 'all'], 'stderr': debug in ['errors', 'all']}
+    output_files, temporary = prepare_cmd_output(output_prefix)
+
+    def make_result(exit_code, rusage=None) -> dict:
+        return make_cmd_result(exit_code=exit_code, started=started, output_files=output_files,
+                               excerpt_bytes=excerpt_bytes, temporary=temporary, rusage=rusage)
+
+    if INTERRUPT_EVENT.is_set():
+        return make_result('INTERRUPTED')
+
+    piped = {stream: bool(max_bytes or echo[stream]) for stream in output_files}
+    process = start_command(cmd=cmd, output_files=output_files, piped=piped)
+    readers = [asyncio.ensure_future(pump_stream_async(stream=getattr(process, stream), file_path=output_files[stream],
+                                                       max_bytes=max_bytes,
+                                                       echo_label=stream.upper() if echo[stream] else ''))
+               for stream in ['stdout', 'stderr'] if piped[stream]]
+    try:
+        try:
+            rusage = await asyncio.wait_for(wait_process_async(process), timeout=timeout or None)
+            exit_code = process.returncode
+            # Команда, остановленная из-за прерывания пайплайна, помечается как прерванная
+            if exit_code != 0 and INTERRUPT_EVENT.is_set():
+                exit_code = 'INTERRUPTED'
+        except asyncio.TimeoutError:
+            kill_process(process)
+            rusage = await wait_process_async(process)
+            exit_code = 'TIMEOUT'
+        except asyncio.CancelledError:
+            INTERRUPT_EVENT.set()
+            kill_process(process)
+            rusage = await wait_process_async(process)
+            exit_code = 'INTERRUPTED'
+        await asyncio.gather(*readers)
+        return make_result(exit_code, rusage)
+    finally:
+        with RUNNING_PROCESSES_LOCK:
+            RUNNING_PROCESSES.discard(process)
+
+
+async def wait_process_async(process:subprocess.Popen):
+    """
+    Ожидает завершения процесса, не блокируя цикл событий, и забирает его через os.wait4 (см. wait_process).
+    Завершение отслеживается через pidfd (Linux 5.3+); без него процесс опрашивается с растущим интервалом.
+
+    :return: Данные resource.struct_rusage либо None, если процесс уже был завершён и учтён в другом месте.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    if pidfd is not None:
+        exited = loop.create_future()
+        loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+    delay = 0.005
+    while True:
+        try:
+            pid, wait_status, rusage = os.wait4(process.pid, os.WNOHANG)
+        except ChildProcessError:
+            process.wait()
+            return None
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(wait_status)
+            return rusage
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+async def pump_stream_async(stream, file_path:str, max_bytes:int=0, echo_label:str=''):
+    """
+    Читает канал вывода процесса в цикле событий и пишет его в файл (см. output_writer).
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=65536, loop=loop)
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader, loop=loop), stream)
+    writer = output_writer(file_path=file_path, max_bytes=max_bytes, echo_label=echo_label)
+    next(writer)
+    try:
+        while True:
+            try:
+                line = await reader.readuntil(b'\n')
+            except asyncio.IncompleteReadError as error:
+                # Конец вывода без перевода строки
+                line = error.partial
+            except asyncio.LimitOverrunError as error:
+                # Строка длиннее буфера (бинарный вывод): пишем накопленное как есть
+                line = await reader.read(max(error.consumed, 1))
+            if not line:
+                break
+            writer.send(line)
+    finally:
+        writer.close()
+        transport.close()
+
+
+def create_async_engine(machine_data:dict) -> AsyncEngine:
+    """
+    Создаёт исполнителя asyncio по настройкам машины (ключ async_engine: max_commands).
+    """
+    options = machine_data.get('async_engine') or {}
+    return AsyncEngine(max_commands=options.get('max_commands', 256))
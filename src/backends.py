@@ -0,0 +1,159 @@
+import json
+from src.utils import run_cmds, failed_unit, DiskSpaceError
+from src.scheduler import ResourcePool, UNIT_DISK_RESERVATION
+from src.result_cache import ResultCache
+
+
+class BatchBackend:
+    """
+    Исполнитель стадии batch, выполняющий образцы вне процесса пайплайна (рабочие процессы, планировщик задач кластера).
+    Выбирается ключом executor в machines_template; при executor: local образцы выполняет сам CommandExecutor.
+
+    Образец передаётся исполнителю задачей (см. make_task) - сгенерированными командами и настройками их выполнения; \
+        задача выполняется функцией run_task, результат которой фиксируется координатором (commit_result).
+    """
+    def open(self):
+        """
+        Подготовка исполнителя к запуску пайплайна.
+        """
+
+    def close(self):
+        """
+        Завершение работы исполнителя после запуска пайплайна.
+        """
+
+    def run_batch(self, executor, module_stage:str, module_result_dict:dict, timeout_behavior:str,
+                  max_parallel_samples:int=1, resources:ResourcePool=None) -> bool:
+        """
+        Выполняет образцы стадии batch и фиксирует их результаты.
+
+        :param executor: CommandExecutor модуля.
+        :param max_parallel_samples: Количество образцов, обрабатываемых одновременно на этой машине.
+        :param resources: Пул ресурсов этой машины.
+            Оба ограничения используются исполнителями, выполняющими образцы в процессе пайплайна; исполнители, \
+            передающие образцы на другие узлы, ограничивают их ресурсами этих узлов.
+        :return: Флаг прерывания.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def make_task(executor, module_stage:str, sample:str, timeout_behavior:str) -> dict:
+        """
+        Формирует задачу: команды образца и всё, что нужно для их выполнения с настройками модуля.
+        """
+        cmds = executor.cmd_data[module_stage][sample]
+        completed = {}
+        if executor.checkpoint:
+            unit = executor.checkpoint.unit(executor.module, module_stage, sample)
+            completed = {title: cmd_opts[0] for title, cmd_opts in cmds.items()
+                         if unit.is_completed(title=title, cmd=cmd_opts[0])}
+        cache = None
+        if executor.cache:
+            cache = {'cache_dir': executor.cache.cache_dir, 'hash_inputs': executor.cache.hash_inputs}
+        # Объём, записываемый образцом (disk_footprint модуля), резервируется исполнителем на своём узле
+        footprint = executor.sample_footprint(sample) if module_stage == 'batch' else 0
+        disk_footprint = {'path': executor.disk_footprint['path'], 'size': footprint} if footprint else None
+        return {'module': executor.module, 'stage': module_stage, 'sample': sample, 'cmds': cmds,
+                'timeout_behavior': timeout_behavior, 'debug': executor.debug, 'capture': executor.capture,
+                'output_dir': executor.output_dir(module_stage, sample), 'cache': cache, 'completed': completed,
+                'disk_footprint': disk_footprint}
+
+    @staticmethod
+    def commit_result(executor, module_stage:str, sample:str, module_result_dict:dict, result:dict) -> bool:
+        """
+        Фиксирует результат задачи в результатах модуля, логах и журнале контрольных точек.
+
+        :return: Флаг прерывания.
+        """
+        unit_result = result['unit_result']
+        executor.commit_sample(module_stage=module_stage, sample=sample, module_result_dict=module_result_dict,
+                               unit_result=unit_result, exit_codes=result['exit_codes'], job=result.get('job'))
+        if executor.checkpoint:
+            unit = executor.checkpoint.unit(executor.module, module_stage, sample)
+            cmds = executor.cmd_data[module_stage][sample]
+            for title, log in unit_result['log'].items():
+                if not log.get('resumed') and log.get('exit_code') != 'SKIPPED':
+                    unit.record(title=title, cmd=cmds[title][0], run_result={'log': log})
+        return result['interruption']
+
+    @staticmethod
+    def order_results(module_stage:str, module_result_dict:dict, samples:list):
+        """
+        Упорядочивает результаты образцов (зафиксированные в порядке поступления) как в cmd_data.
+        """
+        batch = module_result_dict[module_stage]
+        module_result_dict[module_stage] = {sample: batch[sample] for sample in samples if sample in batch}
+
+    @staticmethod
+    def read_json(path:str) -> dict:
+        try:
+            with open(path, 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+
+class TaskCheckpoint:
+    """
+    Журнал контрольных точек задачи на стороне исполнителя: команды, выполненные в возобновляемом запуске, \
+        передаются в задаче; записи о выполнении делает координатор.
+    """
+    def __init__(self, completed:dict):
+        self.completed = completed
+
+    def is_completed(self, title:str, cmd:str) -> bool:
+        return self.completed.get(title) == cmd
+
+    def record(self, title:str, cmd:str, run_result:dict):
+        pass
+
+
+def run_task(task:dict, resources:ResourcePool=None) -> dict:
+    """
+    Выполняет задачу (см. BatchBackend.make_task).
+
+    :param resources: Пул ресурсов узла, на котором выполняется задача. Объём образца (disk_footprint задачи) \
+        резервируется, если на узле включён контроль места на дисках.
+    :return: Результат задачи: результаты и коды выхода команд, статус, флаг прерывания.
+    """
+    cache = ResultCache(**task['cache']) if task['cache'] else None
+    footprint = task.get('disk_footprint')
+    disk = resources.disk if resources and footprint else None
+    try:
+        reservation = disk.acquire(path=footprint['path'], size=footprint['size'], label=task['sample']) if disk else None
+    except DiskSpaceError as e:
+        unit_result, exit_codes, status, interruption = failed_unit(cmds=task['cmds'], exit_code='NO_SPACE',
+                                                                    message=str(e))
+    else:
+        token = UNIT_DISK_RESERVATION.set(reservation)
+        try:
+            unit_result, exit_codes, status, interruption = run_cmds(
+                cmds=task['cmds'], debug=task['debug'], timeout_behavior=task['timeout_behavior'],
+                sample=task['sample'], resources=resources, output_dir=task['output_dir'], capture=task['capture'],
+                cache=cache, checkpoint=TaskCheckpoint(task['completed']))
+        finally:
+            UNIT_DISK_RESERVATION.reset(token)
+            if reservation:
+                disk.release(reservation)
+    return {'unit_result': unit_result, 'exit_codes': exit_codes, 'status': status, 'interruption': interruption}
+
+
+def create_batch_backend(machine_data:dict, output_dir:str, log_dir:str) -> BatchBackend:
+    """
+    Создаёт исполнителя стадии batch по ключу executor машины.
+
+    :return: Исполнитель либо None для локального выполнения (executor: local).
+    """
+    from src.work_queue import create_work_queue
+    from src.slurm import create_slurm_backend
+    from src.async_engine import create_async_engine
+    executor = machine_data.get('executor', 'local')
+    if executor == 'local':
+        return None
+    if executor == 'async':
+        return create_async_engine(machine_data=machine_data)
+    if executor == 'queue':
+        return create_work_queue(machine_data=machine_data, output_dir=output_dir)
+    if executor == 'slurm':
+        return create_slurm_backend(machine_data=machine_data, log_dir=log_dir)
+    raise ValueError(f"Неизвестный исполнитель: {executor}. Допустимые значения: local, async, queue, slurm")
@@ -0,0 +1,61 @@
+import os
+from src.log_sink import JsonlLogSink, read_records
+
+
+class Checkpoint:
+    """
+    Журнал контрольных точек: после завершения каждой команды в него дописывается запись о результате.
+    При возобновлении прерванного запуска журнал загружается, и успешно выполненные команды повторно не запускаются.
+    """
+    def __init__(self, file_path:str, resume:bool=False):
+        """
+        Инициализация журнала.
+
+        :param file_path: Путь к файлу журнала (JSON Lines).
+        :param resume: Загрузить записи предыдущего запуска для его возобновления.
+        """
+        self.file_path = file_path
+        # Успешно выполненные команды: {(модуль, стадия, образец, команда): строка команды}
+        self.completed = {}
+        if resume:
+            for record in read_records(file_path):
+                key = (record['module'], record['stage'], record['sample'], record['title'])
+                if record['exit_code'] == 0:
+                    self.completed[key] = record['cmd']
+                else:
+                    self.completed.pop(key, None)
+        self.sink = JsonlLogSink(file_path)
+
+    def unit(self, module:str, stage:str, sample:str='') -> 'UnitCheckpoint':
+        """
+        Возвращает журнал для команд одной стадии модуля (или одного образца в стадии batch).
+        """
+        return UnitCheckpoint(checkpoint=self, module=module, stage=stage, sample=sample)
+
+    def close(self):
+        self.sink.close()
+
+
+class UnitCheckpoint:
+    """
+    Часть журнала контрольных точек, относящаяся к стадии модуля либо образцу.
+    """
+    def __init__(self, checkpoint:Checkpoint, module:str, stage:str, sample:str):
+        self.checkpoint = checkpoint
+        self.module = module
+        self.stage = stage
+        self.sample = sample
+
+    def is_completed(self, title:str, cmd:str) -> bool:
+        """
+        Проверяет, была ли команда с той же строкой успешно выполнена в возобновляемом запуске.
+        """
+        return self.checkpoint.completed.get((self.module, self.stage, self.sample, title)) == cmd
+
+    def record(self, title:str, cmd:str, run_result:dict):
+        """
+        Записывает результат выполнения команды.
+        """
+        self.checkpoint.sink.write({'module':self.module, 'stage':self.stage, 'sample':self.sample, 'title':title,
+                                    'cmd':cmd, 'exit_code':run_result['log']['exit_code'],
+                                    'end_time':run_result['log']['end_time'], 'pid':os.getpid()})
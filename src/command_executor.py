@@ -1,40 +1,75 @@
 from datetime import datetime
+import os
 import time
-from src.utils import load_yaml, gather_logs, convert_secs_to_dhms, run_cmds
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from src.utils import (gather_logs, convert_secs_to_dhms, run_cmds, interrupt_running_commands, summarize_resources,
+                       format_size, parse_footprint, failed_unit, DiskSpaceError)
+from src.scheduler import ResourcePool, UNIT_DISK_RESERVATION
+from src.result_cache import ResultCache
+from src.checkpoint import Checkpoint
+from src.eta import EtaTracker
+from src.metrics import RunMetrics
 
 
 class CommandExecutor:
-    def __init__(self, cmd_data:dict, log_space:dict, module:str, debug:str):
+    def __init__(self, cmd_data:dict, log_space:dict, log_sink, module:str, debug:str, capture:dict=None,
+                 cache:ResultCache=None, checkpoint:Checkpoint=None, sample_sizes:dict=None, eta:EtaTracker=None,
+                 backend=None, metrics:RunMetrics=None, disk_footprint:dict=None, temp_files=None):
         """
         Инициализация CommandExecutor.
         
         :param cmd_data: Данные о командах.
         :param log_space: Лог-файлы для записи выполнения.
+        :param log_sink: Журнал, в который записываются результаты выполнения команд.
         :param module: Название модуля.
+        :param capture: Настройки сохранения stdout/stderr команд (см. run_command).
+        :param cache: Кэш результатов команд.
+        :param checkpoint: Журнал контрольных точек для возобновления прерванного запуска.
+        :param sample_sizes: Размеры входных данных образцов {образец: байты}, записываемые в логи.
+        :param eta: Оценка времени выполнения пайплайна, обновляемая по мере обработки образцов.
+        :param backend: Исполнитель стадии batch (src.backends.BatchBackend); если указан, образцы стадии batch \
+                        выполняются вне процесса пайплайна (рабочими процессами, заданиями планировщика кластера).
+        :param metrics: Метрики выполнения команд (status.json, файл метрик Prometheus).
+        :param disk_footprint: Объём данных, записываемых образцом стадии batch: size - объём либо кратность размера \
+                               входных данных ('3x'), path - папка, на файловую систему которой они записываются; \
+                               образец запускается, когда на ней достаточно места (см. DiskAdmission).
+        :param temp_files: Временные файлы образцов (src.temp_files.TempFiles), удаляемые после успешной обработки.
         """
-        self.logs:dict
         self.debug:str
 
         self.debug = debug
-        self.logs = {'log':load_yaml(file_path=log_space['log_data']),
-                     'stdout':load_yaml(file_path=log_space['stdout_log']),
-                     'stderr':load_yaml(file_path=log_space['stderr_log'])}
         self.cmd_data = cmd_data
         self.log_space = log_space
+        self.log_sink = log_sink
         self.module = module
         self.module_start_time = datetime.now().strftime("%d.%m.%Y_%H:%M:%S")
+        self.log_section = f'{self.module}_{self.module_start_time}'
+        self.capture = capture or {}
+        self.cache = cache
+        self.checkpoint = checkpoint
+        self.sample_sizes = sample_sizes if sample_sizes is not None else {}
+        self.eta = eta
+        self.backend = backend
+        self.metrics = metrics
+        self.disk_footprint = disk_footprint
+        self.temp_files = temp_files
+        if self.metrics:
+            self.metrics.track(module=module, cmd_data=cmd_data)
+        # Сводки ресурсов по стадиям и образцам модуля
+        self.unit_resources = []
 
         # Инициализируем раздел логов для текущего модуля
-        for log_type in ['log', 'stdout', 'stderr']:
-            if f'{self.module}_{self.module_start_time}' not in self.logs[log_type]:
-                self.logs[log_type][f'{self.module}_{self.module_start_time}'] = {}
+        self.log_sink.write({'type':'section', 'section':self.log_section, 'module':self.module})
 
-    def execute(self, module_stages:list, module_result_dict:dict, timeout_behavior:str='') -> dict:
+    def execute(self, module_stages:list, module_result_dict:dict, timeout_behavior:str='', max_parallel_samples:int=1,
+                resources:ResourcePool=None) -> dict:
         """
         Выполняет команды для списка образцов.
         
         :param samples: Список образцов.
         :param module_result_dict: Данные о результатах выполнения пайплайна для каждого образца
+        :param max_parallel_samples: Количество образцов, обрабатываемых одновременно в стадии batch
+        :param resources: Пул ресурсов машины, в пределах которого распределяются команды образцов
         """
         cmds:dict
         # Цвета!
@@ -42,29 +77,28 @@ class CommandExecutor:
         WHITE ="\033[37m"
         PURPLE = "\033[35m"
         
-        # Получаем раздел логов для текущего модуля
-        log_section = self.logs['log'][f'{self.module}_{self.module_start_time}']
-        stdout_section = self.logs['stdout'][f'{self.module}_{self.module_start_time}']
-        stderr_section = self.logs['stderr'][f'{self.module}_{self.module_start_time}']
-        
         start_time_module = time.time()
         for module_stage in module_stages:
             print(f'\tStage: {PURPLE}{module_stage}{WHITE}')
             if module_stage != 'batch':
-                module_result_dict[module_stage] = {'status':True, 'programms':{}}
                 # Получаем команды для стадии модуля
                 cmds = self.cmd_data[module_stage]
-                unit_result, exit_codes, status, interruption = run_cmds(cmds=cmds, debug=self.debug, timeout_behavior=timeout_behavior)
-                if any(code != 0 for code in exit_codes.values()):
-                        module_result_dict[module_stage]['status'] = False
-                        module_result_dict['status'] = False
-                module_result_dict[module_stage]['status'] = status
-                module_result_dict[module_stage]['programms'].update(exit_codes)
-
-                # Обновляем логи
-                log_section, stdout_section, stderr_section = gather_logs(all_logs=self.logs, log_space=self.log_space,
-                                                                          log=log_section, stdout=stdout_section, stderr=stderr_section,
-                                                                          unit=module_stage, unit_result=unit_result)
+                unit_result, exit_codes, status, interruption = self.run_unit(module_stage=module_stage, cmds=cmds,
+                                                                              timeout_behavior=timeout_behavior)
+                self.commit_stage(module_stage=module_stage, module_result_dict=module_result_dict,
+                                  unit_result=unit_result, exit_codes=exit_codes, status=status)
+                if interruption:
+                    return module_result_dict
+            elif self.backend:
+                interruption = self.backend.run_batch(executor=self, module_stage=module_stage,
+                                                      module_result_dict=module_result_dict, timeout_behavior=timeout_behavior,
+                                                      max_parallel_samples=max_parallel_samples, resources=resources)
+                if interruption:
+                    return module_result_dict
+            elif max_parallel_samples > 1:
+                interruption = self.execute_parallel(module_stage=module_stage, module_result_dict=module_result_dict,
+                                                     timeout_behavior=timeout_behavior, max_workers=max_parallel_samples,
+                                                     resources=resources)
                 if interruption:
                     return module_result_dict
             else:
@@ -72,31 +106,227 @@ class CommandExecutor:
                 k = 0
                 samples = self.cmd_data[module_stage].keys()
                 for sample in samples:
-                    module_result_dict[module_stage][sample] = {'status':True, 'programms':{}}
-                    #s = module_result_dict['samples'][sample]
                     print(f'\t\tSample: {YELLOW}{sample}{WHITE}')
 
                     # Получаем команды для текущего образца
                     cmds = self.cmd_data[module_stage][sample]
-                    unit_result, exit_codes, status, interruption = run_cmds(cmds=cmds, debug=self.debug, timeout_behavior=timeout_behavior)
-                    if any(code != 0 for code in exit_codes.values()):
-                        module_result_dict[module_stage][sample]['status'] = False
-                        module_result_dict['status'] = False
-                    module_result_dict[module_stage][sample]['programms'].update(exit_codes)
-                    
-                    # Обновляем логи
-                    log_section, stdout_section, stderr_section = gather_logs(all_logs=self.logs, log_space=self.log_space,
-                                                                            log=log_section, stdout=stdout_section, stderr=stderr_section,
-                                                                            unit=module_stage, unit_result=unit_result)
+                    unit_result, exit_codes, status, interruption = self.run_unit(module_stage=module_stage, cmds=cmds,
+                                                                                  timeout_behavior=timeout_behavior, sample=sample,
+                                                                                  resources=resources)
+                    self.commit_sample(module_stage=module_stage, sample=sample, module_result_dict=module_result_dict,
+                                       unit_result=unit_result, exit_codes=exit_codes)
                     
                     if interruption:
-                        break
+                        return module_result_dict
                                         
                     # Вывод статистики по времени, затраченному на обработку одного образца в рамках модуля
                     k+=1
-                    avg_duration = (time.time()-start_time_module)/k
-                    samples_remain = len(samples) - k
-                    est_total_time = convert_secs_to_dhms(secs=int(avg_duration * samples_remain), precision='m')
-                    print(f'{k}/{len(samples)}. Est. module completion time: {est_total_time} ')
+                    self.report_progress(sample=sample, unit_result=unit_result, k=k, total=len(samples),
+                                         start_time=start_time_module)
                     
-        return module_result_dict
\ No newline at end of file
+        return module_result_dict
+
+
+    def execute_parallel(self, module_stage:str, module_result_dict:dict,
+                         timeout_behavior:str, max_workers:int, resources:ResourcePool=None) -> bool:
+        """
+        Выполняет наборы команд образцов стадии batch в пуле потоков.
+        Порядок команд внутри образца сохраняется. Результаты и логи фиксируются строго в исходном порядке образцов, \
+            независимо от того, в каком порядке завершаются потоки.
+
+        :param module_stage: Стадия модуля.
+        :param module_result_dict: Данные о результатах выполнения модуля.
+        :param max_workers: Максимальное количество одновременно обрабатываемых образцов.
+        :param resources: Пул ресурсов машины; команды запускаются, только если их потоки и память помещаются в свободные ресурсы.
+        :return: Флаг прерывания.
+        """
+        samples = list(self.cmd_data[module_stage].keys())
+        print(f'\t\tSamples: {len(samples)}, parallel: {min(max_workers, len(samples))}')
+        start_time = time.time()
+        finished = {}
+        interruption = False
+        # Индекс следующего образца, результаты которого нужно зафиксировать
+        next_to_commit = 0
+        k = 0
+
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+        futures = {pool.submit(self.run_unit, module_stage=module_stage, cmds=self.cmd_data[module_stage][sample],
+                               timeout_behavior=timeout_behavior, sample=sample, resources=resources, parallel=True): sample
+                   for sample in samples}
+        try:
+            for future in as_completed(futures):
+                finished[futures[future]] = future.result()
+                k += 1
+                if finished[futures[future]][3]:
+                    interruption = True
+                    interrupt_running_commands()
+                    break
+                self.report_progress(sample=futures[future], unit_result=finished[futures[future]][0], k=k,
+                                     total=len(samples), start_time=start_time)
+                # Фиксируем результаты всех образцов, для которых завершены и они сами, и все предшествующие
+                while next_to_commit < len(samples) and samples[next_to_commit] in finished:
+                    sample = samples[next_to_commit]
+                    unit_result, exit_codes, _status, _interruption = finished.pop(sample)
+                    self.commit_sample(module_stage=module_stage, sample=sample, module_result_dict=module_result_dict,
+                                       unit_result=unit_result, exit_codes=exit_codes)
+                    next_to_commit += 1
+        except KeyboardInterrupt:
+            print('INTERRUPTED')
+            interruption = True
+            interrupt_running_commands()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        if interruption:
+            # Дожидаемся уже запущенных образцов и фиксируем всё, что успело выполниться
+            for future, sample in futures.items():
+                if sample not in finished and future.done() and not future.cancelled():
+                    finished[sample] = future.result()
+            for sample in samples[next_to_commit:]:
+                if sample in finished:
+                    unit_result, exit_codes, _status, _interruption = finished.pop(sample)
+                    self.commit_sample(module_stage=module_stage, sample=sample, module_result_dict=module_result_dict,
+                                       unit_result=unit_result, exit_codes=exit_codes)
+        return interruption
+
+
+    def commit_stage(self, module_stage:str, module_result_dict:dict, unit_result:dict, exit_codes:dict, status:bool,
+                     periodic:bool=False):
+        """
+        Заносит результаты выполнения команд стадии модуля (before_batch, after_batch) в словарь результатов модуля и в логи.
+
+        :param periodic: Стадия after_batch выполнена по запросу в режиме наблюдения и не завершает модуль.
+        """
+        module_result_dict[module_stage] = {'status':True, 'programms':{}}
+        if any(code != 0 for code in exit_codes.values()):
+                module_result_dict[module_stage]['status'] = False
+                module_result_dict['status'] = False
+        module_result_dict[module_stage]['status'] = status
+        module_result_dict[module_stage]['programms'].update(exit_codes)
+        self.add_resources(module_result_dict[module_stage], unit_result)
+        if self.metrics:
+            self.metrics.record_unit(module=self.module, unit_result=unit_result)
+        if self.eta:
+            self.eta.stage_done(module=self.module, stage=module_stage)
+        if self.temp_files and module_stage == 'after_batch' and not periodic:
+            self.temp_files.after_batch_done(module=self.module, success=status, section=self.log_section)
+
+        # Обновляем логи
+        gather_logs(log_sink=self.log_sink, section=self.log_section, unit=module_stage, unit_result=unit_result)
+
+
+    def commit_sample(self, module_stage:str, sample:str, module_result_dict:dict,
+                      unit_result:dict, exit_codes:dict, job:dict=None):
+        """
+        Заносит результаты выполнения команд образца в словарь результатов модуля и в логи.
+
+        :param job: Данные учёта задания планировщика кластера, в котором выполнялся образец.
+        """
+        module_result_dict[module_stage][sample] = {'status':True, 'programms':{}}
+        if any(code != 0 for code in exit_codes.values()):
+            module_result_dict[module_stage][sample]['status'] = False
+            module_result_dict['status'] = False
+        module_result_dict[module_stage][sample]['programms'].update(exit_codes)
+        self.add_resources(module_result_dict[module_stage][sample], unit_result)
+        if self.metrics:
+            self.metrics.record_unit(module=self.module, unit_result=unit_result)
+        if self.temp_files and module_stage == 'batch':
+            self.temp_files.sample_done(module=self.module, sample=sample, section=self.log_section,
+                                        success=module_result_dict[module_stage][sample]['status'])
+        if job:
+            module_result_dict[module_stage][sample]['job'] = job
+
+        # Обновляем логи
+        gather_logs(log_sink=self.log_sink, section=self.log_section, unit=module_stage,
+                    unit_result=unit_result, sample=sample, input_size=self.sample_sizes.get(sample), job=job)
+
+
+    def add_resources(self, unit_result_dict:dict, unit_result:dict):
+        """
+        Добавляет сводку ресурсов, затраченных командами стадии (образца), в её результаты и в сводку модуля.
+        """
+        resources = summarize_resources(unit_result['log'].values())
+        if resources:
+            unit_result_dict['resources'] = resources
+            self.unit_resources.append(resources)
+
+
+    def commit_module(self, module_result_dict:dict):
+        """
+        Заносит сводку ресурсов, затраченных модулем, в результаты модуля и в журнал и выводит её в консоль.
+        """
+        resources = summarize_resources(self.unit_resources)
+        if not resources:
+            return
+        module_result_dict['resources'] = resources
+        self.log_sink.write({'type':'summary', 'section':self.log_section, 'module':self.module, 'resources':resources})
+        print(f'Resources ({self.module}): CPU user {resources["user_cpu_sec"]}s, system {resources["system_cpu_sec"]}s; '
+              f'peak RSS {format_size(resources["max_rss_bytes"])}; read {format_size(resources["read_bytes"])}, '
+              f'written {format_size(resources["write_bytes"])}\n', end='')
+
+
+    def run_unit(self, module_stage:str, cmds:dict, timeout_behavior:str, sample:str='',
+                 resources:ResourcePool=None, parallel:bool=False, label:str='') -> tuple:
+        """
+        Выполняет команды стадии (или образца в стадии batch) с настройками исполнителя.
+
+        :param parallel: Образец выполняется параллельно с другими - строки вывода печатаются с префиксом образца.
+        :param label: Префикс строк вывода вместо имени образца (стадии, выполняемые параллельно с образцами).
+        :return: Результат run_cmds.
+        """
+        disk = resources.disk if resources and module_stage == 'batch' and self.sample_footprint(sample) else None
+        try:
+            reservation = disk.acquire(path=self.disk_footprint['path'], size=self.sample_footprint(sample),
+                                       label=sample) if disk else None
+        except DiskSpaceError as e:
+            return failed_unit(cmds=cmds, exit_code='NO_SPACE', message=str(e))
+        # Команды образца пишут данные в пределах его резерва
+        token = UNIT_DISK_RESERVATION.set(reservation)
+        try:
+            return run_cmds(cmds=cmds, debug=self.debug, timeout_behavior=timeout_behavior,
+                            sample=(label or sample) if parallel else '', resources=resources,
+                            output_dir=self.output_dir(module_stage, sample), capture=self.capture, cache=self.cache,
+                            checkpoint=self.checkpoint.unit(self.module, module_stage, sample) if self.checkpoint else None)
+        finally:
+            UNIT_DISK_RESERVATION.reset(token)
+            if reservation:
+                disk.release(reservation)
+
+
+    def sample_footprint(self, sample:str) -> int:
+        """
+        Объём данных, записываемых образцом, в байтах (0 - не объявлен).
+        """
+        if not self.disk_footprint or not sample:
+            return 0
+        return parse_footprint(self.disk_footprint['size'], input_size=self.sample_sizes.get(sample, 0))
+
+
+    def output_dir(self, module_stage:str, sample:str='') -> str:
+        """
+        Возвращает папку для файлов stdout/stderr команд стадии (или образца в стадии batch).
+        """
+        return os.path.join(self.log_space['log_dir'], 'cmd_output', self.log_section, module_stage, sample)
+
+
+    def report_progress(self, sample:str, unit_result:dict, k:int, total:int, start_time:float):
+        """
+        Учитывает обработанный образец в оценке времени выполнения и выводит прогресс модуля.
+        Без оценки по истории (eta) выводится прежняя оценка по среднему времени обработки образца.
+        """
+        if not self.eta:
+            self.print_progress(k=k, total=total, start_time=start_time)
+            return
+        self.eta.sample_done(module=self.module, sample=sample, unit_result=unit_result)
+        print(f'{self.eta.format_progress(module=self.module, done=k, total=total)}\n', end='')
+
+
+    @staticmethod
+    def print_progress(k:int, total:int, start_time:float):
+        """
+        Выводит количество обработанных образцов и оценку времени до завершения модуля.
+        """
+        avg_duration = (time.time()-start_time)/k
+        samples_remain = total - k
+        est_total_time = convert_secs_to_dhms(secs=int(avg_duration * samples_remain), precision='m')
+        print(f'{k}/{total}. Est. module completion time: {est_total_time} \n', end='')
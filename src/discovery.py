@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+import time
+from src.utils import write_json_atomic
+
+INDEX_VERSION = 1
+
+
+class DiscoveryIndex:
+    """
+    Сохраняемый между запусками индекс содержимого папок входных данных.
+    Для каждой папки хранится список вложенных файлов и папок вместе со временем изменения папки (mtime_ns): \
+        папка, время изменения которой не изменилось, повторно не перечитывается (для неё выполняется один stat). \
+        Поддеревья проверяются так же, поэтому поиск по неизменившемуся дереву сводится к stat каждой папки.
+    Время изменения папки меняется при создании, удалении и переименовании вложенных файлов, но не при изменении \
+        их содержимого, поэтому индекс хранит только имена.
+    """
+    # Папка, изменённая незадолго до чтения, могла измениться ещё раз в пределах точности mtime; \
+    # такие записи используются в текущем поиске, но при следующем перечитываются
+    RACY_NS = 2 * 10**9
+
+    def __init__(self, index_path:str):
+        """
+        :param index_path: Путь к файлу индекса.
+        """
+        self.index_path = index_path
+        # Записи папок: {путь: {'mtime_ns', 'files', 'dirs', 'links', 'racy'}}
+        self.dirs = {}
+        self.changed = False
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path, 'r') as file:
+                data = json.load(file)
+        except (OSError, json.JSONDecodeError):
+            return
+        if data.get('version') == INDEX_VERSION:
+            self.dirs = data.get('dirs', {})
+
+    def save(self):
+        """
+        Сохраняет индекс, если он изменился.
+        """
+        with self.lock:
+            if not self.changed:
+                return
+            os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+            write_json_atomic(self.index_path, {'version': INDEX_VERSION, 'dirs': self.dirs})
+            self.changed = False
+
+    def list_dir(self, dir:str) -> dict:
+        """
+        Возвращает запись папки из индекса, перечитывая папку, если она изменилась.
+
+        :return: Словарь: files - файлы, dirs - вложенные папки, links - ссылки на папки (не обходятся, как в os.walk).
+        """
+        dir = os.path.normpath(dir)
+        mtime_ns = os.stat(dir).st_mtime_ns
+        with self.lock:
+            entry = self.dirs.get(dir)
+            if entry and entry['mtime_ns'] == mtime_ns and not entry.get('racy'):
+                return entry
+        files, dirs, links = [], [], []
+        with os.scandir(dir) as entries:
+            for item in entries:
+                # Тип берётся из данных scandir без дополнительного stat (кроме символических ссылок)
+                if item.is_dir():
+                    (links if item.is_symlink() else dirs).append(item.name)
+                else:
+                    files.append(item.name)
+        entry = {'mtime_ns': mtime_ns, 'files': sorted(files), 'dirs': sorted(dirs), 'links': sorted(links),
+                 'racy': time.time_ns() - mtime_ns < self.RACY_NS}
+        with self.lock:
+            previous = self.dirs.get(dir)
+            # Удалённые папки убираются из индекса вместе с поддеревьями
+            for name in set(previous['dirs'] if previous else []) - set(dirs):
+                self.forget(os.path.join(dir, name))
+            self.dirs[dir] = entry
+            self.changed = True
+        return entry
+
+    def forget(self, dir:str):
+        prefix = os.path.join(dir, '')
+        for path in [path for path in self.dirs if path == dir or path.startswith(prefix)]:
+            del self.dirs[path]
+
+    def find_samples(self, dir:str, extensions:tuple, subfolders:bool=False) -> list:
+        """
+        Возвращает пути с указанными расширениями: в папке dir (файлы и папки, как get_samples_in_dir) либо \
+            во всём дереве папок (только файлы, как get_samples_in_dir_tree). Индекс сохраняется после поиска.
+        """
+        entry = self.list_dir(dir)
+        if not subfolders:
+            samples = [os.path.join(dir, name) for name in entry['files'] + entry['dirs'] + entry['links']
+                       if name.endswith(extensions)]
+        else:
+            samples = []
+            stack = [dir]
+            while stack:
+                root = stack.pop()
+                try:
+                    entry = self.list_dir(root)
+                except FileNotFoundError:
+                    # Папка удалена во время обхода
+                    continue
+                samples.extend(os.path.join(root, name) for name in entry['files'] if name.endswith(extensions))
+                stack.extend(os.path.join(root, name) for name in reversed(entry['dirs']))
+        self.save()
+        return samples
+
+
+def create_discovery_index(machine_data:dict, output_dir:str) -> DiscoveryIndex:
+    """
+    Создаёт индекс по настройкам машины (ключ discovery_index: true - файл в папке результатов, \
+        путь - указанный файл, false - поиск без индекса).
+    """
+    option = machine_data.get('discovery_index', True)
+    if not option:
+        return None
+    return DiscoveryIndex(index_path=option if isinstance(option, str) else
+                          os.path.join(output_dir, '.pipeline_discovery.json'))
@@ -0,0 +1,370 @@
+import bisect
+import threading
+import time
+from datetime import datetime, timedelta
+from src.history import RunHistory
+from src.utils import convert_secs_to_dhms, write_json_atomic
+
+
+class DurationModel:
+    """
+    Модель длительности обработки образца модулем по наблюдениям (история предыдущих запусков и образцы текущего \
+        запуска, переопределяющие историю).
+    Агрегаты наблюдений (суммы, отсортированные длительности и скорости обработки) обновляются по одному наблюдению, \
+        поэтому параметры модели не пересчитываются по всем образцам при каждом обработанном образце.
+    """
+    # Относительный разброс оценки, если наблюдений слишком мало для процентилей
+    DEFAULT_SPREAD = 0.5
+
+    def __init__(self, history_samples:dict):
+        """
+        :param history_samples: История образцов модуля (см. RunHistory.samples).
+        """
+        # {образец: (размер входных данных либо None, длительность)}
+        self.observed = {}
+        # Длительности всех наблюдений и длительности обработки байта наблюдений с размером - по возрастанию
+        self.durations = []
+        self.ratios = []
+        # Суммы по наблюдениям с размером; timed - количество таких наблюдений с ненулевой длительностью
+        self.total_size = 0
+        self.total_duration = 0
+        self.sized = 0
+        self.timed = 0
+        self.cached_params = None
+        for sample, data in history_samples.items():
+            if data['durations']:
+                self.observe(sample=sample, size=data['size'], duration=sum(data['durations'].values()))
+
+    def observe(self, sample:str, size:int, duration:float):
+        """
+        Учитывает наблюдение (заменяя прежнее наблюдение образца).
+        """
+        previous = self.observed.get(sample)
+        if previous:
+            self.count(*previous, sign=-1)
+        self.observed[sample] = (size, duration)
+        self.count(size, duration, sign=1)
+        self.cached_params = None
+
+    def count(self, size:int, duration:float, sign:int):
+        self.update_sorted(self.durations, duration, sign)
+        if not size:
+            return
+        self.update_sorted(self.ratios, duration / size, sign)
+        self.total_size += sign * size
+        self.total_duration += sign * duration
+        self.sized += sign
+        if duration:
+            self.timed += sign
+
+    @staticmethod
+    def update_sorted(values:list, value:float, sign:int):
+        if sign > 0:
+            bisect.insort(values, value)
+        else:
+            del values[bisect.bisect_left(values, value)]
+
+    def params(self) -> tuple:
+        """
+        Параметры модели.
+
+        :return: Кортеж (длительность обработки байта либо None, оценка образца без истории и размера, \
+                 нижняя и верхняя относительные границы) либо None, если наблюдений нет.
+        """
+        if self.cached_params is None and self.observed:
+            if self.sized and self.timed:
+                rate = self.total_duration / self.total_size
+                fallback = self.total_duration / self.sized
+                low, high = self.spread(self.ratios, rate)
+            else:
+                rate = None
+                fallback = self.median(self.durations)
+                low, high = self.spread(self.durations, fallback)
+            self.cached_params = (rate, fallback, low, high)
+        return self.cached_params
+
+    @staticmethod
+    def median(values:list) -> float:
+        middle = len(values) // 2
+        return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+    @classmethod
+    def spread(cls, values:list, point:float) -> tuple:
+        """
+        Относительные границы диапазона оценки по разбросу наблюдений (10-й и 90-й процентили, \
+            как statistics.quantiles(values, n=10) для отсортированного списка).
+        """
+        if len(values) < 3 or not point:
+            return (1 - cls.DEFAULT_SPREAD, 1 + cls.DEFAULT_SPREAD)
+        def decile(i:int) -> float:
+            j = min(max(i * (len(values) + 1) // 10, 1), len(values) - 1)
+            delta = i * (len(values) + 1) - j * 10
+            return (values[j - 1] * (10 - delta) + values[j] * delta) / 10
+        return (min(1.0, decile(1) / point), max(1.0, decile(9) / point))
+
+
+class RemainingWork:
+    """
+    Суммарная оценка необработанных образцов модуля, обновляемая при добавлении и обработке образца.
+    Оценка образца - длительность по истории либо, без истории, размер входных данных, умноженный на скорость обработки, \
+        либо средняя длительность; поэтому сумма оценок выражается через параметры модели и несколько сумм.
+    """
+    def __init__(self):
+        self.samples = 0
+        # Сумма длительностей по истории, сумма и количество размеров образцов без истории, образцы без истории и размера
+        self.history = 0
+        self.size = 0
+        self.sized = 0
+        self.unsized = 0
+
+    def add(self, point:float, size:int, sign:int=1):
+        """
+        :param point: Длительность образца по истории либо None.
+        :param sign: 1 - образец добавлен, -1 - образец обработан.
+        """
+        self.samples += sign
+        if point is not None:
+            self.history += sign * point
+        elif size:
+            self.size += sign * size
+            self.sized += sign
+        else:
+            self.unsized += sign
+
+    def total(self, params:tuple) -> float:
+        rate, fallback, _, _ = params
+        if rate is None:
+            return self.history + fallback * (self.sized + self.unsized)
+        return self.history + rate * self.size + fallback * self.unsized
+
+
+class EtaTracker:
+    """
+    Оценка времени до завершения модулей и всего пайплайна.
+    Длительность образца оценивается по истории предыдущих запусков (длительность этого же образца либо скорость \
+        обработки модулем байта входных данных) и по уже обработанным в текущем запуске образцам; оставшаяся работа \
+        делится на число одновременно обрабатываемых образцов.
+    Диапазон оценки строится по разбросу скорости обработки (10-й и 90-й процентили) в наблюдениях.
+    Модели длительности и оценки оставшейся работы обновляются по событиям, поэтому оценка не зависит от числа образцов.
+    """
+    # Файл состояния по обработанным образцам перезаписывается не чаще, чем раз в STATUS_INTERVAL секунд; \
+    #   начало и завершение модулей записываются сразу
+    STATUS_INTERVAL = 1
+
+    def __init__(self, history:RunHistory, modules:list, status_file:str='', metrics=None):
+        """
+        :param history: История предыдущих запусков.
+        :param modules: Запускаемые модули в порядке выполнения.
+        :param status_file: Путь к файлу состояния (JSON), который перезаписывается при обновлении оценки.
+        :param metrics: Метрики выполнения команд (src.metrics.RunMetrics), добавляемые в файл состояния.
+        """
+        self.history = history
+        self.status_file = status_file
+        self.metrics = metrics
+        # {модуль: {'state', 'sizes', 'done', 'remaining', 'concurrency', 'start_time', 'end_time', 'stages'}}
+        self.modules = {module: {'state': 'pending', 'sizes': {}, 'done': {}, 'remaining': RemainingWork(),
+                                 'concurrency': 1, 'start_time': None, 'end_time': None, 'stages': set()}
+                        for module in modules}
+        # Модели длительности образцов по модулям (создаются при первой оценке)
+        self.models = {}
+        # Образцы последнего запущенного модуля; используются для оценки ещё не запущенных модулей
+        self.samples = []
+        # Оценки оставшейся работы ещё не запущенных модулей по образцам self.samples
+        self.pending = {}
+        # Количество одновременно обрабатываемых образцов в последнем запущенном модуле
+        self.concurrency = 1
+        self.lock = threading.Lock()
+        # Файл состояния перезаписывается и по событиям, и периодически (см. RunMetrics.start)
+        self.write_lock = threading.Lock()
+        self.written = 0
+
+    def model(self, module:str) -> DurationModel:
+        if module not in self.models:
+            self.models[module] = DurationModel(self.history.samples.get(module, {}))
+        return self.models[module]
+
+    def start_module(self, module:str, sample_sizes:dict, concurrency:int=1):
+        """
+        Отмечает начало выполнения модуля.
+
+        :param sample_sizes: Размеры входных данных образцов {образец: байты}.
+        :param concurrency: Количество одновременно обрабатываемых образцов.
+        """
+        with self.lock:
+            data = self.modules.setdefault(module, {'done': {}, 'stages': set()})
+            data.update({'state': 'running', 'sizes': dict(sample_sizes), 'remaining': RemainingWork(),
+                         'concurrency': max(1, int(concurrency)), 'start_time': datetime.now(), 'end_time': None})
+            for sample, size in data['sizes'].items():
+                if sample not in data['done']:
+                    data['remaining'].add(point=self.history.sample_duration(module, sample), size=size)
+            if sample_sizes:
+                self.samples = list(sample_sizes)
+                self.pending = {}
+            self.concurrency = data['concurrency']
+        self.write_status()
+
+    def add_samples(self, module:str, sample_sizes:dict):
+        """
+        Добавляет образцы в выполняющийся модуль (потоковый режим: образцы поступают по мере готовности).
+        """
+        with self.lock:
+            data = self.modules[module]
+            for sample, size in sample_sizes.items():
+                if sample in data['done']:
+                    data['sizes'][sample] = size
+                    continue
+                point = self.history.sample_duration(module, sample)
+                if sample in data['sizes']:
+                    data['remaining'].add(point=point, size=data['sizes'][sample], sign=-1)
+                data['sizes'][sample] = size
+                data['remaining'].add(point=point, size=size)
+
+    def sample_done(self, module:str, sample:str, unit_result:dict):
+        """
+        Учитывает обработанный образец.
+
+        :param unit_result: Результаты выполнения команд образца (см. run_cmds).
+        """
+        durations = [log['duration_sec'] for log in unit_result['log'].values() if RunHistory.is_measured(log)]
+        duration = sum(durations) if durations else None
+        with self.lock:
+            data = self.modules[module]
+            if sample in data['sizes'] and sample not in data['done']:
+                data['remaining'].add(point=self.history.sample_duration(module, sample), size=data['sizes'][sample],
+                                      sign=-1)
+            data['done'][sample] = duration
+            if duration is not None:
+                self.model(module).observe(sample=sample, size=data['sizes'].get(sample), duration=duration)
+        self.write_status(throttle=True)
+
+    def stage_done(self, module:str, stage:str):
+        """
+        Отмечает выполненную стадию модуля (before_batch, after_batch).
+        """
+        with self.lock:
+            self.modules[module]['stages'].add(stage)
+
+    def finish_module(self, module:str):
+        with self.lock:
+            self.modules[module].update({'state': 'done', 'end_time': datetime.now()})
+        self.write_status()
+
+    def stage_estimate(self, module:str, data:dict) -> float:
+        """
+        Оценка длительности ещё не выполненных стадий before_batch и after_batch модуля по истории.
+        """
+        stages = self.history.stages.get(module, {})
+        return sum(sum(durations.values()) for stage, durations in stages.items() if stage not in data.get('stages', ()))
+
+    def module_eta(self, module:str) -> tuple:
+        """
+        Оценка оставшегося времени выполнения модуля.
+
+        :return: Кортеж (оценка, нижняя граница, верхняя граница) в секундах либо None, если оценить нельзя.
+        """
+        with self.lock:
+            data = self.modules.get(module)
+            if not data or data['state'] == 'done':
+                return (0, 0, 0)
+            params = self.model(module).params()
+            if params is None:
+                return None
+            if data['state'] == 'pending':
+                # Образцы модуля ещё неизвестны: считаем, что он обработает те же образцы, что и предыдущий
+                if module not in self.pending:
+                    self.pending[module] = RemainingWork()
+                    for sample in self.samples:
+                        self.pending[module].add(point=self.history.sample_duration(module, sample), size=None)
+                remaining = self.pending[module]
+                concurrency = self.concurrency
+            else:
+                remaining = data['remaining']
+                concurrency = data['concurrency']
+            stages = self.stage_estimate(module, data)
+            if not remaining.samples:
+                return (stages,) * 3
+            concurrency = max(1, min(concurrency, remaining.samples))
+            total = remaining.total(params)
+            _, _, low, high = params
+        return tuple(total * factor / concurrency + stages for factor in (1, low, high))
+
+    def pipeline_eta(self) -> tuple:
+        """
+        Оценка оставшегося времени выполнения пайплайна (сумма оценок невыполненных модулей).
+
+        :return: Кортеж (оценка либо None, если не удалось оценить ни один невыполненный модуль, \
+                 список модулей, которые не удалось оценить).
+        """
+        total = (0, 0, 0)
+        unknown = []
+        for module in list(self.modules):
+            estimate = self.module_eta(module)
+            if estimate is None:
+                unknown.append(module)
+                continue
+            total = tuple(a + b for a, b in zip(total, estimate))
+        if unknown and len(unknown) == len([data for data in list(self.modules.values()) if data['state'] != 'done']):
+            return (None, unknown)
+        return (total, unknown)
+
+    def format_progress(self, module:str, done:int, total:int) -> str:
+        """
+        Строка прогресса модуля для вывода в консоль.
+        """
+        def fmt(estimate):
+            if estimate is None:
+                return 'unknown'
+            point, low, high = (convert_secs_to_dhms(secs=int(value), precision='m') for value in estimate)
+            return f'{point} ({low} - {high})'
+        pipeline, unknown = self.pipeline_eta()
+        # Модули без истории в оценку пайплайна не входят
+        partial = f' + {", ".join(unknown)}' if unknown and pipeline is not None else ''
+        return f'{done}/{total}. Est. module completion time: {fmt(self.module_eta(module))}; ' \
+               f'pipeline: {fmt(pipeline)}{partial}'
+
+    def status(self) -> dict:
+        """
+        Состояние выполнения и оценки времени в машиночитаемом виде.
+        """
+        now = datetime.now()
+        def describe(estimate):
+            if estimate is None:
+                return {'eta_sec': None, 'low_sec': None, 'high_sec': None, 'eta_time': None}
+            point, low, high = (round(value) for value in estimate)
+            return {'eta_sec': point, 'low_sec': low, 'high_sec': high,
+                    'eta_time': (now + timedelta(seconds=point)).strftime("%d.%m.%Y %H:%M:%S")}
+        def throughput(data):
+            # Образцов в час времени выполнения модуля
+            if not data['start_time'] or not data['done']:
+                return None
+            hours = ((data['end_time'] or now) - data['start_time']).total_seconds() / 3600
+            return round(len(data['done']) / hours, 2) if hours > 0 else None
+        modules = {}
+        for module, data in list(self.modules.items()):
+            modules[module] = {'state': data['state'], 'done': len(data['done']), 'total': len(data['sizes']),
+                               'concurrency': data['concurrency'], 'throughput_samples_per_hour': throughput(data),
+                               **describe(self.module_eta(module))}
+        pipeline, unknown = self.pipeline_eta()
+        status = {'updated': now.strftime("%d.%m.%Y %H:%M:%S"),
+                  'pipeline': {**describe(pipeline), 'unknown_modules': unknown}, 'modules': modules}
+        if self.metrics:
+            status['metrics'] = self.metrics.status()
+        return status
+
+    def write_status(self, throttle:bool=False):
+        """
+        Атомарно перезаписывает файл состояния и файл метрик Prometheus.
+
+        :param throttle: Не перезаписывать файлы, если с прошлой записи прошло меньше STATUS_INTERVAL секунд.
+        """
+        if not self.status_file and not (self.metrics and self.metrics.textfile):
+            return
+        if throttle and time.monotonic() - self.written < self.STATUS_INTERVAL:
+            return
+        with self.write_lock:
+            self.written = time.monotonic()
+            status = self.status()
+            if self.status_file:
+                write_json_atomic(self.status_file, status)
+            if self.metrics:
+                self.metrics.write(status)
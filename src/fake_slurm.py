@@ -0,0 +1,241 @@
+"""
+Локальная имитация команд SLURM (sbatch, squeue, sacct, scancel) для проверки исполнителя SLURM без кластера.
+Задания выполняются на этой машине отдельными процессами; состояние хранится в папке FAKE_SLURM_DIR \
+    (по умолчанию /tmp/fake_slurm-<uid>).
+
+Использование: python -m src.fake_slurm <sbatch|squeue|sacct|scancel> [аргументы]
+"""
+import argparse
+import fcntl
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from src.utils import parse_size, write_json_atomic, get_resource_usage
+
+STATE_DIR = os.environ.get('FAKE_SLURM_DIR', f'/tmp/fake_slurm-{os.getuid()}')
+ACTIVE_STATES = ('PENDING', 'RUNNING')
+
+
+@contextmanager
+def locked():
+    """
+    Блокировка папки состояния: изменения заданий и выдача идентификаторов выполняются по одному.
+    """
+    os.makedirs(os.path.join(STATE_DIR, 'jobs'), exist_ok=True)
+    with open(os.path.join(STATE_DIR, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def job_path(job_id:str) -> str:
+    return os.path.join(STATE_DIR, 'jobs', f'{job_id}.json')
+
+
+def read_job(job_id:str) -> dict:
+    try:
+        with open(job_path(job_id), 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def update_job(job_id:str, **fields) -> dict:
+    """
+    Обновляет поля задания под блокировкой. Завершённое задание не меняется (например, отменённое scancel).
+    """
+    with locked():
+        job = read_job(job_id)
+        if job['state'] in ACTIVE_STATES:
+            job.update(fields)
+            write_json_atomic(job_path(job_id), job)
+        return job
+
+
+def parse_time_limit(value:str) -> int:
+    """
+    Переводит лимит времени sbatch (минуты, ММ:СС, ЧЧ:ММ:СС, Д-ЧЧ[:ММ[:СС]]) в секунды; 0 - без ограничения.
+    """
+    if not value:
+        return 0
+    days, _, rest = value.rpartition('-') if '-' in value else ('', '', value)
+    parts = [int(part or 0) for part in rest.split(':')]
+    if days:
+        parts += [0] * (3 - len(parts))
+        hours, minutes, secs = parts
+    elif len(parts) == 1:
+        hours, minutes, secs = 0, parts[0], 0
+    else:
+        hours, minutes, secs = ([0] * (3 - len(parts)) + parts)
+    return int(days or 0) * 86400 + hours * 3600 + minutes * 60 + secs
+
+
+def format_duration(secs:float, fraction:bool=False) -> str:
+    """
+    Длительность в формате sacct: [Д-]ЧЧ:ММ:СС (с миллисекундами, как в TotalCPU, если fraction).
+    """
+    days, rest = divmod(secs, 86400)
+    hours, rest = divmod(rest, 3600)
+    minutes, secs = divmod(rest, 60)
+    secs = f'{secs:06.3f}' if fraction else f'{int(secs):02d}'
+    return (f'{int(days)}-' if days else '') + f'{int(hours):02d}:{int(minutes):02d}:{secs}'
+
+
+def sbatch(argv:list):
+    parser = argparse.ArgumentParser(prog='sbatch')
+    parser.add_argument('--parsable', action='store_true')
+    parser.add_argument('--job-name', '-J', default='')
+    parser.add_argument('--output', '-o', default='')
+    parser.add_argument('--error', '-e', default='')
+    parser.add_argument('--cpus-per-task', '-c', type=int, default=1)
+    parser.add_argument('--mem', default='0')
+    parser.add_argument('--time', '-t', default='')
+    parser.add_argument('--partition', '-p', default='')
+    parser.add_argument('--account', '-A', default='')
+    parser.add_argument('script')
+    args, _ = parser.parse_known_args(argv)
+    script = os.path.abspath(args.script)
+    with locked():
+        counter_path = os.path.join(STATE_DIR, 'counter')
+        try:
+            with open(counter_path, 'r') as file:
+                job_id = str(int(file.read() or 0) + 1)
+        except FileNotFoundError:
+            job_id = '1'
+        with open(counter_path, 'w') as file:
+            file.write(job_id)
+        write_json_atomic(job_path(job_id), {
+            'job_id': job_id, 'name': args.job_name or os.path.basename(script), 'state': 'PENDING', 'script': script,
+            'cwd': os.getcwd(), 'output': args.output or os.path.join(os.getcwd(), f'slurm-{job_id}.out'),
+            'error': args.error, 'cpus': args.cpus_per_task,
+            # Без суффикса --mem указывается в мегабайтах
+            'mem': parse_size(args.mem if args.mem[-1:].isalpha() else f'{args.mem}M'),
+            'time_limit': parse_time_limit(args.time), 'partition': args.partition, 'submit_time': time.time(),
+            'start_time': None, 'end_time': None, 'exit_code': '0:0', 'max_rss': 0, 'total_cpu': 0,
+            'node': socket.gethostname(), 'pid': None})
+    # Задание выполняется отдельным процессом, не связанным с sbatch
+    subprocess.Popen([sys.executable, '-m', 'src.fake_slurm', '_run', job_id], stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    print(job_id if args.parsable else f'Submitted batch job {job_id}')
+
+
+def run_job(job_id:str):
+    """
+    Выполняет скрипт задания, соблюдая лимит времени, и записывает учётные данные.
+    """
+    job = read_job(job_id)
+    output = open(job['output'], 'a')
+    error = open(job['error'], 'a') if job['error'] else output
+    env = dict(os.environ, SLURM_JOB_ID=job_id, SLURM_JOB_NAME=job['name'], SLURM_CPUS_PER_TASK=str(job['cpus']),
+               SLURM_MEM_PER_NODE=str(job['mem'] // 1024**2))
+    process = subprocess.Popen(['/bin/bash', job['script']], cwd=job['cwd'], stdin=subprocess.DEVNULL,
+                               stdout=output, stderr=error, env=env, start_new_session=True)
+    start_time = time.time()
+    job = update_job(job_id, state='RUNNING', start_time=start_time, pid=process.pid)
+    if job['state'] == 'CANCELLED':
+        # scancel до запуска: задание отменено, пока процесс создавался
+        os.killpg(process.pid, signal.SIGTERM)
+    deadline = start_time + job['time_limit'] if job['time_limit'] else None
+    timed_out = False
+    while True:
+        pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        if deadline and time.time() > deadline and not timed_out:
+            timed_out = True
+            os.killpg(process.pid, signal.SIGKILL)
+        time.sleep(0.1)
+    usage = get_resource_usage(rusage)
+    exit_code = os.waitstatus_to_exitcode(status)
+    if timed_out:
+        state = 'TIMEOUT'
+    elif exit_code == 0:
+        state = 'COMPLETED'
+    elif job['mem'] and usage.get('max_rss_bytes', 0) > job['mem']:
+        state = 'OUT_OF_MEMORY'
+    else:
+        state = 'FAILED'
+    # ExitCode в sacct: <код выхода>:<номер сигнала>
+    sacct_code = f'0:{-exit_code}' if exit_code < 0 else f'{exit_code}:0'
+    update_job(job_id, state=state, end_time=time.time(), exit_code=sacct_code,
+               max_rss=usage.get('max_rss_bytes', 0), total_cpu=usage.get('user_cpu_sec', 0) + usage.get('system_cpu_sec', 0))
+
+
+def scancel(argv:list):
+    for job_id in argv:
+        with locked():
+            job = read_job(job_id)
+            if not job or job['state'] not in ACTIVE_STATES:
+                continue
+            job.update({'state': 'CANCELLED', 'end_time': time.time(), 'exit_code': '0:15'})
+            write_json_atomic(job_path(job_id), job)
+        if job['pid']:
+            try:
+                os.killpg(job['pid'], signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+def selected_jobs(job_ids:str) -> list:
+    if job_ids:
+        jobs = [read_job(job_id) for job_id in job_ids.split(',')]
+    else:
+        jobs = [read_job(name[:-5]) for name in os.listdir(os.path.join(STATE_DIR, 'jobs')) if name.endswith('.json')]
+    return sorted((job for job in jobs if job), key=lambda job: int(job['job_id']))
+
+
+def squeue(argv:list):
+    parser = argparse.ArgumentParser(prog='squeue', add_help=False)
+    parser.add_argument('--jobs', '-j', default='')
+    parser.add_argument('--noheader', '-h', action='store_true')
+    args, _ = parser.parse_known_args(argv)
+    if not args.noheader:
+        print('JOBID|NAME|STATE|TIME|NODELIST')
+    for job in selected_jobs(args.jobs):
+        if job['state'] in ACTIVE_STATES:
+            elapsed = time.time() - job['start_time'] if job['start_time'] else 0
+            print(f'{job["job_id"]}|{job["name"]}|{job["state"]}|{format_duration(elapsed)}|{job["node"]}')
+
+
+def sacct(argv:list):
+    parser = argparse.ArgumentParser(prog='sacct')
+    parser.add_argument('--jobs', '-j', default='')
+    parser.add_argument('--format', '-o', default='JobID,JobName,State,ExitCode,Elapsed')
+    parser.add_argument('--parsable2', '-P', action='store_true')
+    parser.add_argument('--noheader', '-n', action='store_true')
+    args, _ = parser.parse_known_args(argv)
+    fields = args.format.split(',')
+    if not args.noheader:
+        print('|'.join(fields))
+    for job in selected_jobs(args.jobs):
+        end_time = job['end_time'] or time.time()
+        elapsed = end_time - job['start_time'] if job['start_time'] else 0
+        values = {'JobID': job['job_id'], 'JobName': job['name'], 'State': job['state'], 'ExitCode': job['exit_code'],
+                  'Elapsed': format_duration(elapsed), 'MaxRSS': '',
+                  'TotalCPU': format_duration(job['total_cpu'], fraction=True), 'NodeList': job['node'], 'Partition': job['partition']}
+        print('|'.join(str(values.get(field, '')) for field in fields))
+        # Как и в SLURM, пиковая память учитывается шагом batch, а не строкой задания
+        if job['start_time']:
+            step = dict(values, JobID=f'{job["job_id"]}.batch', JobName='batch', MaxRSS=f'{job["max_rss"] // 1024}K')
+            print('|'.join(str(step.get(field, '')) for field in fields))
+
+
+def main():
+    commands = {'sbatch': sbatch, 'squeue': squeue, 'sacct': sacct, 'scancel': scancel}
+    if len(sys.argv) < 2 or sys.argv[1] not in [*commands, '_run']:
+        sys.exit(f'Использование: python -m src.fake_slurm <{"|".join(commands)}> [аргументы]')
+    if sys.argv[1] == '_run':
+        run_job(sys.argv[2])
+    else:
+        commands[sys.argv[1]](sys.argv[2:])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import glob
+import os
+from src.log_sink import read_records
+
+
+class RunHistory:
+    """
+    История выполнения модулей в предыдущих запусках, загружаемая из журналов log_records.jsonl в папке Logs.
+    Используется для оценки длительности обработки образцов.
+    """
+    def __init__(self, logs_dir:str, max_runs:int=10):
+        """
+        Загружает историю.
+
+        :param logs_dir: Папка с папками логов запусков (<output_dir>/Logs).
+        :param max_runs: Сколько последних запусков учитывать.
+        """
+        # {модуль: {образец: {'size': размер входных данных, 'durations': {команда: длительность, с}}}}
+        self.samples = {}
+        # {модуль: {стадия: {команда: длительность, с}}} для стадий before_batch и after_batch
+        self.stages = {}
+        runs = sorted(glob.glob(os.path.join(logs_dir, '*', 'log_records.jsonl')), key=os.path.getmtime)
+        # Более поздние запуски загружаются последними и переопределяют данные более ранних
+        for file_path in runs[-max_runs:] if max_runs else []:
+            self.load_run(file_path)
+
+    def load_run(self, file_path:str):
+        """
+        Загружает записи одного запуска.
+        """
+        sections = {}
+        for record in read_records(file_path):
+            if record.get('type') == 'section':
+                sections[record['section']] = record['module']
+                continue
+            if record.get('type') != 'unit':
+                continue
+            module = sections.get(record.get('section'))
+            if module is None:
+                continue
+            durations = {title: log['duration_sec'] for title, log in record.get('log', {}).items()
+                         if self.is_measured(log)}
+            if record['unit'] == 'batch':
+                sample_data = self.samples.setdefault(module, {}).setdefault(record['sample'], {'size': None, 'durations': {}})
+                sample_data['durations'].update(durations)
+                if record.get('input_size') is not None:
+                    sample_data['size'] = record['input_size']
+            else:
+                self.stages.setdefault(module, {}).setdefault(record['unit'], {}).update(durations)
+
+    @staticmethod
+    def is_measured(log:dict) -> bool:
+        """
+        Проверяет, что длительность команды измерена: команда успешно выполнялась, а не была взята из кэша \
+            или пропущена при возобновлении запуска.
+        """
+        return log.get('status') == 'OK' and 'cache' not in log and not log.get('resumed') \
+            and isinstance(log.get('duration_sec'), (int, float))
+
+    def sample_duration(self, module:str, sample:str) -> float:
+        """
+        Длительность обработки образца модулем в предыдущих запусках (сумма длительностей команд) либо None.
+        """
+        sample_data = self.samples.get(module, {}).get(sample)
+        if not sample_data or not sample_data['durations']:
+            return None
+        return sum(sample_data['durations'].values())
+
+    def module_rate(self, module:str) -> float:
+        """
+        Средняя длительность обработки модулем одного байта входных данных (с/байт) либо None, если данных нет.
+        """
+        total_size = 0
+        total_duration = 0
+        for sample_data in self.samples.get(module, {}).values():
+            if sample_data['size'] and sample_data['durations']:
+                total_size += sample_data['size']
+                total_duration += sum(sample_data['durations'].values())
+        # Длительности округляются до секунд, поэтому для коротких команд история не информативна
+        if not total_size or not total_duration:
+            return None
+        return total_duration / total_size
+
+    def order_samples(self, module:str, sizes:dict) -> list:
+        """
+        Упорядочивает образцы по убыванию ожидаемой длительности обработки (сначала самые долгие).
+        Длительность берётся из истории образца; если её нет - оценивается по размеру входных данных и средней \
+            скорости модуля. Если скорость модуля неизвестна, образцы упорядочиваются по размеру входных данных.
+
+        :param module: Название модуля.
+        :param sizes: Размеры входных данных образцов: {образец: размер в байтах}.
+        :return: Список образцов.
+        """
+        rate = self.module_rate(module)
+        if rate is None:
+            return sorted(sizes, key=lambda sample: sizes[sample], reverse=True)
+        costs = {}
+        for sample, size in sizes.items():
+            duration = self.sample_duration(module, sample)
+            costs[sample] = duration if duration is not None else size * rate
+        return sorted(sizes, key=lambda sample: costs[sample], reverse=True)
@@ -0,0 +1,162 @@
+import json
+import os
+import sys
+import threading
+import time
+import yaml
+from src.utils import YamlLoader, YamlDumper
+
+
+class JsonlLogSink:
+    """
+    Журнал выполнения в формате JSON Lines: каждая запись дописывается в конец файла одной строкой.
+    Стоимость записи не зависит от объёма уже накопленных логов; fsync выполняется пакетно.
+    """
+    def __init__(self, file_path:str, fsync_every:int=100, fsync_interval:float=5.0):
+        """
+        Инициализация журнала.
+
+        :param file_path: Путь к файлу журнала.
+        :param fsync_every: Количество записей, после которого данные принудительно сбрасываются на диск.
+        :param fsync_interval: Максимальный интервал в секундах между сбросами данных на диск.
+        """
+        self.file_path = file_path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.file = open(file_path, 'a', encoding='utf-8')
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def write(self, record:dict):
+        """
+        Дописывает запись в журнал.
+        """
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self.lock:
+            self.file.write(f'{line}\n')
+            self.file.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_every or time.time() - self.last_sync >= self.fsync_interval:
+                self.sync()
+
+    def sync(self):
+        """
+        Сбрасывает накопленные записи на диск.
+        """
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+                self.sync()
+                self.file.close()
+
+
+class YamlLogSink:
+    """
+    Прежний формат логов: при каждой записи файлы log.yaml, stdout_log.txt и stderr_log.txt перезаписываются целиком.
+    Оставлен для совместимости; стоимость записи растёт с объёмом логов.
+    """
+    def __init__(self, log_space:dict):
+        self.log_space = log_space
+        self.lock = threading.Lock()
+        self.logs = {'log':load_yaml_logs(log_space['log_data']),
+                     'stdout':load_yaml_logs(log_space['stdout_log']),
+                     'stderr':load_yaml_logs(log_space['stderr_log'])}
+
+    def write(self, record:dict):
+        with self.lock:
+            add_record(self.logs, record)
+            save_yaml_logs(logs=self.logs, log_space=self.log_space)
+
+    def close(self):
+        pass
+
+
+def create_log_sink(backend:str, log_space:dict):
+    """
+    Создаёт журнал выполнения указанного типа.
+
+    :param backend: Тип журнала: 'jsonl' (по умолчанию) либо 'yaml' (прежний формат с полной перезаписью файлов).
+    :param log_space: Пути к файлам логов.
+    """
+    if backend == 'yaml':
+        return YamlLogSink(log_space)
+    if backend in ('jsonl', '', None):
+        return JsonlLogSink(log_space['log_records'])
+    raise ValueError(f"Неизвестный тип журнала: {backend}")
+
+
+def read_records(file_path:str):
+    """
+    Построчно читает записи журнала JSON Lines. Повреждённая последняя строка (например, после сбоя узла) пропускается.
+
+    :param file_path: Путь к файлу журнала.
+    :return: Генератор записей.
+    """
+    if not os.path.isfile(file_path):
+        return
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def add_record(logs:dict, record:dict):
+    """
+    Добавляет запись журнала в структуру логов прежнего формата:
+    {раздел модуля: {стадия: {команда: данные}}}, для стадии batch - {стадия: {образец: {команда: данные}}}.
+    """
+    if record.get('type') not in ('section', 'unit'):
+        return
+    for log_type in ['log', 'stdout', 'stderr']:
+        section = logs[log_type].setdefault(record['section'], {})
+        if record['type'] == 'section':
+            continue
+        if record.get('sample'):
+            section.setdefault(record['unit'], {})[record['sample']] = record[log_type]
+        else:
+            section[record['unit']] = record[log_type]
+
+
+def load_yaml_logs(file_path:str) -> dict:
+    try:
+        with open(file_path, 'r') as file:
+            return yaml.load(file, Loader=YamlLoader) or {}
+    except FileNotFoundError:
+        return {}
+
+
+def save_yaml_logs(logs:dict, log_space:dict):
+    for log_type, file_key in [('log', 'log_data'), ('stdout', 'stdout_log'), ('stderr', 'stderr_log')]:
+        with open(log_space[file_key], 'w') as file:
+            yaml.dump(logs[log_type], file, Dumper=YamlDumper, default_flow_style=False)
+
+
+def export_yaml(log_space:dict):
+    """
+    Формирует из журнала JSON Lines файлы log.yaml, stdout_log.txt и stderr_log.txt в прежнем формате.
+
+    :param log_space: Пути к файлам логов.
+    """
+    logs = {'log':{}, 'stdout':{}, 'stderr':{}}
+    for record in read_records(log_space['log_records']):
+        add_record(logs, record)
+    save_yaml_logs(logs=logs, log_space=log_space)
+
+
+if __name__ == '__main__':
+    # Экспорт логов по требованию: python -m src.log_sink <папка логов>
+    if len(sys.argv) != 2:
+        raise SystemExit('Использование: python -m src.log_sink <папка логов>')
+    log_dir = sys.argv[1]
+    export_yaml({'log_records': os.path.join(log_dir, 'log_records.jsonl'),
+                 'log_data': os.path.join(log_dir, 'log.yaml'),
+                 'stdout_log': os.path.join(log_dir, 'stdout_log.txt'),
+                 'stderr_log': os.path.join(log_dir, 'stderr_log.txt')})
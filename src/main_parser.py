@@ -1,5 +1,6 @@
 import argparse
 import os
+import sys
 import importlib.util
 
 def parse_args():
@@ -11,7 +12,11 @@ def parse_args():
 
     # Загружаем и выполняем второй парсер, передаем остальные аргументы
     parse_cli_args = load_config_parser(initial_args.project_path)
+    sys.argv = [sys.argv[0], *remaining_args]
     final_args = parse_cli_args()
+    final_args['resume'] = initial_args.resume
+    final_args['worker'] = initial_args.worker
+    final_args['watch'] = initial_args.watch
 
     return final_args
 
@@ -21,6 +26,9 @@ def parse_initial_args():
     """
     parser = argparse.ArgumentParser(description="Initial argument parser")
     parser.add_argument('-pp', '--project_path', required=True, help="Путь для загрузки конфигурационных файлов")
+    parser.add_argument('--resume', default='', help="Папка логов прерванного запуска: выполняются только незавершённые и упавшие команды")
+    parser.add_argument('--worker', action='store_true', help="Запустить рабочий процесс, выполняющий задачи из очереди (executor: queue)")
+    parser.add_argument('--watch', action='store_true', help="Наблюдать за папкой входных данных и обрабатывать новые образцы по мере поступления")
     
     # Используем parse_known_args, чтобы собрать только --project_path и передать остальные аргументы позже
     args, remaining_args = parser.parse_known_args()
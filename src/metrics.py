@@ -0,0 +1,207 @@
+import bisect
+import itertools
+import os
+import threading
+from src.history import RunHistory
+from src.utils import RUNNING_PROCESSES, RUNNING_PROCESSES_LOCK
+
+
+class RunMetrics:
+    """
+    Метрики выполнения пайплайна: количество выполняющихся, ожидающих и завершённых команд, ошибки, повторные запуски \
+        и процентили длительности команд по модулям.
+    Метрики добавляются в файл состояния (status.json) и, если задан textfile, выводятся в формате Prometheus \
+        для textfile collector node_exporter. Файлы перезаписываются атомарно при обновлении оценки времени \
+        (см. EtaTracker.write_status) и периодически (раз в interval секунд), чтобы отражать долго выполняющиеся команды.
+    """
+    def __init__(self, textfile:str='', interval:float=15, labels:dict=None):
+        """
+        :param textfile: Путь к файлу метрик Prometheus (*.prom); пустая строка - только status.json.
+        :param interval: Интервал периодического обновления файлов, в секундах (0 - только по событиям).
+        :param labels: Метки, добавляемые ко всем метрикам (например, папка результатов).
+        """
+        self.textfile = textfile
+        self.interval = interval
+        self.labels = labels or {}
+        # {модуль: {'cmd_data', 'finished', 'failed', 'retries', 'durations' (по возрастанию), 'duration_sum', ...}}
+        self.modules = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def module(self, module:str) -> dict:
+        return self.modules.setdefault(module, {'cmd_data': {}, 'batch_counted': 0, 'batch_cmds': 0, 'finished': 0,
+                                                'failed': 0, 'retries': 0, 'durations': [], 'duration_sum': 0})
+
+    def track(self, module:str, cmd_data:dict):
+        """
+        Регистрирует команды модуля; команды, ещё не получившие результата, считаются ожидающими.
+        В потоковом режиме cmd_data пополняется по мере поступления образцов.
+        """
+        with self.lock:
+            self.module(module).update({'cmd_data': cmd_data, 'batch_counted': 0, 'batch_cmds': 0})
+
+    def record_unit(self, module:str, unit_result:dict):
+        """
+        Учитывает результаты команд стадии либо образца. Длительность учитывается только для выполнявшихся команд \
+            (не взятых из кэша и не пропущенных при возобновлении).
+        """
+        with self.lock:
+            data = self.module(module)
+            for log in unit_result['log'].values():
+                data['finished'] += 1
+                if log.get('status') == 'FAIL':
+                    data['failed'] += 1
+                if RunHistory.is_measured(log):
+                    bisect.insort(data['durations'], log['duration_sec'])
+                    data['duration_sum'] += log['duration_sec']
+
+    def record_retry(self, module:str, count:int=1):
+        """
+        Учитывает повторно запущенные наборы команд (например, задачи очереди, возвращённые после отказа рабочего).
+        """
+        with self.lock:
+            self.module(module)['retries'] += count
+
+    @staticmethod
+    def planned(data:dict) -> int:
+        """
+        Количество команд модуля: стадии хранят команды, стадия batch - наборы команд образцов.
+        Образцы стадии batch только добавляются, поэтому пересчитываются лишь новые наборы команд.
+        """
+        batch = data['cmd_data'].get('batch', {})
+        if len(batch) != data['batch_counted']:
+            data['batch_cmds'] += sum(len(cmds) for cmds in itertools.islice(list(batch.values()), data['batch_counted'], None))
+            data['batch_counted'] = len(batch)
+        return data['batch_cmds'] + sum(len(cmds) for stage, cmds in list(data['cmd_data'].items()) if stage != 'batch')
+
+    @staticmethod
+    def percentile(values:list, q:float):
+        """
+        Процентиль отсортированного списка (ближайший ранг) либо None.
+        """
+        if not values:
+            return None
+        return values[min(len(values) - 1, max(0, int(q * len(values) + 0.5) - 1))]
+
+    def status(self) -> dict:
+        """
+        Метрики в машиночитаемом виде.
+        Выполняющиеся команды - процессы, запущенные пайплайном на этой машине (команды рабочих очереди и заданий \
+            SLURM выполняются вне процесса пайплайна и считаются ожидающими до получения результата).
+        """
+        with RUNNING_PROCESSES_LOCK:
+            running = len(RUNNING_PROCESSES)
+        modules = {}
+        with self.lock:
+            for module, data in self.modules.items():
+                durations = data['durations']
+                modules[module] = {'commands_finished': data['finished'], 'commands_failed': data['failed'],
+                                   'commands_pending': max(0, self.planned(data) - data['finished']),
+                                   'retries': data['retries'], 'duration_count': len(durations),
+                                   'duration_sum_sec': round(data['duration_sum'], 3),
+                                   'duration_p50_sec': self.percentile(durations, 0.5),
+                                   'duration_p95_sec': self.percentile(durations, 0.95)}
+        pending = sum(data['commands_pending'] for data in modules.values())
+        commands = {'running': running, 'queued': max(0, pending - running),
+                    'finished': sum(data['commands_finished'] for data in modules.values()),
+                    'failed': sum(data['commands_failed'] for data in modules.values()),
+                    'retries': sum(data['retries'] for data in modules.values())}
+        return {'commands': commands, 'modules': modules}
+
+    def render(self, status:dict) -> str:
+        """
+        Формирует текст метрик Prometheus по файлу состояния (см. EtaTracker.status).
+        """
+        def labels(**extra) -> str:
+            items = {**self.labels, **extra}
+            if not items:
+                return ''
+            escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in items.values())
+            return '{' + ','.join(f'{key}="{value}"' for key, value in zip(items, escaped)) + '}'
+
+        lines = []
+        def metric(name:str, kind:str, help:str, samples:list):
+            lines.extend([f'# HELP {name} {help}', f'# TYPE {name} {kind}'])
+            lines.extend(f'{name}{labels(**extra)} {value}' for extra, value in samples if value is not None)
+
+        metrics = status.get('metrics', {})
+        commands = metrics.get('commands', {})
+        modules = status.get('modules', {})
+        module_metrics = metrics.get('modules', {})
+        metric('pipeline_commands_running', 'gauge', 'Commands currently running on this host.',
+               [({}, commands.get('running', 0))])
+        metric('pipeline_commands_queued', 'gauge', 'Commands waiting to run.', [({}, commands.get('queued', 0))])
+        metric('pipeline_commands_finished_total', 'counter', 'Commands finished in this run.',
+               [({'module': module}, data['commands_finished']) for module, data in module_metrics.items()])
+        metric('pipeline_commands_failed_total', 'counter', 'Commands that finished with an error.',
+               [({'module': module}, data['commands_failed']) for module, data in module_metrics.items()])
+        metric('pipeline_retries_total', 'counter', 'Command sets started again after a worker failure.',
+               [({'module': module}, data['retries']) for module, data in module_metrics.items()])
+        metric('pipeline_command_duration_seconds', 'summary', 'Command duration quantiles.',
+               [({'module': module, 'quantile': q}, data[key]) for module, data in module_metrics.items()
+                for q, key in [('0.5', 'duration_p50_sec'), ('0.95', 'duration_p95_sec')]])
+        lines.extend(f'pipeline_command_duration_seconds_{suffix}{labels(module=module)} {data[key]}'
+                     for module, data in module_metrics.items()
+                     for suffix, key in [('sum', 'duration_sum_sec'), ('count', 'duration_count')])
+        metric('pipeline_module_samples_done', 'gauge', 'Samples processed by the module.',
+               [({'module': module}, data['done']) for module, data in modules.items()])
+        metric('pipeline_module_samples_total', 'gauge', 'Samples known to the module.',
+               [({'module': module}, data['total']) for module, data in modules.items()])
+        metric('pipeline_module_throughput_samples_per_hour', 'gauge', 'Samples processed per hour of module run time.',
+               [({'module': module}, data.get('throughput_samples_per_hour')) for module, data in modules.items()])
+        metric('pipeline_module_eta_seconds', 'gauge', 'Estimated time to module completion.',
+               [({'module': module}, data['eta_sec']) for module, data in modules.items()])
+        pipeline = status.get('pipeline', {})
+        metric('pipeline_eta_seconds', 'gauge', 'Estimated time to pipeline completion.',
+               [({'bound': 'estimate'}, pipeline.get('eta_sec')), ({'bound': 'low'}, pipeline.get('low_sec')),
+                ({'bound': 'high'}, pipeline.get('high_sec'))])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, status:dict):
+        """
+        Атомарно перезаписывает файл метрик Prometheus (node_exporter не должен прочитать файл частично).
+        """
+        if not self.textfile:
+            return
+        tmp_path = f'{self.textfile}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'w') as file:
+                file.write(self.render(status))
+            os.replace(tmp_path, self.textfile)
+        except OSError as e:
+            print(f'Не удалось записать метрики {self.textfile}: {e}')
+
+    def start(self, refresh):
+        """
+        Запускает периодическое обновление файлов.
+
+        :param refresh: Функция, перезаписывающая файл состояния и метрики (EtaTracker.write_status).
+        """
+        if not self.interval or self.thread:
+            return
+        def run():
+            while not self.stop_event.wait(self.interval):
+                refresh()
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+
+def create_run_metrics(machine_data:dict, output_dir:str) -> RunMetrics:
+    """
+    Создаёт метрики по настройкам машины (ключ metrics: textfile - путь к файлу *.prom либо папка textfile collector, \
+        в которой создаётся файл pipeline_<имя папки результатов>.prom; interval - интервал обновления).
+    """
+    options = machine_data.get('metrics') or {}
+    textfile = options.get('textfile', '')
+    if textfile and os.path.isdir(textfile):
+        name = os.path.basename(os.path.normpath(output_dir)) or 'output'
+        textfile = os.path.join(textfile, f'pipeline_{name}.prom')
+    return RunMetrics(textfile=textfile, interval=float(options.get('interval', 15)),
+                      labels={'output_dir': os.path.normpath(output_dir)})
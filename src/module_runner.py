@@ -1,6 +1,12 @@
-from src.utils import generate_sample_list, generate_cmd_data, save_yaml, get_paths, create_paths
+from src.utils import (generate_sample_list, generate_cmd_data, save_yaml, get_paths, create_paths, parse_size, get_input_size,
+                       generate_sample_filenames)
+from src.templates import compile_filenames
+from src.temp_files import temp_paths
 from src.pipeline_manager import PipelineManager
 from src.command_executor import CommandExecutor
+from src.scheduler import ResourcePool, create_disk_admission
+from src.result_cache import ResultCache
+from src.staging import staging_options
 import os
 
 class ModuleRunner:
@@ -13,6 +19,8 @@ class ModuleRunner:
         self.folders: dict
         self.log_dir:str
         self.log_space:dict
+        self.log_sink:object
+        self.checkpoint:object
         self.module_before: str
         self.modules: list
         self.modules_template: dict
@@ -22,11 +30,25 @@ class ModuleRunner:
         self.filenames: dict
         self.commands: dict
         self.cmd_data: dict
+        self.max_parallel_samples: int
+        self.depends_on: dict
+        self.shards: dict
+        self.staging: dict
+        self.disk_footprint: object
+        self.temp: list
+        self.temp_after_batch: bool
+        self.temp_files: object
+        self.sample_order: str
+        self.history: object
+        self.eta: object
+        self.metrics: object
+        self.batch_backend: object
+        self.discovery: object
+        self.plan_cache: object
         self.__dict__= pipeline_manager.__dict__
 
     def run_module(self, module:str, module_result_dict:dict) -> dict:
-        self.timeout_behavior=''
-        self.proc_debug=''
+        self.reset_module_options()
         # Цвета!
         BLUE = "\033[34m"
         WHITE ="\033[37m"
@@ -41,11 +63,36 @@ class ModuleRunner:
 
         # Получаем список образцов
         self.samples = generate_sample_list(in_samples=self.include_samples, ex_samples=self.exclude_samples,
-                                            input_dir=self.input_dir, extensions=self.source_extensions, subfolders=self.subfolders)
-        # Генеририруем команды
-        self.cmd_data = generate_cmd_data(args=self.__dict__, folders=self.folders,
-                                    executables=self.executables, filenames=self.filenames,
-                                    cmds_dict=self.commands, commands=self.cmds_template, samples=self.samples)
+                                            input_dir=self.input_dir, extensions=self.source_extensions, subfolders=self.subfolders,
+                                            index=self.discovery)
+        # Генеририруем команды либо берём их из кэша, если от прошлого запуска не изменилось ничего, от чего они зависят
+        staging = self.module_staging(module)
+        plan_key = self.plan_key(module) if self.plan_cache and not staging else None
+        cached = self.plan_cache.load(name=f'cmd_data_{module}', key=plan_key) if plan_key else None
+        # Запись устарела, если изменились файлы, прочитанные при генерации команд (например, regions_file)
+        if cached and self.plan_cache.files_digests(cached[3]) == cached[3]:
+            self.cmd_data, sources, part_filenames, _ = cached
+        else:
+            sources = {}
+            # Файлы частей образцов нужны, только чтобы удалять временные файлы частей
+            part_filenames = {} if self.temp else None
+            read_files = set()
+            self.cmd_data = generate_cmd_data(args=self.__dict__, folders=self.folders,
+                                        executables=self.executables, filenames=self.filenames,
+                                        cmds_dict=self.commands, commands=self.cmds_template, samples=self.samples,
+                                        depends_on=self.depends_on, sources=sources, shards=self.shards,
+                                        staging=staging, read_files=read_files, part_filenames=part_filenames,
+                                        shards_folder=self.shards_folder(module))
+            if plan_key:
+                self.plan_cache.store(name=f'cmd_data_{module}', key=plan_key,
+                                      value=(self.cmd_data, sources, part_filenames,
+                                             self.plan_cache.files_digests(read_files)))
+        self.register_temp_files(module)
+        if self.temp_files.tracks(module):
+            self.temp_files.add_samples(module=module, samples=self.sample_temp_files(sources, part_filenames or {}))
+        # Размеры входных данных образцов: по ним (и по истории предыдущих запусков) определяется порядок обработки
+        sample_sizes = {sample: get_input_size(path) for sample, path in sources.items()}
+        self.cmd_data['batch'] = self.order_batch(module=module, batch=self.cmd_data['batch'], sample_sizes=sample_sizes)
         # Логгируем сгенерированные команды для модуля
         save_yaml(f'cmd_data_{module}', self.log_dir, self.cmd_data)
 
@@ -69,13 +116,154 @@ class ModuleRunner:
         # Создаём пути
         create_paths(list(self.folders.values()))
         # Инициализируем CommandExecutor
-        exe = CommandExecutor(cmd_data=c, log_space=self.log_space, module=module, debug=self.proc_debug)
+        exe = self.create_executor(module=module, cmd_data=c, sample_sizes=sample_sizes)
 
         # Выполняем команды для каждого образца
         print(f'Module: {BLUE}{module}{WHITE}')
-        module_result_dict = exe.execute(c.keys(), module_result_dict, timeout_behavior=self.timeout_behavior)
+        self.eta.start_module(module=module, sample_sizes={sample: sample_sizes.get(sample, 0) for sample in c['batch']},
+                              concurrency=int(self.max_parallel_samples))
+        module_result_dict = exe.execute(c.keys(), module_result_dict, timeout_behavior=self.timeout_behavior,
+                                         max_parallel_samples=int(self.max_parallel_samples),
+                                         resources=self.create_resource_pool())
+        exe.commit_module(module_result_dict)
+        self.eta.finish_module(module)
         
         return module_result_dict
+
+
+    def reset_module_options(self):
+        """
+        Устанавливает настройки выполнения модуля по умолчанию (значения машины); шаблон модуля может их переопределить.
+        """
+        machine_data = self.machines_template[self.machine]
+        self.timeout_behavior=''
+        self.proc_debug=''
+        # Количество параллельно обрабатываемых образцов: значение машины, которое может быть переопределено в шаблоне модуля.
+        # Если для машины заданы лимиты потоков, по умолчанию число образцов ограничивается только ресурсами
+        self.max_parallel_samples = machine_data.get('max_parallel_samples', machine_data.get('max_threads', 1))
+        # Кэш результатов команд: False, True (размер и время изменения входных файлов) либо 'hash' (хэш содержимого)
+        self.cache = machine_data.get('cache', False)
+        # Порядок обработки образцов: 'cost' - сначала самые долгие (по истории и размеру входных данных), \
+        # 'discovery' - в порядке обнаружения файлов
+        self.sample_order = machine_data.get('sample_order', 'cost')
+        # Зависимости команд модуля {название: [команды]}, переопределяющие depends_on из cmds_template
+        self.depends_on = {}
+        # Разбиение образцов на части для параллельной обработки (scatter-gather, см. generate_sharded_cmds)
+        self.shards = None
+        # Размещение образцов на локальном диске узла: staging модуля используется, если для машины задан scratch
+        self.staging = None
+        # Объём данных, записываемых образцом в папку результатов: объём ('50G') либо кратность размера входных данных \
+        #   ('3x'); учитывается при допуске образцов, если для машины задан ключ disk (см. DiskAdmission)
+        self.disk_footprint = None
+        # Ключи filenames временных файлов, удаляемых, как только они больше не нужны (см. src.temp_files)
+        self.temp = []
+        # Временные файлы нужны командам after_batch модуля: удаляются после их успешного выполнения
+        self.temp_after_batch = True
+
+
+    def shards_folder(self, module:str) -> str:
+        """
+        Папка входных файлов частей образцов модуля: у каждого модуля своя, поэтому части одноимённых образцов \
+            разных модулей не перезаписывают друг друга.
+        """
+        return os.path.join(self.output_dir, 'shards', module)
+
+
+    def plan_key(self, module:str) -> str:
+        """
+        Ключ кэша команд модуля: шаблоны, машина, папки, аргументы командной строки и файлы образцов.
+        Модули с размещением на scratch не кэшируются: их пути включают папку запуска на scratch (см. src.staging).
+        Файлы, прочитанные при генерации команд (regions_file), проверяются по хэшам, сохранённым вместе с записью.
+        """
+        return self.plan_cache.digest(
+            module, self.machines_template[self.machine], self.modules_template[module], self.cmds_template,
+            self.folders, self.executables, self.input_dir, self.output_dir, self.shards, self.depends_on,
+            {key: value for key, value in self.cli_args.items() if key != 'resume'},
+            self.plan_cache.samples_digest(self.samples))
+
+
+    def module_staging(self, module:str) -> dict:
+        """
+        Настройки размещения образцов модуля на scratch (см. src.staging.staging_options).
+        """
+        return staging_options(scratch=self.machines_template[self.machine].get('scratch'), staging=self.staging,
+                               run=self.log_dir, module=module)
+
+
+    def register_temp_files(self, module:str):
+        """
+        Регистрирует временные файлы модуля вместе со следующими модулями запуска, которые получают образцы \
+            из его result_dir (временные файлы в этой папке удаляются после их обработки).
+        """
+        if not self.temp:
+            return
+        folder = os.path.join(self.output_dir, self.modules_template[module]['result_dir'])
+        consumers = [(consumer, folder, self.modules_template[consumer]['source_extensions']) for consumer in self.modules
+                     if self.modules_template[consumer].get('module_before') == module]
+        self.temp_files.add_module(module=module, consumers=consumers,
+                                   after_batch=self.temp_after_batch and bool(self.commands['after_batch']))
+
+
+    def sample_temp_files(self, sources:dict, part_filenames:dict) -> dict:
+        """
+        Временные файлы образцов модуля: файлы образца целиком и файлы каждой его части (ключи temp, \
+            зависящие от shard, например shard["suffix"]).
+
+        :param sources: Пути к входным данным образцов {имя образца: путь}.
+        :param part_filenames: Файлы частей разбитых образцов {имя образца: [filenames частей]}.
+        :return: {имя образца: (путь, [временные файлы])}.
+        """
+        if not self.temp:
+            return {sample: (path, []) for sample, path in sources.items()}
+        filenames = compile_filenames(self.filenames)
+        temp_files = {}
+        for sample, path in sources.items():
+            sample_filenames = generate_sample_filenames(sample=path, folders=self.folders, filenames=filenames)
+            temp_files[sample] = (path, temp_paths(self.temp, [sample_filenames] + part_filenames.get(sample, [])))
+        return temp_files
+
+
+    def order_batch(self, module:str, batch:dict, sample_sizes:dict) -> dict:
+        """
+        Упорядочивает команды образцов модуля согласно sample_order.
+
+        :param batch: Команды образцов {образец: команды}.
+        :param sample_sizes: Размеры входных данных образцов {образец: байты}.
+        :return: Упорядоченный словарь команд образцов.
+        """
+        if self.sample_order != 'cost':
+            return batch
+        order = self.history.order_samples(module=module, sizes={sample: sample_sizes.get(sample, 0) for sample in batch})
+        return {sample: batch[sample] for sample in order}
+
+
+    def create_executor(self, module:str, cmd_data:dict, sample_sizes:dict=None) -> CommandExecutor:
+        """
+        Создаёт CommandExecutor для модуля с текущими настройками выполнения.
+        """
+        machine_data = self.machines_template[self.machine]
+        cache = None
+        if self.cache:
+            cache = ResultCache(cache_dir=os.path.join(self.output_dir, '.pipeline_cache'), hash_inputs=self.cache == 'hash')
+        return CommandExecutor(cmd_data=cmd_data, log_space=self.log_space, log_sink=self.log_sink, module=module,
+                               debug=self.proc_debug, capture=machine_data.get('output_capture', {}),
+                               cache=cache, checkpoint=self.checkpoint, sample_sizes=sample_sizes, eta=self.eta,
+                               backend=self.batch_backend, metrics=self.metrics,
+                               temp_files=self.temp_files if self.temp_files.tracks(module) else None,
+                               disk_footprint={'size': self.disk_footprint, 'path': self.output_dir} if self.disk_footprint else None)
+
+
+    def create_resource_pool(self) -> ResourcePool:
+        """
+        Создаёт пул ресурсов машины, в пределах которого команды разных образцов выполняются одновременно.
+        Возвращает None, если лимиты ресурсов и контроль места на дисках для машины не заданы.
+        """
+        machine_data = self.machines_template[self.machine]
+        disk = create_disk_admission(machine_data)
+        if machine_data.get('max_threads') or machine_data.get('max_memory') or disk:
+            return ResourcePool(threads=int(machine_data.get('max_threads', 0)),
+                                memory=parse_size(machine_data.get('max_memory', 0)), disk=disk)
+        return None
         
 
     def load_module(self, data:dict, input_dir:str, output_dir:str):
@@ -83,6 +271,8 @@ class ModuleRunner:
         Загружает данные о модуле, обрабатывает их с использованием переменных в пространстве класса и\
                 добавляет их в пространство объекта класса.
         """
+        # Работаем с копией, чтобы шаблон модуля можно было загружать повторно
+        data = dict(data)
         # Составляем полные пути для папок
         data['folders'] = get_paths(folders=data['folders'], input_dir=input_dir, output_dir=output_dir)
         # Устанавливаем атрибут modules_data в пространство экземпляра класса
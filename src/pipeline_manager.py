@@ -1,4 +1,14 @@
-from src.utils import load_templates, create_paths, save_yaml
+from src.utils import load_templates, create_paths, save_yaml, format_size, INTERRUPT_EVENT
+from src.log_sink import create_log_sink, export_yaml
+from src.checkpoint import Checkpoint
+from src.history import RunHistory
+from src.eta import EtaTracker
+from src.metrics import create_run_metrics
+from src.backends import create_batch_backend
+from src.discovery import create_discovery_index
+from src.watch import create_input_watcher
+from src.plan_cache import PlanCache
+from src.temp_files import TempFiles
 import os
 from datetime import date
 
@@ -26,10 +36,19 @@ class PipelineManager:
         self.executables: dict
         self.debug:list
         self.subfolders:bool
+        self.resume:str
+        self.watch:bool
+        self.cli_args:dict
         
+        # Папка логов прерванного запуска, который нужно возобновить
+        self.resume = ''
+        # Режим наблюдения за папкой входных данных (--watch)
+        self.watch = False
         # Добавляем все элементы args как атрибуты класса
         for key, value in args.items():
             setattr(self, key, value)
+        # Аргументы запуска в исходном виде (входят в ключ кэша команд модулей)
+        self.cli_args = dict(args)
         # Получаем данные о запуске
         #self.current_dir = os.getcwd()
         self.today = date.today().strftime('%d.%m.%Y')
@@ -41,8 +60,12 @@ class PipelineManager:
         self.config_path = f'{self.project_path}/config/'
         # Загружаем данные конфигов
         #Загружаем указанные конфиги
-        templates = ['machines_template', 'modules_template', 'cmds_template']
-        loaded_templates = load_templates(self.config_path, templates)
+        # Конфиг машин загружается первым: от настроек машины зависит, используется ли кэш (plan_cache)
+        loaded_templates = load_templates(self.config_path, ['machines_template'])
+        machine_data = loaded_templates['machines_template'].get(self.machine) or {}
+        # Разобранные шаблоны модулей и команд берутся из кэша (plan_cache: true), пока содержимое файлов не изменилось
+        cache = PlanCache(self.plan_cache_dir()) if machine_data.get('plan_cache', False) else None
+        loaded_templates.update(load_templates(self.config_path, ['modules_template', 'cmds_template'], cache=cache))
         # Добавляем загруженные конфиги в атрибуты класса
         for template,data in loaded_templates.items():
             setattr(self, template, data)
@@ -56,12 +79,21 @@ class PipelineManager:
         save_yaml('init_configs', self.log_dir, self.init_configs)
 
 
+    def plan_cache_dir(self) -> str:
+        return os.path.join(self.output_dir, '.pipeline_plan_cache')
+
+
     def set_logs(self):
         """
         Инициализирует директории для логов и сохраняет пути к файлам логов в атрибуты класса.
         """
-        # Устанавливаем директорию для логов
-        self.log_dir = os.path.join(self.output_dir, 'Logs/', f'{self.today}_{"-".join(self.modules)}/')
+        # Устанавливаем директорию для логов. При возобновлении запуска продолжаем писать логи в его папку
+        if self.resume:
+            self.log_dir = os.path.join(self.resume, '')
+            if not os.path.isdir(self.log_dir):
+                raise FileNotFoundError(f"Папка логов возобновляемого запуска не найдена: {self.log_dir}")
+        else:
+            self.log_dir = os.path.join(self.output_dir, 'Logs/', f'{self.today}_{"-".join(self.modules)}/')
         # Создаём директорию логов
         create_paths([self.log_dir])
         
@@ -70,6 +102,9 @@ class PipelineManager:
         self.stderr_log = os.path.join(self.log_dir, 'stderr_log.txt')
         self.log_data = os.path.join(self.log_dir, 'log.yaml')
         self.status_log = os.path.join(self.log_dir, 'status_log.yaml')
+        self.log_records = os.path.join(self.log_dir, 'log_records.jsonl')
+        self.checkpoint_log = os.path.join(self.log_dir, 'checkpoint.jsonl')
+        self.status_file = os.path.join(self.log_dir, 'status.json')
         
         # Создаём словарь с путями к файлам логов
         self.log_space = {
@@ -77,7 +112,10 @@ class PipelineManager:
             'stdout_log': self.stdout_log,
             'stderr_log': self.stderr_log,
             'log_data': self.log_data,
-            'status_log': self.status_log
+            'status_log': self.status_log,
+            'log_records': self.log_records,
+            'checkpoint_log': self.checkpoint_log,
+            'status_file': self.status_file
         }
 
 
@@ -118,59 +156,153 @@ class PipelineManager:
         self.executables = executables
 
 
+    def get_module_chains(self, stream:bool=False, barriers:bool=True) -> list:
+        """
+        Разбивает запускаемые модули на цепочки для потокового выполнения.
+        Модуль присоединяется к цепочке, если его module_before - предыдущий модуль и для него не указан stream_barrier.
+
+        :param stream: Потоковый режим включён; иначе каждый модуль образует отдельную цепочку.
+        :param barriers: Учитывать stream_barrier (в режиме наблюдения образцы поступают непрерывно, и барьер не был бы пройден).
+        :return: Список цепочек (списков модулей) в порядке sequence.
+        """
+        chains = []
+        for module in self.modules_template['sequence']:
+            if module not in self.modules:
+                continue
+            data = self.modules_template[module]
+            if stream and chains and data.get('module_before') == chains[-1][-1] and not (barriers and data.get('stream_barrier', False)):
+                chains[-1].append(module)
+            else:
+                chains.append([module])
+        return chains
+
+
     def run_pipeline(self):
         """
         Запуск всего пайплайна по модулям.
         """
         from src.module_runner import ModuleRunner
-        # Инициализируем ModuleRunner с текущим экземпляром PipelineManager
-        module_runner = ModuleRunner(self)
+        from src.stream_runner import StreamRunner
+        machine_data = self.machines_template[self.machine]
+        # Журнал выполнения команд (по умолчанию - дописываемый файл JSON Lines)
+        self.log_sink = create_log_sink(backend=machine_data.get('log_backend', 'jsonl'), log_space=self.log_space)
+        # Временные файлы образцов, удаляемые, как только они больше не нужны
+        self.temp_files = TempFiles(log_sink=self.log_sink)
+        # Журнал контрольных точек; при возобновлении из него загружаются уже выполненные команды
+        self.checkpoint = Checkpoint(file_path=self.checkpoint_log, resume=bool(self.resume))
+        # Исполнитель стадии batch: 'local' - на этой машине в пуле потоков, 'async' - на этой машине в цикле событий asyncio, \
+        #   'queue' - рабочими процессами через очередь в общей папке, 'slurm' - заданиями планировщика SLURM
+        executor = machine_data.get('executor', 'local')
+        self.batch_backend = create_batch_backend(machine_data=machine_data, output_dir=self.output_dir, log_dir=self.log_dir)
+        if self.batch_backend:
+            self.batch_backend.open()
+        self.metrics = None
+        self.eta = None
+        try:
+            # Кэш сгенерированных команд модулей (plan_cache: true): при неизменных шаблонах, образцах и аргументах \
+            #   команды не генерируются заново
+            self.plan_cache = PlanCache(self.plan_cache_dir()) if machine_data.get('plan_cache', False) else None
+            # Индекс содержимого папок входных данных, сохраняемый между запусками
+            self.discovery = create_discovery_index(machine_data=machine_data, output_dir=self.output_dir)
+            # История предыдущих запусков: по ней оценивается длительность обработки образцов
+            self.history = RunHistory(logs_dir=os.path.join(self.output_dir, 'Logs'), max_runs=machine_data.get('history_runs', 10))
+            # Инициализируем ModuleRunner с текущим экземпляром PipelineManager
+            module_runner = ModuleRunner(self)
 
-        result_dict = {'status':True, 'modules':{}}
+            result_dict = {'status':True, 'modules':{}}
 
-        # Проходим по каждому модулю, указанному в аргументах
-        if self.modules == 'all':
-            self.modules = self.modules_template['sequence']
-        for module in self.modules_template['sequence']:
-            if module in self.modules:
-                print(f'Запуск модуля: {module}')
+            # Проходим по каждому модулю, указанному в аргументах
+            if self.modules == 'all':
+                self.modules = self.modules_template['sequence']
+            # Метрики выполнения команд (status.json и, если задан metrics.textfile, файл метрик Prometheus)
+            self.metrics = create_run_metrics(machine_data=machine_data, output_dir=self.output_dir)
+            # Оценка времени выполнения модулей и пайплайна (выводится в консоль и в status.json)
+            self.eta = EtaTracker(history=self.history, status_file=self.status_file, metrics=self.metrics,
+                                  modules=[module for module in self.modules_template['sequence'] if module in self.modules])
+            self.metrics.start(refresh=self.eta.write_status)
+            # Потоковое выполнение цепочек модулей доступно только при локальном исполнителе
+            stream = machine_data.get('stream_modules', False) and not self.debug and executor == 'local'
+            # В режиме наблюдения модули образуют одну потоковую цепочку, первый модуль которой получает новые образцы
+            chains = self.get_module_chains(stream=stream or self.watch, barriers=not self.watch)
+            if self.watch and (len(chains) != 1 or executor != 'local'):
+                print('Режим --watch требует локального исполнителя и модулей, образующих одну цепочку (module_before)')
+                exit(code=1)
+            # Обработанные входные файлы сохраняются между перезапусками наблюдения (по первому модулю цепочки)
+            watcher = create_input_watcher(machine_data=machine_data, log_dir=self.log_dir,
+                                           state_path=os.path.join(self.output_dir, f'.pipeline_watch_{chains[0][0]}.jsonl')) \
+                if self.watch else None
+            for chain in chains:
+                if len(chain) > 1 or watcher:
+                    # Цепочка зависимых модулей выполняется потоково: образец переходит в следующий модуль сразу после предыдущего
+                    stream_runner = StreamRunner(self)
+                    result_dict = stream_runner.run_chain(chain, result_dict, watcher=watcher)
+                else:
+                    module = chain[0]
+                    print(f'Запуск модуля: {module}')
 
-                result_dict['modules'][module] = {'status': True, 'before_batch':{}, 'batch':{}, 'after_batch':{}}
+                    result_dict['modules'][module] = {'status': True, 'before_batch':{}, 'batch':{}, 'after_batch':{}}
 
-                # Запускаем модуль через ModuleRunner
-                result_dict['modules'][module] = module_runner.run_module(module, result_dict['modules'][module])
+                    # Запускаем модуль через ModuleRunner
+                    result_dict['modules'][module] = module_runner.run_module(module, result_dict['modules'][module])
                 
-                # Если хотя бы один модуль завершился с ошибкой, обновляем статус пайплайна
-                if not result_dict['modules'][module]['status']:
+                    # Если хотя бы один модуль завершился с ошибкой, обновляем статус пайплайна
+                    if not result_dict['modules'][module]['status']:
+                        result_dict['status'] = False
+                # После прерывания следующие модули не запускаем
+                if INTERRUPT_EVENT.is_set():
                     result_dict['status'] = False
+                    print(f"Пайплайн прерван. Для продолжения запустите его с параметром --resume {self.log_dir}")
+                    break
 
-        if result_dict['status']:
-            print("Пайплайн завершён успешно.")
-        else:
-            print("Пайплайн завершён с ошибками!")
-            '''failed_programms = {}
-            for module, module_data in result_dict['modules'].items():
-                if not module_data['status']:
-                    failed_programms[module]={}
-                    if isinstance(module_data, dict):
-                        for stage, stage_data in module_data.items():
-                            if not stage_data['status']:
-                                failed_programms[module][stage] = {}
-                                if isinstance(stage_data, dict):
-                                    if stage !='batch':
-                                        for program, code in stage_data['programms'].items():
-                                            if code != 0:
+            if result_dict['status']:
+                print("Пайплайн завершён успешно.")
+            else:
+                print("Пайплайн завершён с ошибками!")
+                '''failed_programms = {}
+                for module, module_data in result_dict['modules'].items():
+                    if not module_data['status']:
+                        failed_programms[module]={}
+                        if isinstance(module_data, dict):
+                            for stage, stage_data in module_data.items():
+                                if not stage_data['status']:
+                                    failed_programms[module][stage] = {}
+                                    if isinstance(stage_data, dict):
+                                        if stage !='batch':
+                                            for program, code in stage_data['programms'].items():
+                                                if code != 0:
                                             
 
 
 
-                if not module_data['status']:
-                    print(f'Модуль: {module}')
-                    for sample, sample_data in result_dict['modules'][module][module_data].items():
-                        if not sample_data['status']:
-                            print(f'\t{sample}')
-                            for programm, exit_code in sample_data.items():
-                                print(f'\t\t{programm}: exit code {exit_code}')'''
-        if 'all' in self.debug:
-            print(result_dict)
-        save_yaml(filename='status_log', data=result_dict, path=self.log_dir)
\ No newline at end of file
+                    if not module_data['status']:
+                        print(f'Модуль: {module}')
+                        for sample, sample_data in result_dict['modules'][module][module_data].items():
+                            if not sample_data['status']:
+                                print(f'\t{sample}')
+                                for programm, exit_code in sample_data.items():
+                                    print(f'\t\t{programm}: exit code {exit_code}')'''
+            if self.temp_files.freed_bytes:
+                print(f"Временные файлы удалены, освобождено {format_size(self.temp_files.freed_bytes)}")
+            if 'all' in self.debug:
+                print(result_dict)
+            save_yaml(filename='status_log', data=result_dict, path=self.log_dir)
+        finally:
+            # Журналы закрываются и экспортируются и при ошибке: по ним разбирается сбой
+            self.close_logs(machine_data)
+
+
+    def close_logs(self, machine_data:dict):
+        """
+        Останавливает обновление метрик, закрывает журналы и исполнителя batch, формирует логи в прежнем YAML-формате.
+        """
+        if self.metrics:
+            self.metrics.stop()
+        if self.eta:
+            self.eta.write_status()
+        self.log_sink.close()
+        self.checkpoint.close()
+        if self.batch_backend:
+            self.batch_backend.close()
+        # Однократно формируем логи в прежнем YAML-формате для тех, кто читает эти файлы
+        if machine_data.get('log_backend', 'jsonl') == 'jsonl' and machine_data.get('export_yaml_logs', True):
+            export_yaml(self.log_space)
\ No newline at end of file
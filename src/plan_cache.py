@@ -0,0 +1,105 @@
+import hashlib
+import json
+import marshal
+import os
+import threading
+
+
+class PlanCache:
+    """
+    Кэш подготовленных данных запуска в двоичном виде (marshal): разобранных шаблонов и сгенерированных команд модулей.
+    marshal, в отличие от pickle, восстанавливает только встроенные типы данных и не выполняет код при загрузке, \
+        поэтому подменённый файл в папке результатов не может выполнить код в процессе пайплайна.
+    Каждая запись хранится отдельным файлом вместе с ключом - хэшем всего, от чего она зависит; \
+        запись с другим ключом считается отсутствующей и перезаписывается.
+    """
+    def __init__(self, cache_dir:str):
+        """
+        :param cache_dir: Папка кэша.
+        """
+        self.cache_dir = cache_dir
+
+    def path(self, name:str) -> str:
+        return os.path.join(self.cache_dir, f'{name}.marshal')
+
+    def load(self, name:str, key:str):
+        """
+        Возвращает сохранённое значение, если его ключ совпадает с key, иначе None.
+        """
+        try:
+            with open(self.path(name), 'rb') as file:
+                data = marshal.load(file)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(data, dict) or data.get('key') != key:
+            return None
+        return data['value']
+
+    def store(self, name:str, key:str, value):
+        """
+        Сохраняет значение атомарно (через временный файл); ошибки записи не прерывают запуск.
+        Значения с типами, которые marshal не поддерживает (например, даты в шаблонах), не кэшируются.
+        """
+        try:
+            data = marshal.dumps({'key': key, 'value': value})
+        except ValueError:
+            return
+        tmp_path = f'{self.path(name)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, self.path(name))
+        except OSError as e:
+            print(f'Не удалось сохранить кэш {name}: {e}')
+
+    @staticmethod
+    def digest(*parts) -> str:
+        """
+        Хэш значений, сериализуемых в JSON (ключи словарей сортируются, прочие объекты приводятся к строке).
+        """
+        data = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    @staticmethod
+    def file_digest(paths:list) -> str:
+        """
+        Хэш содержимого файлов.
+        """
+        hasher = hashlib.sha256()
+        for path in paths:
+            with open(path, 'rb') as file:
+                hasher.update(path.encode())
+                hasher.update(hashlib.sha256(file.read()).digest())
+        return hasher.hexdigest()
+
+    @staticmethod
+    def files_digests(paths) -> dict:
+        """
+        Хэши содержимого файлов, прочитанных при генерации команд (например, regions_file разбиения образцов): \
+            {путь: хэш либо None, если файла нет}. Пути становятся известны только при генерации, поэтому хэши \
+            хранятся вместе с записью и проверяются при загрузке (см. ModuleRunner.plan_module).
+        """
+        digests = {}
+        for path in sorted(paths):
+            try:
+                with open(path, 'rb') as file:
+                    digests[path] = hashlib.sha256(file.read()).hexdigest()
+            except OSError:
+                digests[path] = None
+        return digests
+
+    @staticmethod
+    def samples_digest(samples:list) -> str:
+        """
+        Хэш путей, размеров и времени изменения файлов образцов: команды могут зависеть от размера входных данных \
+            (например, число частей при разбиении образцов).
+        """
+        hasher = hashlib.sha256()
+        for sample in samples:
+            try:
+                stat = os.stat(sample)
+                hasher.update(f'{sample}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+            except OSError:
+                hasher.update(f'{sample}\0\n'.encode())
+        return hasher.hexdigest()
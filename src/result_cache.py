@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import threading
+from src.utils import skipped_result
+
+
+class ResultCache:
+    """
+    Кэш результатов команд, адресуемый содержимым: ключ - хэш итоговой строки команды и отпечатков её входных файлов.
+    Команда пропускается, если с тем же ключом ранее было успешное выполнение и все объявленные выходные файлы существуют.
+    Кэшируются только команды, у которых объявлены выходные файлы (outputs): иначе нельзя убедиться, что результат ещё на месте.
+    """
+    def __init__(self, cache_dir:str, hash_inputs:bool=False):
+        """
+        Инициализация кэша.
+
+        :param cache_dir: Папка для записей кэша (по одному JSON-файлу на ключ, безопасно для общей файловой системы).
+        :param hash_inputs: Использовать хэш содержимого входных файлов вместо размера и времени изменения.
+        """
+        self.cache_dir = cache_dir
+        self.hash_inputs = hash_inputs
+        # Хэши содержимого файлов, посчитанные в текущем запуске: {(путь, размер, mtime): хэш}
+        self.file_hashes = {}
+        self.lock = threading.Lock()
+
+    def key(self, cmd:str, options:dict) -> str:
+        """
+        Вычисляет ключ кэша для команды.
+
+        :return: Ключ либо None, если команда не кэшируется или какого-то входного файла нет.
+        """
+        if not options.get('outputs') or not options.get('cache', True):
+            return None
+        fingerprints = []
+        for path in options.get('inputs', []):
+            fingerprint = self.fingerprint(path)
+            if fingerprint is None:
+                return None
+            fingerprints.append([path, fingerprint])
+        data = json.dumps({'cmd': cmd, 'inputs': fingerprints}, sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def fingerprint(self, path:str):
+        """
+        Отпечаток входного файла: размер и время изменения либо хэш содержимого.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if not self.hash_inputs or os.path.isdir(path):
+            return [stat.st_size, stat.st_mtime_ns]
+        file_id = (path, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if file_id in self.file_hashes:
+                return self.file_hashes[file_id]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        with self.lock:
+            self.file_hashes[file_id] = digest.hexdigest()
+        return self.file_hashes[file_id]
+
+    def entry_path(self, key:str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def lookup(self, key:str, options:dict) -> dict:
+        """
+        Ищет успешный результат команды в кэше.
+
+        :return: Результат в формате run_command с отметкой о попадании в кэш либо None.
+        """
+        try:
+            with open(self.entry_path(key), 'r') as file:
+                entry = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if not all(os.path.exists(path) for path in options.get('outputs', [])):
+            return None
+        run_result = skipped_result(cache='HIT', cached_run=entry['log'])
+        run_result['stdout'] = entry.get('stdout', '')
+        run_result['stderr'] = entry.get('stderr', '')
+        return run_result
+
+    def store(self, key:str, cmd:str, run_result:dict):
+        """
+        Сохраняет успешный результат команды. Запись создаётся атомарно, через временный файл.
+        """
+        file_path = self.entry_path(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'cmd': cmd, 'log': run_result['log'],
+                       'stdout': run_result['stdout'], 'stderr': run_result['stderr']}, file, ensure_ascii=False)
+        os.replace(tmp_path, file_path)
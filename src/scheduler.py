@@ -0,0 +1,261 @@
+import contextvars
+import os
+import threading
+import time
+from src.utils import cmd_interrupted, format_size, parse_size, DiskSpaceError
+
+# Резерв места, занятый образцом (disk_footprint модуля), команды которого выполняются в текущем контексте: \
+#   данные команд образца входят в этот объём, поэтому на той же файловой системе он засчитывается в их запросы
+UNIT_DISK_RESERVATION = contextvars.ContextVar('unit_disk_reservation', default=None)
+
+
+class ResourcePool:
+    """
+    Пул ресурсов машины (потоки CPU и оперативная память), из которого команды разных образцов \
+        получают ресурсы перед запуском. Команда ждёт, пока на машине не освободится объявленное ею количество ресурсов.
+    """
+    # Через сколько секунд ожидания самая старая команда получает приоритет над более новыми,
+    # чтобы крупные команды не простаивали бесконечно из-за постоянно проходящих мелких
+    AGING_SEC = 60
+
+    def __init__(self, threads:int=0, memory:int=0, disk=None):
+        """
+        Инициализация пула ресурсов.
+
+        :param threads: Количество потоков CPU на машине (0 - без ограничения).
+        :param memory: Объём оперативной памяти в байтах (0 - без ограничения).
+        :param disk: Контроль места на дисках (DiskAdmission); None - без ограничения.
+        """
+        self.threads = threads
+        self.memory = memory
+        self.disk = disk
+        self.used_threads = 0
+        self.used_memory = 0
+        self.condition = threading.Condition()
+        # Очередь ожидающих команд в порядке поступления: (номер заявки, время поступления)
+        self.waiting = []
+        self.tickets = 0
+
+    def clamp(self, threads:int, memory:int) -> tuple:
+        """
+        Ограничивает запрос лимитами машины, чтобы команда, запросившая больше, чем есть на машине, \
+            выполнилась в одиночку, а не ждала вечно.
+        """
+        if self.threads:
+            threads = min(threads, self.threads)
+        if self.memory:
+            memory = min(memory, self.memory)
+        return (threads, memory)
+
+    def fits(self, threads:int, memory:int) -> bool:
+        """
+        Проверяет, помещается ли запрос в свободные ресурсы.
+        """
+        threads_ok = not self.threads or self.used_threads + threads <= self.threads
+        memory_ok = not self.memory or self.used_memory + memory <= self.memory
+        return threads_ok and memory_ok
+
+    def acquire(self, threads:int=1, memory:int=0) -> bool:
+        """
+        Ожидает освобождения ресурсов и занимает их.
+
+        :param threads: Количество потоков, необходимое команде.
+        :param memory: Объём памяти в байтах, необходимый команде.
+        :return: True, если ресурсы получены; False, если ожидание прервано остановкой пайплайна.
+        """
+        threads, memory = self.clamp(threads, memory)
+        with self.condition:
+            self.tickets += 1
+            ticket = (self.tickets, time.time())
+            self.waiting.append(ticket)
+            try:
+                while True:
+                    if cmd_interrupted():
+                        return False
+                    oldest = self.waiting[0]
+                    # Пока самая старая заявка ждёт слишком долго, остальные не обгоняют её
+                    starving = oldest != ticket and time.time() - oldest[1] > self.AGING_SEC
+                    if not starving and self.fits(threads, memory):
+                        self.used_threads += threads
+                        self.used_memory += memory
+                        return True
+                    self.condition.wait(timeout=1)
+            finally:
+                self.waiting.remove(ticket)
+
+    def release(self, threads:int=1, memory:int=0):
+        """
+        Возвращает ресурсы в пул и будит ожидающие команды.
+        """
+        threads, memory = self.clamp(threads, memory)
+        with self.condition:
+            self.used_threads -= threads
+            self.used_memory -= memory
+            self.condition.notify_all()
+
+
+class DiskAdmission:
+    """
+    Допуск образцов и команд по месту на файловых системах, в которые они пишут.
+    Образец (команда) объявляет ожидаемый объём записываемых данных и запускается, только если после этого на файловой \
+        системе останется не меньше min_free байт. Свободное место определяется statvfs, из него вычитаются объёмы, \
+        объявленные уже выполняющимися образцами и командами: их данные ещё не записаны. Резерв снимается \
+        по завершении - к этому моменту записанные данные учтены statvfs.
+    Команды с опцией io (интенсивный ввод-вывод) дополнительно ограничиваются количеством одновременно \
+        выполняющихся на одной файловой системе.
+    Ожидание места не занимает потоков и памяти пула ресурсов, поэтому выполняющиеся образцы продолжают работу.
+    Если на файловой системе ничего не зарезервировано, место может освободить только другой процесс: \
+        такое ожидание ограничено timeout, после чего образец (команда) завершается ошибкой DiskSpaceError.
+    Команды образца, зарезервировавшего свой объём (UNIT_DISK_RESERVATION), резервируют на той же файловой системе \
+        только превышение над ним, а резерв самого образца не считается местом, которое может освободиться.
+    """
+    def __init__(self, min_free:int=0, io_limit:int=0, poll:float=5, timeout:float=0):
+        """
+        :param min_free: Место, которое должно оставаться свободным на каждой файловой системе, в байтах.
+        :param io_limit: Количество одновременных команд с опцией io на файловой системе (0 - без ограничения).
+        :param poll: Интервал повторной проверки свободного места при ожидании, в секундах.
+        :param timeout: Сколько секунд ждать места, которое не освободится за счёт образцов пайплайна \
+                        (0 - сразу завершить образец либо команду ошибкой).
+        """
+        self.min_free = min_free
+        self.io_limit = io_limit
+        self.poll = poll
+        self.timeout = timeout
+        # Резервы и команды ввода-вывода по файловым системам (номер устройства)
+        self.reserved = {}
+        self.io_running = {}
+        # Свободное место по файловым системам: {устройство: (байты, время проверки)}
+        self.free = {}
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def device(path:str) -> int:
+        """
+        Файловая система пути; для ещё не созданного пути - ближайшей существующей родительской папки.
+        """
+        path = os.path.abspath(path)
+        while True:
+            try:
+                return os.stat(path).st_dev
+            except FileNotFoundError:
+                parent = os.path.dirname(path)
+                if parent == path:
+                    raise
+                path = parent
+
+    def free_space(self, device:int, path:str) -> int:
+        """
+        Свободное место файловой системы; результат statvfs используется не дольше секунды.
+        """
+        cached = self.free.get(device)
+        if cached and time.time() - cached[1] < 1:
+            return cached[0]
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        stat = os.statvfs(path)
+        free = stat.f_bavail * stat.f_frsize
+        self.free[device] = (free, time.time())
+        return free
+
+    @staticmethod
+    def own_reservation(device:int) -> int:
+        """
+        Объём, зарезервированный на файловой системе образцом, команды которого выполняются в текущем контексте.
+        """
+        reservation = UNIT_DISK_RESERVATION.get()
+        return reservation[1] if reservation and reservation[0] == device else 0
+
+    def try_acquire(self, path:str, size:int=0, io:bool=False) -> tuple:
+        """
+        Резервирует место без ожидания.
+
+        :return: Резерв (устройство, объём, io) либо None, если места (или слотов ввода-вывода) сейчас недостаточно.
+        """
+        path = os.path.abspath(path)
+        device = self.device(path)
+        size = max(0, size - self.own_reservation(device))
+        with self.condition:
+            if io and self.io_limit and self.io_running.get(device, 0) >= self.io_limit:
+                return None
+            if size and self.free_space(device, path) - self.reserved.get(device, 0) - size < self.min_free:
+                return None
+            self.reserved[device] = self.reserved.get(device, 0) + size
+            if io:
+                self.io_running[device] = self.io_running.get(device, 0) + 1
+            return (device, size, io)
+
+    def acquire(self, path:str, size:int=0, io:bool=False, label:str='') -> tuple:
+        """
+        Ожидает, пока на файловой системе пути не освободится место (слот ввода-вывода), и резервирует его.
+
+        :param label: Образец либо команда для сообщения об ожидании.
+        :return: Резерв либо None, если ожидание прервано остановкой пайплайна.
+        :raises DiskSpaceError: Место не освободилось за timeout, и на файловой системе ничего не зарезервировано.
+        """
+        reservation = self.try_acquire(path, size=size, io=io)
+        if reservation:
+            return reservation
+        waiting_since = time.time()
+        self.check_unreserved(path, size=size, label=label, waiting_since=waiting_since)
+        print(self.waiting_message(path, size=size, io=io, label=label), end='')
+        while True:
+            with self.condition:
+                # Место освобождают как завершающиеся образцы (пробуждение), так и другие процессы (опрос)
+                self.condition.wait(timeout=min(self.poll, self.timeout) if self.timeout else self.poll)
+            if cmd_interrupted():
+                return None
+            reservation = self.try_acquire(path, size=size, io=io)
+            if reservation:
+                return reservation
+            self.check_unreserved(path, size=size, label=label, waiting_since=waiting_since)
+
+    def check_unreserved(self, path:str, size:int, label:str, waiting_since:float):
+        """
+        Завершает ожидание ошибкой, если объём не помещается, на файловой системе ничего не зарезервировано \
+            другими образцами и командами (ни один из них не освободит место) и ожидание длится дольше timeout.
+
+        :raises DiskSpaceError: Объём не может быть зарезервирован.
+        """
+        if not size or time.time() - waiting_since < self.timeout:
+            return
+        path = os.path.abspath(path)
+        device = self.device(path)
+        with self.condition:
+            if self.reserved.get(device, 0) - self.own_reservation(device):
+                return
+            free = self.free_space(device, path)
+        if free - size < self.min_free:
+            raise DiskSpaceError(f'{label}: недостаточно места на диске: требуется {format_size(size)} в {path}, '
+                                 f'свободно {format_size(free)}, должно оставаться {format_size(self.min_free)}')
+
+    @staticmethod
+    def waiting_message(path:str, size:int, io:bool, label:str) -> str:
+        if size:
+            return f'\t\t\t{label}: ожидание места на диске ({format_size(size)} в {path})\n'
+        return f'\t\t\t{label}: ожидание слота ввода-вывода ({path})\n'
+
+    def release(self, reservation:tuple):
+        if not reservation:
+            return
+        device, size, io = reservation
+        with self.condition:
+            self.reserved[device] -= size
+            if io:
+                self.io_running[device] -= 1
+            # Записанные данные должны быть учтены при следующей проверке
+            self.free.pop(device, None)
+            self.condition.notify_all()
+
+
+def create_disk_admission(machine_data:dict) -> DiskAdmission:
+    """
+    Создаёт контроль места на дисках по настройкам машины (ключ disk: min_free - место, которое должно оставаться \
+        свободным, io_limit - одновременные команды с опцией io на файловой системе, poll - интервал проверки, \
+        timeout - ожидание места, которое не освободят образцы пайплайна).
+        Объёмы, объявленные в шаблонах модулей и команд, учитываются только на машинах с ключом disk.
+    """
+    options = machine_data.get('disk')
+    if not options:
+        return None
+    return DiskAdmission(min_free=parse_size(options.get('min_free', 0)), io_limit=int(options.get('io_limit', 0)),
+                         poll=float(options.get('poll', 5)), timeout=float(options.get('timeout', 0)))
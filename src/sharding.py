@@ -0,0 +1,189 @@
+"""
+Разбиение больших входных файлов образца на части (shards) для параллельной обработки (scatter-gather).
+Модуль не зависит от остальных модулей пайплайна: встроенный разделитель запускается командой \
+    python sharding.py split-records ... в задании образца, в том числе на узлах кластера.
+"""
+import argparse
+import gzip
+import os
+import shlex
+import sys
+
+SHARD_MODES = ['records', 'bytes', 'regions']
+
+
+def whole_shard(sample:str) -> dict:
+    """
+    Описание образца целиком: используется в filenames без разбиения и для файлов, собираемых командой gather.
+    """
+    return {'index': None, 'count': 1, 'name': '', 'suffix': '', 'input': sample,
+            'start': 0, 'end': None, 'region': ''}
+
+
+def plan_shards(sample:str, by:str, count:int=1, regions:list=None, folder:str='') -> list:
+    """
+    Описывает части образца.
+
+    :param sample: Путь к входному файлу образца.
+    :param by: Способ разбиения: 'records' - файл делится на части по записям (встроенным либо заданным разделителем), \
+               'bytes' - диапазоны байт исходного файла, выровненные по началу строки, \
+               'regions' - по одной части на геномный регион.
+    :param count: Количество частей (records, bytes).
+    :param regions: Регионы (regions).
+    :param folder: Папка для файлов частей (records).
+    :return: Список частей: index, count, name, suffix (.<name> для имён файлов), input (входной файл части), \
+             start и end (диапазон байт), region.
+    """
+    if by == 'regions':
+        count = len(regions or [])
+    count = max(1, int(count))
+    stem, ext = split_extension(os.path.basename(sample))
+    ranges = byte_ranges(sample, count) if by == 'bytes' else []
+    shards = []
+    for i in range(count):
+        name = f'shard{i:04d}'
+        shard = {**whole_shard(sample), 'index': i, 'count': count, 'name': name, 'suffix': f'.{name}'}
+        if by == 'records':
+            shard['input'] = os.path.join(folder, f'{stem}.{name}{ext}')
+        elif by == 'bytes':
+            shard['start'], shard['end'] = ranges[i]
+        elif by == 'regions':
+            shard['region'] = regions[i]
+        shards.append(shard)
+    return shards
+
+
+def split_extension(filename:str) -> tuple:
+    """
+    Делит имя файла на основу и полное расширение ('s1.fastq.gz' -> ('s1', '.fastq.gz')).
+    """
+    stem, dot, ext = filename.partition('.')
+    return (stem, dot + ext)
+
+
+def byte_ranges(path:str, count:int) -> list:
+    """
+    Делит файл на count диапазонов байт [начало, конец), границы которых сдвинуты к началу следующей строки.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = 0
+    if not size:
+        return [(0, 0)] * count
+    bounds = [0]
+    with open(path, 'rb') as file:
+        for i in range(1, count):
+            position = max(size * i // count, bounds[-1])
+            if 0 < position < size:
+                file.seek(position - 1)
+                # Если позиция уже в начале строки, readline прочитает только предшествующий ей перевод строки
+                file.readline()
+                position = file.tell()
+            bounds.append(min(position, size))
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(count)]
+
+
+def read_regions(path:str) -> list:
+    """
+    Читает регионы из файла: по одному региону на строку (chr1, chr1:1-1000) либо BED (chrom, start, end).
+    Координаты BED (с нуля, полуинтервал) переводятся в запись chrom:start+1-end.
+    """
+    regions = []
+    with open(path, 'r') as file:
+        for line in file:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.split()
+            if len(fields) >= 3 and fields[1].isdigit() and fields[2].isdigit():
+                regions.append(f'{fields[0]}:{int(fields[1]) + 1}-{fields[2]}')
+            else:
+                regions.append(fields[0])
+    return regions
+
+
+def split_records_cmd(sample:str, shards:list, record_lines:int=4) -> str:
+    """
+    Команда встроенного разделителя по записям.
+    """
+    args = ['split-records', '--record-lines', str(record_lines), sample] + [shard['input'] for shard in shards]
+    return ' '.join(shlex.quote(arg) for arg in [sys.executable, os.path.abspath(__file__)] + args)
+
+
+def remove_shards_cmd(shards:list) -> str:
+    """
+    Команда удаления входных файлов частей (после того как результаты частей собраны).
+    """
+    args = ['remove'] + [shard['input'] for shard in shards]
+    return ' '.join(shlex.quote(arg) for arg in [sys.executable, os.path.abspath(__file__)] + args)
+
+
+def open_file(path:str, mode:str):
+    # Сжатые части пишутся с минимальным уровнем сжатия: они временные и читаются сразу же
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, compresslevel=1) if 'w' in mode else gzip.open(path, mode)
+    return open(path, mode)
+
+
+def split_records(source:str, outputs:list, record_lines:int=4):
+    """
+    Распределяет записи файла (по record_lines строк, например 4 для FASTQ) по файлам частей по кругу: \
+        части получаются одинакового размера за один проход, а парные файлы (R1/R2) делятся согласованно.
+    """
+    for output in outputs:
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    files = [open_file(output, 'wb') for output in outputs]
+    try:
+        with open_file(source, 'rb') as reader:
+            record = []
+            i = 0
+            for line in reader:
+                record.append(line)
+                if len(record) == record_lines:
+                    files[i % len(files)].writelines(record)
+                    record = []
+                    i += 1
+            if record:
+                files[i % len(files)].writelines(record)
+    finally:
+        for file in files:
+            file.close()
+
+
+def remove_shards(paths:list):
+    """
+    Удаляет файлы частей; папка частей удаляется, если в ней больше ничего нет.
+    """
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    for folder in {os.path.dirname(path) for path in paths}:
+        try:
+            os.rmdir(folder)
+        except OSError:
+            pass
+
+
+def main(argv:list):
+    parser = argparse.ArgumentParser(prog='sharding.py')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_split = subparsers.add_parser('split-records')
+    parser_split.add_argument('--record-lines', type=int, default=4)
+    parser_split.add_argument('source')
+    parser_split.add_argument('outputs', nargs='+')
+    parser_remove = subparsers.add_parser('remove')
+    parser_remove.add_argument('paths', nargs='+')
+    args = parser.parse_args(argv)
+    if args.command == 'remove':
+        remove_shards(paths=args.paths)
+        return
+    if args.record_lines < 1:
+        parser_split.error('--record-lines должно быть положительным числом')
+    split_records(source=args.source, outputs=args.outputs, record_lines=args.record_lines)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,457 @@
+"""
+Моделирование выполнения прошлого запуска при других настройках (планирование мощностей): количество одновременно \
+    обрабатываемых образцов, лимиты потоков и памяти, порядок образцов, потоковое выполнение модулей.
+Длительности команд берутся из логов запуска (log_records.jsonl либо log.yaml), ресурсы и зависимости команд - \
+    из сгенерированных команд модулей (cmd_data_<модуль>.yaml), настройки запуска - из init_configs.yaml. \
+    Реальные программы не запускаются: выполнение воспроизводится моделью дискретных событий с теми же правилами, \
+    что у исполнителя (команды образца - по depends_on либо последовательно, ресурсы - как в ResourcePool).
+Результат: ожидаемое время выполнения (makespan), загрузка потоков и слотов образцов, критический путь - \
+    цепочка команд и ожиданий, определившая время завершения.
+
+Запуск: python -m src.simulator <папка логов запуска> [--parallel 4 8 16] [--threads 32 64] [--memory 256G] \
+    [--order recorded cost] [--stream] [--measured-memory]
+"""
+import argparse
+import heapq
+import itertools
+import os
+import sys
+from datetime import datetime
+from src.log_sink import read_records, load_yaml_logs
+from src.utils import load_yaml, get_cmd_dependencies, parse_size, format_size, convert_secs_to_dhms
+
+STAGES = ['before_batch', 'batch', 'after_batch']
+ORDERS = ['recorded', 'cost', 'shortest', 'name']
+
+
+def load_sections(log_dir:str) -> dict:
+    """
+    Загружает логи команд запуска: {раздел модуля: {'module', 'before_batch': {команда: лог}, \
+        'batch': {образец: {команда: лог}}, 'after_batch': {команда: лог}}} в порядке разделов.
+    """
+    sections = {}
+    records_path = os.path.join(log_dir, 'log_records.jsonl')
+    if os.path.isfile(records_path):
+        for record in read_records(records_path):
+            if record.get('type') == 'section':
+                sections[record['section']] = {'module': record['module'], 'before_batch': {}, 'batch': {}, 'after_batch': {}}
+            elif record.get('type') == 'unit' and record.get('section') in sections:
+                section = sections[record['section']]
+                if record['unit'] == 'batch':
+                    section['batch'][record['sample']] = record['log']
+                elif record['unit'] in section:
+                    section[record['unit']] = record['log']
+        return sections
+    # Прежний формат: {раздел: {стадия: {команда: лог}}, для batch - {образец: {команда: лог}}}
+    for name, stages in load_yaml_logs(os.path.join(log_dir, 'log.yaml')).items():
+        # Раздел - <модуль>_<дата>_<время>
+        section = {'module': name.rsplit('_', 2)[0], 'before_batch': {}, 'batch': {}, 'after_batch': {}}
+        for stage, data in (stages or {}).items():
+            if stage in section:
+                section[stage] = data or {}
+        sections[name] = section
+    return sections
+
+
+def parse_time(value) -> datetime:
+    try:
+        return datetime.strptime(str(value), "%d.%m.%Y %H:%M:%S")
+    except ValueError:
+        return None
+
+
+def load_workload(log_dir:str) -> dict:
+    """
+    Загружает нагрузку запуска. Если модуль выполнялся в папке логов несколько раз (повторные запуски за день), \
+        используется последнее выполнение.
+
+    :return: Словарь: modules - [{'module', 'before_batch': команды, 'batch': {образец: команды}, 'after_batch': команды}], \
+             где команды - {название: {'duration', 'threads', 'memory', 'rss', 'deps'}}; config - init_configs.yaml; \
+             recorded - фактическая длительность выполнения этих модулей в секундах либо None.
+    """
+    latest = {}
+    for section in load_sections(log_dir).values():
+        latest.pop(section['module'], None)
+        latest[section['module']] = section
+    if not latest:
+        raise SystemExit(f'В {log_dir} нет логов выполнения команд')
+    config = load_yaml(os.path.join(log_dir, 'init_configs.yaml')) or {}
+    modules = []
+    times = []
+    for module, section in latest.items():
+        cmd_data = load_yaml(os.path.join(log_dir, f'cmd_data_{module}.yaml')) or {}
+        data = {'module': module}
+        for stage in STAGES:
+            if stage == 'batch':
+                data[stage] = {sample: make_commands(logs, cmd_data.get('batch', {}).get(sample, {}))
+                               for sample, logs in section['batch'].items()}
+                logs = [log for sample_logs in section['batch'].values() for log in sample_logs.values()]
+            else:
+                data[stage] = make_commands(section[stage], cmd_data.get(stage, {}))
+                logs = list(section[stage].values())
+            times += [(parse_time(log.get('start_time')), parse_time(log.get('end_time'))) for log in logs]
+        modules.append(data)
+    times = [(start, end) for start, end in times if start and end]
+    recorded = (max(end for _, end in times) - min(start for start, _ in times)).total_seconds() if times else None
+    return {'modules': modules, 'config': config, 'recorded': recorded}
+
+
+def make_commands(logs:dict, cmds:dict) -> dict:
+    """
+    Объединяет логи команд стадии (образца) с их опциями. Учитываются только команды, которые выполнялись; \
+        зависимости от невыполнявшихся команд отбрасываются.
+
+    :param logs: Логи команд {название: лог}.
+    :param cmds: Сгенерированные команды {название: [команда, таймаут, (опции)]}; без них команды выполняются последовательно.
+    """
+    dependencies = get_cmd_dependencies({title: cmds.get(title, ['', 0]) for title in logs} if not cmds else cmds)
+    commands = {}
+    for title, log in logs.items():
+        options = cmds.get(title, [])[2] if len(cmds.get(title, [])) > 2 else {}
+        commands[title] = {'duration': float(log.get('duration_sec') or 0), 'threads': int(options.get('threads', 1)),
+                           'memory': int(options.get('memory', 0)), 'rss': int(log.get('max_rss_bytes') or 0),
+                           'deps': [dep for dep in dependencies.get(title, []) if dep in logs]}
+    return commands
+
+
+class ReplaySimulator:
+    """
+    Модель дискретных событий выполнения запуска.
+    Образцы модуля занимают слоты (max_parallel_samples) в выбранном порядке, команды образца запускаются после своих \
+        зависимостей, если помещаются в свободные потоки и память (запрос, превышающий лимит, ограничивается им, \
+        как в ResourcePool). Модули выполняются друг за другом (before_batch -> образцы -> after_batch) либо потоково: \
+        образец модуля запускается сразу после образца с тем же именем в предыдущем модуле.
+    """
+    def __init__(self, workload:dict, parallel:int=0, threads:int=0, memory:int=0, order:str='recorded',
+                 stream:bool=False, measured_memory:bool=False):
+        """
+        :param workload: Нагрузка запуска (см. load_workload).
+        :param parallel: Количество одновременно обрабатываемых образцов модуля (0 - как в записанном запуске).
+        :param threads: Лимит потоков (0 - без ограничения).
+        :param memory: Лимит памяти в байтах (0 - без ограничения).
+        :param order: Порядок образцов: recorded - как в запуске, cost - сначала самые долгие, shortest - сначала \
+                      самые короткие, name - по имени.
+        :param stream: Потоковое выполнение модулей.
+        :param measured_memory: Память команды - измеренный пик RSS, а не объявленная в шаблоне.
+        """
+        self.workload = workload
+        self.parallel = parallel
+        self.threads = threads
+        self.memory = memory
+        self.order = order
+        self.stream = stream
+        self.measured_memory = measured_memory
+
+    def module_parallel(self, module:str) -> int:
+        """
+        Слоты образцов модуля: заданные либо как в записанном запуске (см. ModuleRunner.reset_module_options).
+        """
+        if self.parallel:
+            return self.parallel
+        config = self.workload['config']
+        machine = (config.get('machines_template') or {}).get(config.get('machine'), {})
+        value = (config.get('modules_template') or {}).get(module, {}).get('max_parallel_samples') or \
+            machine.get('max_parallel_samples', machine.get('max_threads', 1))
+        return max(1, int(value))
+
+    def build(self):
+        """
+        Строит наборы команд (стадии и образцы модулей) и зависимости между ними.
+        """
+        self.units = []
+        self.commands = []
+        modules = self.workload['modules']
+        previous = None
+        for index, data in enumerate(modules):
+            ranks = self.sample_ranks(data['batch'])
+            before = self.add_unit(index, 'before_batch', '', data['before_batch'],
+                                   deps=[previous['after']] if previous and not self.stream else [])
+            samples = {}
+            for sample, cmds in data['batch'].items():
+                deps = [before]
+                if previous and self.stream:
+                    # Образец поступает после образца с тем же именем; прочие - после завершения предыдущего модуля
+                    deps += [previous['samples'][sample]] if sample in previous['samples'] else list(previous['samples'].values())
+                samples[sample] = self.add_unit(index, 'batch', sample, cmds, deps=deps, rank=ranks[sample])
+            after_deps = list(samples.values()) or [before]
+            if previous and self.stream:
+                after_deps += list(previous['samples'].values())
+            after = self.add_unit(index, 'after_batch', '', data['after_batch'], deps=after_deps)
+            previous = {'after': after, 'samples': samples}
+
+    def sample_ranks(self, batch:dict) -> dict:
+        samples = list(batch)
+        cost = {sample: sum(cmd['duration'] for cmd in cmds.values()) for sample, cmds in batch.items()}
+        if self.order == 'cost':
+            samples.sort(key=lambda sample: -cost[sample])
+        elif self.order == 'shortest':
+            samples.sort(key=lambda sample: cost[sample])
+        elif self.order == 'name':
+            samples.sort()
+        return {sample: rank for rank, sample in enumerate(samples)}
+
+    def add_unit(self, module:int, stage:str, sample:str, cmds:dict, deps:list, rank:int=0) -> int:
+        unit_id = len(self.units)
+        ids = {title: len(self.commands) + i for i, title in enumerate(cmds)}
+        for title, cmd in cmds.items():
+            memory = cmd['rss'] if self.measured_memory else cmd['memory']
+            threads, memory = self.clamp(cmd['threads'], memory)
+            self.commands.append({'unit': unit_id, 'title': title, 'duration': cmd['duration'], 'threads': threads,
+                                  'memory': memory, 'deps': [ids[dep] for dep in cmd['deps']], 'dependents': [],
+                                  'waiting': len(cmd['deps']), 'start': None, 'end': None, 'cause': None})
+        for command_id in ids.values():
+            for dep in self.commands[command_id]['deps']:
+                self.commands[dep]['dependents'].append(command_id)
+        self.units.append({'module': module, 'stage': stage, 'sample': sample, 'rank': rank, 'commands': list(ids.values()),
+                           'remaining': len(ids), 'deps': deps, 'waiting': len(deps), 'dependents': [],
+                           'start': None, 'end': None, 'cause': None})
+        for dep in deps:
+            self.units[dep]['dependents'].append(unit_id)
+        return unit_id
+
+    def clamp(self, threads:int, memory:int) -> tuple:
+        if self.threads:
+            threads = min(threads, self.threads)
+        if self.memory:
+            memory = min(memory, self.memory)
+        return (threads, memory)
+
+    def run(self) -> dict:
+        """
+        Воспроизводит выполнение.
+
+        :return: Словарь: makespan - длительность в секундах, busy_threads - среднее количество занятых потоков, \
+                 thread_utilization - доля занятых потоков (при лимите потоков), peak_memory - пик занятой памяти, \
+                 slot_utilization - {модуль: доля занятых слотов образцов}, critical_path - цепочка команд.
+        """
+        self.build()
+        modules = self.workload['modules']
+        slots = [self.module_parallel(data['module']) for data in modules]
+        active = [0] * len(modules)
+        # Готовые к запуску образцы модулей (ожидают слота) и команды (ожидают ресурсов)
+        queued = [[] for _ in modules]
+        ready = []
+        events = []
+        sequence = itertools.count()
+        used = {'threads': 0, 'memory': 0, 'peak_memory': 0}
+        now = 0.0
+
+        def fits(command:dict) -> bool:
+            return (not self.threads or used['threads'] + command['threads'] <= self.threads) and \
+                   (not self.memory or used['memory'] + command['memory'] <= self.memory)
+
+        def unit_ready(unit_id:int, cause):
+            unit = self.units[unit_id]
+            unit['cause'] = cause
+            if unit['stage'] == 'batch':
+                unit['queued_at'] = now
+                heapq.heappush(queued[unit['module']], (unit['rank'], unit_id))
+            else:
+                activate(unit_id, cause)
+
+        def activate(unit_id:int, cause):
+            unit = self.units[unit_id]
+            unit['start'] = now
+            if unit['stage'] == 'batch':
+                active[unit['module']] += 1
+            if not unit['commands']:
+                finish_unit(unit_id, cause)
+                return
+            for command_id in unit['commands']:
+                if not self.commands[command_id]['waiting']:
+                    command_ready(command_id, cause)
+
+        def command_ready(command_id:int, cause):
+            command = self.commands[command_id]
+            command['ready'] = now
+            command['cause'] = cause
+            ready.append(command_id)
+
+        def finish_unit(unit_id:int, cause):
+            unit = self.units[unit_id]
+            unit['end'] = now
+            if unit['stage'] == 'batch':
+                active[unit['module']] -= 1
+            for dependent in unit['dependents']:
+                self.units[dependent]['waiting'] -= 1
+                if not self.units[dependent]['waiting']:
+                    unit_ready(dependent, (cause[0], 'dependency') if cause else None)
+
+        def dispatch(event):
+            # Слоты образцов и ресурсы, освобождённые событием, занимаются в порядке очереди
+            for module, queue in enumerate(queued):
+                while queue and active[module] < slots[module]:
+                    _, unit_id = heapq.heappop(queue)
+                    unit = self.units[unit_id]
+                    # Образец, ожидавший слота, запускается из-за завершения команды, освободившей слот
+                    activate(unit_id, (event, 'slot') if unit['queued_at'] < now and event is not None else unit['cause'])
+            started = []
+            for command_id in ready:
+                command = self.commands[command_id]
+                if not fits(command):
+                    continue
+                used['threads'] += command['threads']
+                used['memory'] += command['memory']
+                used['peak_memory'] = max(used['peak_memory'], used['memory'])
+                command['start'] = now
+                if command['ready'] < now and event is not None:
+                    command['cause'] = (event, 'resources')
+                heapq.heappush(events, (now + command['duration'], next(sequence), command_id))
+                started.append(command_id)
+            for command_id in started:
+                ready.remove(command_id)
+
+        # Наборы без зависимостей отбираются заранее: при запуске пустых наборов готовыми становятся и их зависимые
+        for unit_id in [unit_id for unit_id, unit in enumerate(self.units) if not unit['waiting']]:
+            unit_ready(unit_id, None)
+        dispatch(None)
+        while events:
+            now, _, command_id = heapq.heappop(events)
+            command = self.commands[command_id]
+            command['end'] = now
+            used['threads'] -= command['threads']
+            used['memory'] -= command['memory']
+            for dependent in command['dependents']:
+                self.commands[dependent]['waiting'] -= 1
+                if not self.commands[dependent]['waiting']:
+                    command_ready(dependent, (command_id, 'dependency'))
+            unit = self.units[command['unit']]
+            unit['remaining'] -= 1
+            if not unit['remaining']:
+                finish_unit(command['unit'], (command_id, 'dependency'))
+            dispatch(command_id)
+        return self.summarize(slots)
+
+    def summarize(self, slots:list) -> dict:
+        makespan = max([command['end'] for command in self.commands if command['end'] is not None] or [0])
+        thread_seconds = sum(command['duration'] * command['threads'] for command in self.commands)
+        busy_threads = thread_seconds / makespan if makespan else 0
+        slot_utilization = {}
+        for index, data in enumerate(self.workload['modules']):
+            samples = [unit for unit in self.units if unit['module'] == index and unit['stage'] == 'batch' and unit['end'] is not None]
+            if not samples:
+                continue
+            span = max(unit['end'] for unit in samples) - min(unit['start'] for unit in samples)
+            busy = sum(unit['end'] - unit['start'] for unit in samples)
+            slot_utilization[data['module']] = busy / (span * slots[index]) if span else 1.0
+        return {'makespan': makespan, 'busy_threads': busy_threads,
+                'thread_utilization': busy_threads / self.threads if self.threads else None,
+                'peak_memory': max([0] + [self.peak_memory()]), 'slot_utilization': slot_utilization,
+                'critical_path': self.critical_path()}
+
+    def peak_memory(self) -> int:
+        changes = sorted([(command['start'], command['memory']) for command in self.commands if command['start'] is not None] +
+                         [(command['end'], -command['memory']) for command in self.commands if command['end'] is not None],
+                         key=lambda change: (change[0], change[1]))
+        peak = current = 0
+        for _, delta in changes:
+            current += delta
+            peak = max(peak, current)
+        return peak
+
+    def critical_path(self) -> list:
+        """
+        Цепочка команд, определившая время завершения: от последней завершившейся команды по причинам запуска \
+            (завершение зависимости, освобождение слота образца либо ресурсов) к началу.
+
+        :return: Список шагов: module, stage, sample, command, start, duration, wait - ожидание перед запуском, \
+                 reason - почему команда не могла начаться раньше.
+        """
+        finished = [command_id for command_id, command in enumerate(self.commands) if command['end'] is not None]
+        if not finished:
+            return []
+        command_id = max(finished, key=lambda command_id: (self.commands[command_id]['end'], command_id))
+        reason = 'end'
+        path = []
+        seen = set()
+        while command_id is not None and command_id not in seen:
+            seen.add(command_id)
+            command = self.commands[command_id]
+            unit = self.units[command['unit']]
+            cause = command['cause']
+            previous_end = self.commands[cause[0]]['end'] if cause else 0
+            path.append({'module': self.workload['modules'][unit['module']]['module'], 'stage': unit['stage'],
+                         'sample': unit['sample'], 'command': command['title'], 'start': command['start'],
+                         'duration': command['duration'], 'wait': max(0, command['start'] - previous_end),
+                         'reason': cause[1] if cause else 'start'})
+            command_id = cause[0] if cause else None
+        path.reverse()
+        return path
+
+
+def format_secs(secs:float) -> str:
+    return convert_secs_to_dhms(secs=int(round(secs)), precision='s')
+
+
+def format_report(workload:dict, results:list, path_limit:int=20) -> str:
+    """
+    Формирует таблицу результатов и критические пути.
+
+    :param results: [(настройки, результат ReplaySimulator.run)].
+    """
+    lines = []
+    recorded = workload['recorded']
+    if recorded is not None:
+        lines.append(f'Recorded makespan: {format_secs(recorded)} ({recorded:.0f} s)')
+    lines.append(f'{"parallel":>8} {"threads":>8} {"memory":>8} {"order":>9} {"stream":>6} {"makespan":>14} '
+                 f'{"speedup":>8} {"busy thr":>8} {"thr util":>8} {"peak mem":>9}  slot utilization')
+    for settings, result in results:
+        speedup = f'{recorded / result["makespan"]:.2f}x' if recorded and result['makespan'] else '-'
+        utilization = f'{result["thread_utilization"]:.0%}' if result['thread_utilization'] is not None else '-'
+        slots = ', '.join(f'{module} {value:.0%}' for module, value in result['slot_utilization'].items())
+        lines.append(f'{settings["parallel"] or "run":>8} {settings["threads"] or "-":>8} '
+                     f'{format_size(settings["memory"]) if settings["memory"] else "-":>8} {settings["order"]:>9} '
+                     f'{"yes" if settings["stream"] else "no":>6} {format_secs(result["makespan"]):>14} {speedup:>8} '
+                     f'{result["busy_threads"]:>8.1f} {utilization:>8} {format_size(result["peak_memory"]):>9}  {slots}')
+    for settings, result in results:
+        path = result['critical_path']
+        lines.append(f'\nCritical path (parallel {settings["parallel"] or "run"}, threads {settings["threads"] or "-"}, '
+                     f'order {settings["order"]}{", stream" if settings["stream"] else ""}): {len(path)} commands, '
+                     f'running {format_secs(sum(step["duration"] for step in path))}, '
+                     f'waiting {format_secs(sum(step["wait"] for step in path))}')
+        # Вклад команд в критический путь
+        totals = {}
+        for step in path:
+            key = f'{step["module"]}/{step["stage"]}/{step["command"]}'
+            totals[key] = totals.get(key, 0) + step['duration']
+        for key, value in sorted(totals.items(), key=lambda item: -item[1])[:5]:
+            lines.append(f'  {key}: {format_secs(value)}')
+        shown = path if len(path) <= path_limit else path[:path_limit // 2] + [None] + path[-(path_limit - path_limit // 2):]
+        for step in shown:
+            if step is None:
+                lines.append(f'    ... {len(path) - path_limit} more')
+                continue
+            sample = f' {step["sample"]}' if step['sample'] else ''
+            wait = f', waited {format_secs(step["wait"])}' if step['wait'] else ''
+            lines.append(f'    {format_secs(step["start"]):>12}  {step["module"]}/{step["stage"]}{sample}: '
+                         f'{step["command"]} {format_secs(step["duration"])} [{step["reason"]}{wait}]')
+    return '\n'.join(lines)
+
+
+def main(argv:list):
+    parser = argparse.ArgumentParser(prog='python -m src.simulator',
+                                     description="Моделирование выполнения прошлого запуска при других настройках")
+    parser.add_argument('log_dir', help="Папка логов запуска (<output_dir>/Logs/<запуск>)")
+    parser.add_argument('--parallel', type=int, nargs='+', default=[0],
+                        help="Количества одновременно обрабатываемых образцов (0 - как в запуске)")
+    parser.add_argument('--threads', type=int, nargs='+', default=[0], help="Лимиты потоков (0 - без ограничения)")
+    parser.add_argument('--memory', nargs='+', default=['0'], help="Лимиты памяти, например 256G (0 - без ограничения)")
+    parser.add_argument('--order', nargs='+', default=['recorded'], choices=ORDERS, help="Порядок образцов")
+    parser.add_argument('--stream', action='store_true', help="Потоковое выполнение модулей")
+    parser.add_argument('--measured-memory', action='store_true',
+                        help="Память команды - измеренный пик RSS, а не объявленная в шаблоне")
+    parser.add_argument('--path-limit', type=int, default=20, help="Сколько шагов критического пути выводить")
+    args = parser.parse_args(argv)
+
+    workload = load_workload(args.log_dir)
+    results = []
+    for parallel, threads, memory, order in itertools.product(args.parallel, args.threads, args.memory, args.order):
+        settings = {'parallel': parallel, 'threads': threads, 'memory': parse_size(memory), 'order': order,
+                    'stream': args.stream}
+        simulator = ReplaySimulator(workload=workload, measured_memory=args.measured_memory, **settings)
+        results.append((settings, simulator.run()))
+    print(format_report(workload, results, path_limit=args.path_limit))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
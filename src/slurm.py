@@ -0,0 +1,289 @@
+import os
+import shlex
+import subprocess
+import sys
+import time
+from datetime import datetime
+from src.utils import parse_size, write_json_atomic, INTERRUPT_EVENT
+from src.scheduler import ResourcePool
+from src.backends import BatchBackend, run_task
+
+# Корень репозитория: задания запускают python -m src.slurm из него
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Состояния заданий SLURM, после которых задание больше не выполняется
+FINAL_STATES = {'COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL', 'PREEMPTED',
+                'BOOT_FAIL', 'DEADLINE', 'MISSING'}
+SACCT_FIELDS = ['JobID', 'State', 'ExitCode', 'Elapsed', 'MaxRSS', 'TotalCPU', 'NodeList']
+
+
+class SlurmBackend(BatchBackend):
+    """
+    Выполнение образцов стадии batch заданиями планировщика SLURM.
+    Для каждого образца в папке модуля создаются файл задачи и скрипт задания; задание (sbatch) выполняет \
+        команды образца тем же кодом, что и локальный запуск (run_task), и записывает результат в файл.
+    Состояние всех заданий модуля запрашивается одним вызовом sacct за интервал опроса; данные учёта \
+        (состояние, длительность, пиковая память, время CPU, узел) записываются в логи образца (поле job).
+    Задание, которое отсутствует в учёте дольше missing_timeout (удалено из базы учёта, ошибка настройки кластера), \
+        отмечается как завершившееся с ошибкой SLURM_MISSING.
+    """
+    def __init__(self, jobs_dir:str, partition:str='', account:str='', time_limit:str='', extra_args:list=None,
+                 poll:float=10, fake:bool=False, missing_timeout:float=600):
+        """
+        :param jobs_dir: Папка файлов заданий (должна быть доступна узлам кластера).
+        :param partition: Раздел (очередь) SLURM.
+        :param account: Счёт SLURM.
+        :param time_limit: Лимит времени задания в формате SLURM; если не указан, вычисляется по таймаутам команд.
+        :param extra_args: Дополнительные аргументы sbatch.
+        :param poll: Интервал опроса состояния заданий, в секундах.
+        :param fake: Использовать локальную имитацию SLURM (src.fake_slurm) вместо настоящих sbatch/sacct/scancel.
+        :param missing_timeout: Сколько секунд задание может отсутствовать в ответах sacct, прежде чем \
+                                оно будет отмечено как завершившееся с ошибкой.
+        """
+        self.jobs_dir = jobs_dir
+        self.partition = partition
+        self.account = account
+        self.time_limit = time_limit
+        self.extra_args = [str(arg) for arg in extra_args or []]
+        self.poll = poll
+        self.fake = fake
+        self.missing_timeout = missing_timeout
+
+    def slurm_cmd(self, command:str) -> list:
+        if self.fake:
+            return [sys.executable, '-m', 'src.fake_slurm', command]
+        return [command]
+
+    def call(self, command:str, args:list) -> str:
+        """
+        Выполняет команду SLURM и возвращает её stdout.
+        """
+        env = dict(os.environ)
+        if self.fake:
+            env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_DIR, env.get('PYTHONPATH')]))
+        result = subprocess.run(self.slurm_cmd(command) + args, capture_output=True, text=True, env=env)
+        if result.returncode != 0:
+            raise RuntimeError(f'{command} завершился с ошибкой ({result.returncode}): {result.stderr.strip()}')
+        return result.stdout
+
+    def run_batch(self, executor, module_stage:str, module_result_dict:dict, timeout_behavior:str,
+                  max_parallel_samples:int=1, resources:ResourcePool=None) -> bool:
+        """
+        Отправляет задания образцов стадии batch и фиксирует результаты по мере завершения заданий.
+
+        :param executor: CommandExecutor модуля.
+        :return: Флаг прерывания.
+        """
+        samples = list(executor.cmd_data[module_stage].keys())
+        module_dir = os.path.join(self.jobs_dir, executor.log_section.replace(':', '-'))
+        os.makedirs(module_dir, exist_ok=True)
+        # {идентификатор задания: (образец, префикс файлов задания)}
+        jobs = {}
+        done = set()
+        # {идентификатор задания: время первого успешного опроса sacct, в ответе на который задания не было}
+        missing_since = {}
+        interruption = False
+        try:
+            for i, sample in enumerate(samples):
+                prefix = os.path.join(module_dir, f'{i:06d}_{sample}')
+                job_id = self.submit(executor=executor, module_stage=module_stage, sample=sample,
+                                     timeout_behavior=timeout_behavior, prefix=prefix)
+                jobs[job_id] = (sample, prefix)
+            print(f'\t\tSamples: {len(samples)}, SLURM jobs: {module_dir}')
+
+            start_time = time.time()
+            while len(done) < len(jobs) and not interruption:
+                time.sleep(self.poll)
+                try:
+                    accounting = self.query([job_id for job_id in jobs if job_id not in done])
+                except (RuntimeError, OSError) as e:
+                    # Сбой sacct (перегрузка контроллера, сеть) не прерывает модуль: опрос повторяется
+                    print(f'\t\tНе удалось получить состояние заданий, повтор через {self.poll:g} с: {e}')
+                    continue
+                now = time.time()
+                for job_id in jobs:
+                    if job_id in done or job_id in accounting:
+                        missing_since.pop(job_id, None)
+                        continue
+                    # Задание попадает в учёт не сразу после sbatch: ошибка, только если его нет дольше missing_timeout
+                    if now - missing_since.setdefault(job_id, now) >= self.missing_timeout:
+                        accounting[job_id] = self.missing_job(job_id)
+                for job_id, job in accounting.items():
+                    if job['state'] not in FINAL_STATES:
+                        continue
+                    sample, prefix = jobs[job_id]
+                    result = self.read_json(f'{prefix}.result.json')
+                    if result is None:
+                        # Задание завершилось, не записав результат (таймаут, нехватка памяти, отмена, сбой узла)
+                        error = f'Задание {job_id} отсутствует в учёте SLURM (sacct) дольше {self.missing_timeout:g} с\n' \
+                            if job['state'] == 'MISSING' else ''
+                        result = self.failed_result(cmds=executor.cmd_data[module_stage][sample], job=job,
+                                                    error_file=f'{prefix}.err', error=error)
+                    result['job'] = job
+                    done.add(job_id)
+                    interruption = self.commit_result(executor=executor, module_stage=module_stage, sample=sample,
+                                                      module_result_dict=module_result_dict, result=result) or interruption
+                    executor.report_progress(sample=sample, unit_result=result['unit_result'], k=len(done),
+                                             total=len(jobs), start_time=start_time)
+        except KeyboardInterrupt:
+            print('INTERRUPTED')
+            INTERRUPT_EVENT.set()
+            interruption = True
+        finally:
+            # Задания, результаты которых уже не будут зафиксированы (прерывание либо ошибка), отменяются
+            pending = [job_id for job_id in jobs if job_id not in done]
+            if pending:
+                try:
+                    self.call('scancel', pending)
+                except (RuntimeError, OSError) as e:
+                    print(f'\t\tНе удалось отменить задания {", ".join(pending)}: {e}')
+        self.order_results(module_stage=module_stage, module_result_dict=module_result_dict, samples=samples)
+        return interruption
+
+    def submit(self, executor, module_stage:str, sample:str, timeout_behavior:str, prefix:str) -> str:
+        """
+        Создаёт задачу и скрипт задания образца и отправляет задание в SLURM.
+
+        :param prefix: Префикс путей файлов задания (задача, скрипт, результат, stdout/stderr задания).
+        :return: Идентификатор задания.
+        """
+        task = self.make_task(executor=executor, module_stage=module_stage, sample=sample,
+                              timeout_behavior=timeout_behavior)
+        cmds = task['cmds']
+        # Заданию выделяются ресурсы самой требовательной команды образца; команды распределяются в их пределах
+        threads = max([cmd_opts[2].get('threads', 1) for cmd_opts in cmds.values() if len(cmd_opts) > 2] or [1])
+        memory = max([cmd_opts[2].get('memory', 0) for cmd_opts in cmds.values() if len(cmd_opts) > 2] or [0])
+        task['resources'] = {'threads': threads, 'memory': memory}
+        write_json_atomic(f'{prefix}.task.json', task)
+        with open(f'{prefix}.sh', 'w') as file:
+            file.write('#!/bin/bash\n'
+                       f'export PYTHONPATH={shlex.quote(REPO_DIR)}${{PYTHONPATH:+:$PYTHONPATH}}\n'
+                       f'exec {shlex.quote(sys.executable)} -m src.slurm run-task '
+                       f'{shlex.quote(prefix + ".task.json")} {shlex.quote(prefix + ".result.json")}\n')
+
+        args = ['--parsable', f'--job-name={executor.module}_{sample}', f'--output={prefix}.out',
+                f'--error={prefix}.err', f'--cpus-per-task={threads}']
+        if memory:
+            args.append(f'--mem={max(1, memory // 1024**2)}M')
+        time_limit = self.time_limit or self.job_time_limit(cmds)
+        if time_limit:
+            args.append(f'--time={time_limit}')
+        if self.partition:
+            args.append(f'--partition={self.partition}')
+        if self.account:
+            args.append(f'--account={self.account}')
+        # --parsable: "<идентификатор>[;<кластер>]"
+        return self.call('sbatch', args + self.extra_args + [f'{prefix}.sh']).strip().split(';')[0]
+
+    @staticmethod
+    def job_time_limit(cmds:dict) -> str:
+        """
+        Лимит времени задания (минуты) - сумма таймаутов команд образца с запасом на запуск; \
+            пустая строка, если у какой-либо команды таймаута нет.
+        """
+        timeouts = [cmd_opts[1] for cmd_opts in cmds.values()]
+        if not timeouts or not all(isinstance(timeout, (int, float)) and timeout > 0 for timeout in timeouts):
+            return ''
+        return str(int(sum(timeouts) // 60) + 5)
+
+    def query(self, job_ids:list) -> dict:
+        """
+        Запрашивает учётные данные заданий одним вызовом sacct.
+
+        :return: {идентификатор задания: данные учёта}; задания, ещё не попавшие в учёт, отсутствуют.
+        """
+        if not job_ids:
+            return {}
+        output = self.call('sacct', ['-j', ','.join(job_ids), f'--format={",".join(SACCT_FIELDS)}',
+                                     '--parsable2', '--noheader'])
+        jobs = {}
+        for line in output.splitlines():
+            row = dict(zip(SACCT_FIELDS, line.split('|')))
+            if not row.get('JobID'):
+                continue
+            job_id, _, step = row['JobID'].partition('.')
+            job = jobs.setdefault(job_id, {'job_id': job_id, 'state': '', 'exit_code': '', 'elapsed_sec': 0,
+                                           'max_rss_bytes': 0, 'total_cpu_sec': 0, 'node': ''})
+            # Пиковая память учитывается по шагам задания (batch, extern), остальное - по строке самого задания
+            job['max_rss_bytes'] = max(job['max_rss_bytes'], parse_size(row.get('MaxRSS') or 0))
+            if step:
+                continue
+            # "CANCELLED by 1000" -> "CANCELLED"
+            job['state'] = row.get('State', '').split(' ')[0].rstrip('+')
+            job['exit_code'] = row.get('ExitCode', '')
+            job['elapsed_sec'] = parse_slurm_duration(row.get('Elapsed', ''))
+            job['total_cpu_sec'] = parse_slurm_duration(row.get('TotalCPU', ''))
+            job['node'] = row.get('NodeList', '')
+        return jobs
+
+    @staticmethod
+    def missing_job(job_id:str) -> dict:
+        """
+        Данные учёта задания, которое не найдено в sacct: состояние MISSING считается конечным.
+        """
+        return {'job_id': job_id, 'state': 'MISSING', 'exit_code': '', 'elapsed_sec': 0, 'max_rss_bytes': 0,
+                'total_cpu_sec': 0, 'node': ''}
+
+    @staticmethod
+    def failed_result(cmds:dict, job:dict, error_file:str, error:str='') -> dict:
+        """
+        Результат образца, задание которого завершилось без записи результата: все команды отмечаются как \
+            завершившиеся с ошибкой SLURM_<состояние>; в stderr попадает error и конец stderr задания.
+        """
+        stderr = error
+        try:
+            with open(error_file, 'r', errors='replace') as file:
+                stderr += file.read()[-4096:]
+        except FileNotFoundError:
+            pass
+        now = datetime.now().strftime("%d.%m.%Y %H:%M:%S")
+        exit_code = f'SLURM_{job["state"]}'
+        unit_result = {'log': {}, 'stdout': {}, 'stderr': {}}
+        for title in cmds:
+            unit_result['log'][title] = {'status': 'FAIL', 'start_time': now, 'end_time': now, 'duration': '< 1s',
+                                         'duration_sec': 0, 'cpu_duration_sec': 0, 'exit_code': exit_code}
+            unit_result['stdout'][title] = ''
+            unit_result['stderr'][title] = stderr
+        return {'unit_result': unit_result, 'exit_codes': {title: exit_code for title in cmds},
+                'status': False, 'interruption': False}
+
+
+def parse_slurm_duration(value:str) -> float:
+    """
+    Переводит длительность в формате SLURM ([ДД-][ЧЧ:]ММ:СС[.ммм]) в секунды.
+    """
+    if not value:
+        return 0
+    days, _, rest = value.rpartition('-') if '-' in value else ('', '', value)
+    secs = 0.0
+    for part in rest.split(':'):
+        secs = secs * 60 + float(part or 0)
+    return round(int(days or 0) * 86400 + secs, 3)
+
+
+def create_slurm_backend(machine_data:dict, log_dir:str) -> SlurmBackend:
+    """
+    Создаёт исполнителя SLURM по настройкам машины (ключ slurm: dir, partition, account, time, extra_args, poll, fake, \
+        missing_timeout).
+    """
+    options = machine_data.get('slurm') or {}
+    return SlurmBackend(jobs_dir=options.get('dir', os.path.join(log_dir, 'slurm')),
+                        partition=options.get('partition', ''), account=options.get('account', ''),
+                        time_limit=str(options.get('time', '')), extra_args=options.get('extra_args'),
+                        poll=float(options.get('poll', 10)), fake=bool(options.get('fake', False)),
+                        missing_timeout=float(options.get('missing_timeout', 600)))
+
+
+def run_task_file(task_path:str, result_path:str):
+    """
+    Выполняет задачу из файла внутри задания SLURM и атомарно записывает результат.
+    """
+    task = BatchBackend.read_json(task_path)
+    limits = task.get('resources') or {}
+    resources = ResourcePool(threads=int(limits.get('threads', 0)), memory=int(limits.get('memory', 0)))
+    write_json_atomic(result_path, run_task(task=task, resources=resources))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'run-task':
+        sys.exit('Использование: python -m src.slurm run-task <задача.json> <результат.json>')
+    run_task_file(task_path=sys.argv[2], result_path=sys.argv[3])
@@ -0,0 +1,224 @@
+"""
+Размещение входных и промежуточных файлов образца на локальном диске узла (scratch).
+Входные файлы образца копируются (либо связываются жёсткой ссылкой) в папку образца на scratch, промежуточные папки \
+    модуля указывают на scratch, объявленные выходные файлы копируются обратно после выполнения команд, \
+    папка образца удаляется.
+Модуль не зависит от остальных модулей пайплайна: операции выполняются командами python staging.py ... \
+    в наборе команд образца, то есть на том узле, где выполняется образец.
+"""
+import argparse
+import fcntl
+import hashlib
+import os
+import shlex
+import shutil
+import sys
+import time
+
+
+def staging_options(scratch:dict, staging:dict, run:str='', module:str='') -> dict:
+    """
+    Объединяет настройки scratch машины и staging модуля. Размещение на scratch используется, только если \
+        оба раздела заданы: шаблоны модулей остаются переносимыми между машинами с локальным диском и без него.
+
+    :param scratch: Настройки машины: dir - папка на локальном диске узла, min_free - место, которое должно остаться \
+                    свободным после размещения входных файлов (байты), max_stage_in - количество одновременных \
+                    размещений на узле, link - связывать входные файлы жёсткими ссылками, если возможно, \
+                    wait - сколько секунд ждать освобождения места, keep - не удалять папку образца.
+    :param staging: Настройки модуля: inputs - размещать входной файл образца, folders - папки модуля на scratch, \
+                    outputs - ключи filenames, которые копируются обратно.
+    :param run: Папка логов запуска: по ней определяется папка запуска на scratch (см. plan_staging).
+    :param module: Название модуля.
+    :return: Объединённые настройки либо None.
+    """
+    if not scratch or not scratch.get('dir') or not staging:
+        return None
+    run = os.path.abspath(run) if run else ''
+    run_name = f'{os.path.basename(run)}-{hashlib.md5(run.encode()).hexdigest()[:8]}' if run else 'run'
+    return {'dir': scratch['dir'], 'run': run_name, 'module': module or 'module', 'min_free': scratch.get('min_free', 0), 'max_stage_in': int(scratch.get('max_stage_in', 2)),
+            'link': bool(scratch.get('link', True)), 'wait': float(scratch.get('wait', 600)), 'keep': bool(scratch.get('keep', False)),
+            'inputs': bool(staging.get('inputs', True)), 'folders': list(staging.get('folders') or []),
+            'outputs': list(staging.get('outputs') or [])}
+
+
+def plan_staging(sample:str, folders:dict, options:dict) -> dict:
+    """
+    Описывает размещение образца на scratch.
+    Папка образца определяется только запуском (папкой его логов), модулем и образцом: возобновлённый запуск \
+        (--resume) получает те же команды и продолжает с промежуточными файлами, оставшимися на scratch \
+        от прерванного либо завершившегося с ошибкой образца (см. add_staging_cmds).
+
+    :return: root - папка образца, sample - путь к входному файлу для команд, folders - папки модуля для команд.
+    """
+    key = hashlib.md5(sample.encode()).hexdigest()[:8]
+    root = os.path.join(options['dir'], f'pipeline-{options["run"]}', options['module'],
+                        f'{os.path.basename(sample.rstrip("/"))}-{key}')
+    staged_folders = dict(folders)
+    for name in options['folders']:
+        staged_folders[name] = os.path.join(root, f'{name}/')
+    staged_sample = os.path.join(root, 'input', os.path.basename(sample.rstrip('/'))) if options['inputs'] else sample
+    return {'root': root, 'sample': staged_sample, 'folders': staged_folders}
+
+
+def script_cmd(args:list) -> str:
+    return ' '.join(shlex.quote(arg) for arg in [sys.executable, os.path.abspath(__file__)] + args)
+
+
+def stage_in_cmd(plan:dict, options:dict, inputs:list, need:int) -> str:
+    """
+    Команда размещения: создаёт папки образца на scratch и копирует входные файлы.
+
+    :param inputs: Пары (исходный путь, путь на scratch).
+    :param need: Объём размещаемых данных в байтах.
+    """
+    args = ['stage-in', '--scratch', options['dir'], '--need', str(need), '--min-free', str(options['min_free']),
+            '--slots', str(options['max_stage_in']), '--wait', str(options['wait'])]
+    if options['link']:
+        args.append('--link')
+    for name in options['folders']:
+        args += ['--mkdir', plan['folders'][name]]
+    for source, target in inputs:
+        args += ['--copy', source, target]
+    return script_cmd(args)
+
+
+def stage_out_cmd(outputs:list) -> str:
+    """
+    Команда копирования выходных файлов с scratch. outputs - пары (путь на scratch, итоговый путь).
+    """
+    args = ['stage-out']
+    for source, target in outputs:
+        args += ['--copy', source, target]
+    return script_cmd(args)
+
+
+def cleanup_cmd(plan:dict) -> str:
+    return script_cmd(['cleanup', plan['root']])
+
+
+def free_space(path:str) -> int:
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def acquire_slot(scratch:str, slots:int, deadline:float):
+    """
+    Занимает один из slots файлов блокировки в папке scratch: одновременно размещаются данные не более \
+        slots образцов узла, в том числе из разных процессов (рабочие очереди, задания SLURM).
+
+    :return: Открытый файл блокировки (блокировка снимается при закрытии) либо None по истечении deadline.
+    """
+    while True:
+        for i in range(max(1, slots)):
+            lock = open(os.path.join(scratch, f'.stage_in.{i}.lock'), 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock
+            except BlockingIOError:
+                lock.close()
+        if time.time() > deadline:
+            return None
+        time.sleep(0.5)
+
+
+def copy_path(source:str, target:str, link:bool=False):
+    """
+    Копирует файл либо папку через временный путь рядом с target, поэтому прерванное копирование \
+        не оставляет неполный файл под итоговым именем.
+    """
+    def copy_file(src:str, dst:str):
+        if link:
+            try:
+                os.link(src, dst)
+                return dst
+            except OSError:
+                # Разные файловые системы либо ссылки не поддерживаются
+                pass
+        return shutil.copy2(src, dst)
+
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    part = f'{target}.part'
+    if os.path.isdir(source):
+        shutil.rmtree(part, ignore_errors=True)
+        shutil.copytree(source, part, copy_function=copy_file)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+    else:
+        if os.path.exists(part):
+            os.remove(part)
+        copy_file(source, part)
+    os.replace(part, target)
+
+
+def stage_in(scratch:str, need:int, min_free:int, slots:int, wait:float, link:bool, mkdirs:list, copies:list) -> int:
+    os.makedirs(scratch, exist_ok=True)
+    deadline = time.time() + wait
+    lock = acquire_slot(scratch, slots, deadline)
+    if lock is None:
+        print(f'Не удалось начать размещение на {scratch} за {wait:.0f} с', file=sys.stderr)
+        return 1
+    try:
+        # Место освобождается по мере завершения других образцов узла
+        while free_space(scratch) - need < min_free:
+            if time.time() > deadline:
+                print(f'Недостаточно места на {scratch}: свободно {free_space(scratch)} байт, '
+                      f'требуется {need} + {min_free} байт', file=sys.stderr)
+                return 1
+            time.sleep(min(5, max(0.5, deadline - time.time())))
+        for folder in mkdirs:
+            os.makedirs(folder, exist_ok=True)
+        for source, target in copies:
+            copy_path(source, target, link=link)
+    finally:
+        lock.close()
+    return 0
+
+
+def stage_out(copies:list) -> int:
+    missing = [source for source, _ in copies if not os.path.exists(source)]
+    for source, target in copies:
+        if source not in missing:
+            copy_path(source, target)
+    for source in missing:
+        print(f'Выходной файл не найден: {source}', file=sys.stderr)
+    return 1 if missing else 0
+
+
+def cleanup(root:str) -> int:
+    shutil.rmtree(root, ignore_errors=True)
+    # Папки модуля и запуска удаляются вместе с последним образцом
+    for folder in [os.path.dirname(root), os.path.dirname(os.path.dirname(root))]:
+        try:
+            os.rmdir(folder)
+        except OSError:
+            break
+    return 0
+
+
+def main(argv:list) -> int:
+    parser = argparse.ArgumentParser(prog='staging.py')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_in = subparsers.add_parser('stage-in')
+    parser_in.add_argument('--scratch', required=True)
+    parser_in.add_argument('--need', type=int, default=0)
+    parser_in.add_argument('--min-free', type=int, default=0)
+    parser_in.add_argument('--slots', type=int, default=2)
+    parser_in.add_argument('--wait', type=float, default=600)
+    parser_in.add_argument('--link', action='store_true')
+    parser_in.add_argument('--mkdir', action='append', default=[])
+    parser_in.add_argument('--copy', nargs=2, action='append', default=[])
+    parser_out = subparsers.add_parser('stage-out')
+    parser_out.add_argument('--copy', nargs=2, action='append', default=[])
+    parser_cleanup = subparsers.add_parser('cleanup')
+    parser_cleanup.add_argument('root')
+    args = parser.parse_args(argv)
+    if args.command == 'stage-in':
+        return stage_in(scratch=args.scratch, need=args.need, min_free=args.min_free, slots=args.slots, wait=args.wait,
+                        link=args.link, mkdirs=args.mkdir, copies=args.copy)
+    if args.command == 'stage-out':
+        return stage_out(copies=args.copy)
+    return cleanup(root=args.root)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
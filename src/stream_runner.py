@@ -0,0 +1,342 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from src.module_runner import ModuleRunner
+from src.utils import (generate_sample_list, generate_sample_cmds, generate_commands, make_context, compile_module_templates,
+                       get_samples_in_dir, filter_samples, create_paths, save_yaml, interrupt_running_commands,
+                       get_input_size, get_samples_in_dir_tree)
+from src.watch import InputWatcher
+from src.temp_files import temp_paths
+
+
+class StreamRunner(ModuleRunner):
+    """
+    Потоковое выполнение цепочки модулей (каждый следующий модуль использует результаты предыдущего, см. module_before).
+    Образец, завершивший sample_level модуля A, сразу передаётся в sample_level модуля B, пока другие образцы ещё в A.
+    Стадии before_batch всех модулей цепочки выполняются до начала обработки образцов, after_batch модуля - после того, \
+        как все его образцы обработаны.
+    """
+    def run_chain(self, chain:list, result_dict:dict, watcher:InputWatcher=None) -> dict:
+        """
+        Выполняет цепочку модулей в потоковом режиме.
+
+        :param chain: Модули цепочки в порядке выполнения.
+        :param result_dict: Данные о результатах выполнения пайплайна.
+        :param watcher: Наблюдатель режима --watch: образцы первого модуля поступают по мере появления готовых входных \
+                        файлов, пока наблюдение не будет остановлено; after_batch модулей выполняется по запросу \
+                        и после остановки.
+        :return: Обновлённые данные о результатах выполнения пайплайна.
+        """
+        # Цвета!
+        BLUE = "\033[34m"
+        WHITE ="\033[37m"
+
+        print(f'Потоковый запуск модулей: {" -> ".join(chain)}')
+        plans = []
+        for i, module in enumerate(chain):
+            result_dict['modules'][module] = {'status': True, 'before_batch':{}, 'batch':{}, 'after_batch':{}}
+            plans.append(self.plan_module(module=module, upstream=chain[i-1] if i else '',
+                                          module_result_dict=result_dict['modules'][module]))
+        if not watcher:
+            head_samples = generate_sample_list(in_samples=self.include_samples, ex_samples=self.exclude_samples,
+                                                input_dir=plans[0]['input_dir'], extensions=plans[0]['extensions'],
+                                                subfolders=plans[0]['subfolders'], index=self.discovery)
+
+        # Барьеры before_batch: выполняются до начала потоковой обработки образцов
+        interruption = False
+        for plan in plans:
+            create_paths(list(plan['folders'].values()))
+            print(f'Module: {BLUE}{plan["module"]}{WHITE}')
+            unit_result, exit_codes, status, interruption = plan['executor'].run_unit(
+                                                module_stage='before_batch', cmds=plan['cmd_data']['before_batch'],
+                                                timeout_behavior=plan['timeout_behavior'])
+            plan['executor'].commit_stage(module_stage='before_batch', module_result_dict=plan['result'],
+                                          unit_result=unit_result, exit_codes=exit_codes, status=status)
+            if interruption:
+                return self.finish_chain(plans=plans, result_dict=result_dict)
+
+        resources = self.create_resource_pool()
+        # Пул потоков общий для цепочки; количество одновременно обрабатываемых образцов каждого модуля ограничено \
+        #   его max_parallel_samples (семафор модуля занимается до передачи образца в пул)
+        pool = ThreadPoolExecutor(max_workers=max(int(plan['max_parallel_samples']) for plan in plans))
+        futures = {}
+
+        def prepare_sample(idx:int, sample_path:str) -> str:
+            # Генерирует команды образца; возвращает имя образца либо None, если образец уже запланирован
+            plan = plans[idx]
+            sample_path = os.path.normpath(sample_path)
+            if sample_path in plan['scheduled']:
+                return None
+            plan['scheduled'].add(sample_path)
+            part_filenames = []
+            sample_filenames, cmds = generate_sample_cmds(context=plan['context'], sample=sample_path, folders=plan['folders'],
+                                                          filenames=plan['filenames'], commands=plan['commands'],
+                                                          cmd_list=plan['cmds_dict']['sample_level'], shards=plan['shards'],
+                                                          staging=plan['staging'], part_filenames=part_filenames,
+                                                          shards_folder=plan['shards_folder'])
+            sample = sample_filenames['basename']
+            plan['cmd_data']['batch'][sample] = cmds
+            plan['sample_filenames'][sample] = sample_filenames
+            plan['sources'][sample] = sample_path
+            plan['sample_sizes'][sample] = get_input_size(sample_path)
+            if self.temp_files.tracks(plan['module']):
+                self.temp_files.add_samples(module=plan['module'], samples={
+                    sample: (sample_path, temp_paths(plan['temp'], [sample_filenames] + part_filenames))})
+            return sample
+
+        def submit_sample(idx:int, sample:str):
+            plan = plans[idx]
+            plan['order'].append(sample)
+            plan['pending'] += 1
+            plan['waiting'].append(sample)
+            start_samples(idx)
+
+        def start_samples(idx:int):
+            # Ожидающие образцы модуля передаются в пул, пока у модуля есть свободные слоты
+            plan = plans[idx]
+            while plan['waiting'] and plan['slots'].acquire(blocking=False):
+                sample = plan['waiting'].popleft()
+                future = pool.submit(plan['executor'].run_unit, module_stage='batch', cmds=plan['cmd_data']['batch'][sample],
+                                     timeout_behavior=plan['timeout_behavior'], sample=sample, resources=resources,
+                                     parallel=True)
+                futures[future] = ('batch', idx, sample)
+
+        def feed_samples(idx:int, sample_paths:list):
+            samples = [sample for sample in (prepare_sample(idx, path) for path in sample_paths) if sample]
+            plan = plans[idx]
+            if plan['sample_order'] == 'cost':
+                samples = self.history.order_samples(module=plan['module'],
+                                                     sizes={sample: plan['sample_sizes'][sample] for sample in samples})
+            if plan['started']:
+                self.eta.add_samples(module=plan['module'], sample_sizes={sample: plan['sample_sizes'][sample] for sample in samples})
+            elif samples:
+                plan['started'] = True
+                self.eta.start_module(module=plan['module'], concurrency=int(plan['max_parallel_samples']),
+                                      sample_sizes={sample: plan['sample_sizes'][sample] for sample in samples})
+            for sample in samples:
+                submit_sample(idx, sample)
+
+        def check_finished(idx:int):
+            plan = plans[idx]
+            if plan['feeding'] or plan['pending'] or plan['finished']:
+                return
+            plan['finished'] = True
+            if idx + 1 < len(plans):
+                # Подбираем результаты, не объявленные в filenames образцов, и закрываем поступление образцов в следующий модуль
+                feed_samples(idx + 1, self.find_stream_inputs(plans[idx + 1]))
+                plans[idx + 1]['feeding'] = False
+                check_finished(idx + 1)
+            # Барьер after_batch: все образцы модуля обработаны
+            cmds = generate_commands(context=plan['context'], cmd_list=plan['cmds_dict']['after_batch'], commands=plan['commands'])
+            plan['cmd_data']['after_batch'] = cmds
+            future = pool.submit(plan['executor'].run_unit, module_stage='after_batch', cmds=cmds,
+                                 timeout_behavior=plan['timeout_behavior'], parallel=True,
+                                 label=f'{plan["module"]}/after_batch')
+            futures[future] = ('after_batch', idx, '')
+
+        def run_periodic_after_batch(idx:int):
+            # after_batch по запросу в режиме наблюдения; не запускается, пока выполняется предыдущий
+            plan = plans[idx]
+            if plan['finished'] or any(key == ('after_batch', idx, 'periodic') for key in futures.values()):
+                return
+            cmds = generate_commands(context=plan['context'], cmd_list=plan['cmds_dict']['after_batch'], commands=plan['commands'])
+            future = pool.submit(plan['executor'].run_unit, module_stage='after_batch', cmds=cmds,
+                                 timeout_behavior=plan['timeout_behavior'], parallel=True,
+                                 label=f'{plan["module"]}/after_batch')
+            futures[future] = ('after_batch', idx, 'periodic')
+
+        def watch_inputs():
+            # Новые готовые входные файлы передаются в первый модуль, запросы наблюдателя выполняются
+            nonlocal watcher
+            if watcher.stop_requested():
+                print('Наблюдение за входными данными остановлено, завершаем обработку поступивших образцов')
+                watcher = None
+                plans[0]['feeding'] = False
+                check_finished(0)
+                return
+            if watcher.scan_due():
+                feed_samples(0, watcher.ready(self.find_stream_inputs(plans[0])))
+            if watcher.after_batch_due():
+                for idx in range(len(plans)):
+                    run_periodic_after_batch(idx)
+
+        # Наблюдатель сохраняется и после остановки наблюдения: обработанные образцы записываются в его файл состояния
+        input_watcher = watcher
+        try:
+            if watcher:
+                print(f'Наблюдение за {plans[0]["input_dir"]}: новые образцы обрабатываются по мере поступления')
+                plans[0]['feeding'] = True
+                watcher.install_signals()
+            else:
+                # Первый модуль цепочки получает все образцы сразу; они упорядочиваются так же, как в ModuleRunner
+                feed_samples(0, head_samples)
+                plans[0]['feeding'] = False
+                check_finished(0)
+
+            while (futures or watcher) and not interruption:
+                if watcher:
+                    watch_inputs()
+                    if not futures:
+                        time.sleep(min(1, watcher.poll) if watcher else 0)
+                        continue
+                done, _ = wait(list(futures), timeout=min(1, watcher.poll) if watcher else None,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, idx, sample = futures.pop(future)
+                    interruption = self.commit_unit(plan=plans[idx], stage=stage, sample=sample,
+                                                    run_result=future.result()) or interruption
+                    if stage != 'batch':
+                        continue
+                    plans[idx]['pending'] -= 1
+                    plans[idx]['slots'].release()
+                    if not interruption:
+                        start_samples(idx)
+                    if input_watcher and idx == 0 and plans[0]['result']['batch'][sample]['status']:
+                        input_watcher.mark_processed(plans[0]['sources'][sample])
+                    # Успешно обработанный образец сразу передаётся в следующий модуль
+                    if not interruption and idx + 1 < len(plans) and plans[idx]['result']['batch'][sample]['status']:
+                        feed_samples(idx + 1, self.sample_stream_inputs(plan=plans[idx + 1],
+                                                                        sample_filenames=plans[idx]['sample_filenames'][sample]))
+                    if not interruption:
+                        check_finished(idx)
+        except KeyboardInterrupt:
+            print('INTERRUPTED')
+            interruption = True
+        finally:
+            if input_watcher:
+                input_watcher.restore_signals()
+        if interruption:
+            interrupt_running_commands()
+        pool.shutdown(wait=True, cancel_futures=True)
+        # Фиксируем результаты, успевшие завершиться после прерывания
+        for future, (stage, idx, sample) in futures.items():
+            if future.done() and not future.cancelled():
+                self.commit_unit(plan=plans[idx], stage=stage, sample=sample, run_result=future.result())
+        return self.finish_chain(plans=plans, result_dict=result_dict)
+
+
+    def plan_module(self, module:str, upstream:str, module_result_dict:dict) -> dict:
+        """
+        Загружает модуль и подготавливает всё, что нужно для генерации и выполнения его команд по мере поступления образцов.
+
+        :param module: Название модуля.
+        :param upstream: Модуль, результаты которого являются входными данными (пустая строка для первого модуля цепочки).
+        :param module_result_dict: Данные о результатах выполнения модуля.
+        """
+        self.reset_module_options()
+        self.load_module(data=self.modules_template[module], input_dir=self.input_dir, output_dir=self.output_dir)
+        # Папка входных данных определяется так же, как в ModuleRunner.run_module
+        if self.module_before in self.modules:
+            self.input_dir = f'{self.output_dir}/{self.modules_template[self.module_before]["result_dir"]}'
+            self.subfolders = False
+        filenames, commands = compile_module_templates(filenames=self.filenames, commands=self.cmds_template,
+                                                       cmds_dict=self.commands, depends_on=self.depends_on, shards=self.shards)
+        self.register_temp_files(module)
+        context = make_context(args=self.__dict__, folders=self.folders, executables=self.executables)
+        cmd_data = {'before_batch': generate_commands(context=context, cmd_list=self.commands['before_batch'], commands=commands),
+                    'batch': {}, 'after_batch': {}}
+        sample_sizes = {}
+        return {'module': module,
+                'folders': self.folders,
+                'filenames': filenames,
+                'commands': commands,
+                'cmds_dict': self.commands,
+                'context': context,
+                'extensions': self.source_extensions,
+                'input_dir': self.input_dir,
+                'subfolders': self.subfolders,
+                'timeout_behavior': self.timeout_behavior,
+                'max_parallel_samples': self.max_parallel_samples,
+                'sample_order': self.sample_order,
+                'shards': self.shards,
+                'shards_folder': self.shards_folder(module),
+                'staging': self.module_staging(module),
+                'temp': list(self.temp),
+                'executor': self.create_executor(module=module, cmd_data=cmd_data, sample_sizes=sample_sizes),
+                'cmd_data': cmd_data,
+                'result': module_result_dict,
+                # Пути входных файлов, для которых уже сгенерированы команды
+                'scheduled': set(),
+                'sample_filenames': {},
+                # Входные файлы образцов {имя образца: путь}
+                'sources': {},
+                'sample_sizes': sample_sizes,
+                'order': [],
+                # Образцы, переданные в модуль и ещё не обработанные (включая ожидающие свободного слота)
+                'pending': 0,
+                'waiting': deque(),
+                'slots': threading.Semaphore(max(1, int(self.max_parallel_samples))),
+                # Пока предыдущий модуль обрабатывает образцы, в модуль могут поступать новые
+                'feeding': bool(upstream),
+                'finished': False,
+                # Модуль получил первые образцы (учтён в оценке времени как выполняющийся)
+                'started': False}
+
+
+    def sample_stream_inputs(self, plan:dict, sample_filenames:dict) -> list:
+        """
+        Возвращает входные файлы модуля, созданные образцом предыдущего модуля: файлы из его filenames, \
+            лежащие в папке входных данных модуля и имеющие подходящее расширение.
+        """
+        input_dir = os.path.normpath(plan['input_dir'])
+        candidates = [path for path in sample_filenames.values()
+                      if isinstance(path, str) and os.path.normpath(os.path.dirname(path)) == input_dir
+                      and path.endswith(plan['extensions']) and os.path.isfile(path)]
+        return filter_samples(samples=candidates, in_samples=self.include_samples, ex_samples=self.exclude_samples)
+
+
+    def find_stream_inputs(self, plan:dict) -> list:
+        """
+        Возвращает все входные файлы модуля в папке входных данных (для следующих модулей цепочки - \
+            в папке результатов предыдущего модуля).
+        """
+        if not os.path.isdir(plan['input_dir']):
+            return []
+        if self.discovery:
+            samples = self.discovery.find_samples(dir=plan['input_dir'], extensions=plan['extensions'],
+                                                  subfolders=plan['subfolders'])
+        elif plan['subfolders']:
+            samples = get_samples_in_dir_tree(dir=plan['input_dir'], extensions=plan['extensions'])
+        else:
+            samples = get_samples_in_dir(dir=plan['input_dir'], extensions=plan['extensions'])
+        return filter_samples(samples=samples, in_samples=self.include_samples, ex_samples=self.exclude_samples)
+
+
+    def commit_unit(self, plan:dict, stage:str, sample:str, run_result:tuple) -> bool:
+        """
+        Фиксирует результаты выполнения образца либо стадии after_batch модуля цепочки.
+
+        :return: Флаг прерывания.
+        """
+        unit_result, exit_codes, status, interruption = run_result
+        if stage == 'batch':
+            plan['executor'].commit_sample(module_stage='batch', sample=sample, module_result_dict=plan['result'],
+                                           unit_result=unit_result, exit_codes=exit_codes)
+            self.eta.sample_done(module=plan['module'], sample=sample, unit_result=unit_result)
+            done = len(plan['result']['batch'])
+            total = f'{len(plan["order"])}' + ('+' if plan['feeding'] else '')
+            print(f'{plan["module"]}: {self.eta.format_progress(module=plan["module"], done=done, total=total)}\n', end='')
+        else:
+            plan['executor'].commit_stage(module_stage=stage, module_result_dict=plan['result'],
+                                          unit_result=unit_result, exit_codes=exit_codes, status=status,
+                                          periodic=bool(sample))
+            # after_batch по запросу в режиме наблюдения (sample == 'periodic') не завершает модуль
+            if stage == 'after_batch' and not sample:
+                self.eta.finish_module(plan['module'])
+        return interruption
+
+
+    def finish_chain(self, plans:list, result_dict:dict) -> dict:
+        """
+        Упорядочивает результаты образцов в порядке их поступления, сохраняет сгенерированные команды и статусы модулей.
+        """
+        for plan in plans:
+            batch = plan['result']['batch']
+            plan['result']['batch'] = {sample: batch[sample] for sample in plan['order'] if sample in batch}
+            plan['executor'].commit_module(plan['result'])
+            save_yaml(f'cmd_data_{plan["module"]}', self.log_dir, plan['cmd_data'])
+            if not plan['result']['status']:
+                result_dict['status'] = False
+        return result_dict
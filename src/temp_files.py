@@ -0,0 +1,156 @@
+import os
+import shutil
+import threading
+from src.utils import get_input_size, format_size
+
+
+class TempFiles:
+    """
+    Удаление временных файлов образцов (ключи filenames, перечисленные в temp модуля) сразу после того, \
+        как они перестают быть нужны.
+    Файл удаляется, когда все команды образца выполнены успешно, а если файл - входные данные следующих модулей \
+        запуска (лежит в result_dir модуля и подходит под source_extensions модуля, для которого он module_before), \
+        то когда и эти модули успешно обработали его как образец. При ошибке файл сохраняется для отладки.
+    Если у модуля есть команды after_batch, его временные файлы по умолчанию удаляются только после их успешного \
+        выполнения (опция temp_after_batch модуля; false - сразу, если after_batch не читает временные файлы).
+    Модули, не связанные через module_before, не должны читать временные файлы.
+    Освобождённый объём записывается в журнал выполнения (записи типа cleanup).
+    """
+    def __init__(self, log_sink):
+        """
+        :param log_sink: Журнал выполнения (см. src.log_sink).
+        """
+        self.log_sink = log_sink
+        # Модули с временными файлами: {модуль: [(следующий модуль, папка результатов, расширения образцов)]}
+        self.consumers = {}
+        # Образцы: {модуль: {образец: (путь к входным данным образца, [временные файлы])}}
+        self.samples = {}
+        # Файлы, ожидающие обработки следующими модулями: {путь: (модуль файла, {модули})}
+        self.pending = {}
+        # Модули, временные файлы которых нужны их командам after_batch, и отложенные до after_batch файлы:
+        #   {модуль: [(образец, путь)]}
+        self.deferred = {}
+        self.freed_bytes = 0
+        self.lock = threading.Lock()
+
+    def add_module(self, module:str, consumers:list, after_batch:bool=False):
+        """
+        Регистрирует модуль с временными файлами.
+
+        :param consumers: Следующие модули запуска, получающие образцы из result_dir модуля: \
+                          [(модуль, папка результатов модуля, расширения образцов)].
+        :param after_batch: Временные файлы нужны командам after_batch модуля: удаляются после их успешного \
+                            выполнения (см. after_batch_done).
+        """
+        with self.lock:
+            self.consumers[module] = [(consumer, os.path.normpath(folder), tuple(extensions))
+                                      for consumer, folder, extensions in consumers]
+            if after_batch:
+                self.deferred.setdefault(module, [])
+
+    def tracks(self, module:str) -> bool:
+        """
+        Проверяет, нужно ли учитывать образцы модуля: у модуля есть временные файлы либо он обрабатывает \
+            временные файлы предыдущего модуля.
+        """
+        return module in self.consumers or \
+            any(consumer == module for consumers in self.consumers.values() for consumer, _, _ in consumers)
+
+    def add_samples(self, module:str, samples:dict):
+        """
+        Добавляет образцы модуля.
+
+        :param samples: {образец: (путь к входным данным образца, [временные файлы])}.
+        """
+        with self.lock:
+            self.samples.setdefault(module, {}).update(
+                {sample: (os.path.normpath(source), [os.path.normpath(path) for path in paths])
+                 for sample, (source, paths) in samples.items()})
+
+    def sample_done(self, module:str, sample:str, success:bool, section:str=''):
+        """
+        Учитывает обработанный образец: удаляет его временные файлы, не нужные следующим модулям, и временные \
+            файлы предыдущего модуля, входные данные образца, если их обработали все следующие модули.
+
+        :param success: Все команды образца выполнены успешно.
+        :param section: Раздел логов модуля.
+        """
+        if not success or sample not in self.samples.get(module, {}):
+            return
+        removable = []
+        with self.lock:
+            source, paths = self.samples[module][sample]
+            owner, waiting = self.pending.get(source, (None, None))
+            if waiting is not None:
+                waiting.discard(module)
+                if not waiting:
+                    del self.pending[source]
+                    removable.append((owner, source))
+            for path in paths:
+                consumers = {consumer for consumer, folder, extensions in self.consumers.get(module, [])
+                             if os.path.dirname(path) == folder and path.endswith(extensions)}
+                if consumers:
+                    self.pending[path] = (module, consumers)
+                else:
+                    removable.append((module, path))
+            # Файлы модулей, команды after_batch которых ещё не выполнены, откладываются до них
+            for owner, path in removable:
+                if owner in self.deferred:
+                    self.deferred[owner].append((sample, path))
+            removable = [path for owner, path in removable if owner not in self.deferred]
+        self.remove(module=module, sample=sample, paths=removable, section=section)
+
+    def after_batch_done(self, module:str, success:bool, section:str=''):
+        """
+        Учитывает выполненную стадию after_batch модуля: удаляет отложенные до неё временные файлы, \
+            если стадия выполнена успешно; иначе файлы модуля (в том числе ещё не обработанные следующими модулями) \
+            сохраняются для отладки.
+        """
+        if not success:
+            return
+        with self.lock:
+            deferred = self.deferred.pop(module, None)
+        if not deferred:
+            return
+        samples = {}
+        for sample, path in deferred:
+            samples.setdefault(sample, []).append(path)
+        for sample, paths in samples.items():
+            self.remove(module=module, sample=sample, paths=paths, section=section)
+
+    def remove(self, module:str, sample:str, paths:list, section:str=''):
+        """
+        Удаляет файлы и записывает освобождённый объём в журнал.
+        """
+        removed = {}
+        for path in paths:
+            if not os.path.lexists(path):
+                continue
+            size = get_input_size(path)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                print(f'\t\t\tНе удалось удалить временный файл {path}: {e}\n', end='')
+                continue
+            removed[path] = size
+        if not removed:
+            return
+        freed = sum(removed.values())
+        with self.lock:
+            self.freed_bytes += freed
+        self.log_sink.write({'type': 'cleanup', 'section': section, 'module': module, 'sample': sample,
+                             'files': removed, 'freed_bytes': freed})
+        print(f'\t\t\t{sample}: удалено временных файлов: {len(removed)}, освобождено {format_size(freed)}\n', end='')
+
+
+def temp_paths(keys:list, filenames:list) -> list:
+    """
+    Пути временных файлов образца (ключи keys) по filenames образца целиком и его частей, без повторов.
+    """
+    paths = {}
+    for sample_filenames in filenames:
+        paths.update({sample_filenames[key]: None for key in keys if key in sample_filenames})
+    return list(paths)
@@ -0,0 +1,111 @@
+from types import CodeType
+
+
+class Template:
+    """
+    Инструкция из filenames/cmds_template, скомпилированная один раз на модуль.
+    Подстановка значений для образца - вызов eval() над готовым объектом кода, без повторного разбора строки.
+    """
+    __slots__ = ('source', 'code')
+
+    def __init__(self, source:str, code:CodeType=None):
+        """
+        :param source: Исходный текст инструкции (для сообщений об ошибках).
+        :param code: Скомпилированное выражение; None - инструкция является обычной строкой и подставляется как есть.
+        """
+        self.source = source
+        self.code = code
+
+    def render(self, context:dict):
+        """
+        Вычисляет инструкцию в указанном контексте.
+        """
+        if self.code is None:
+            return self.source
+        return eval(self.code, context)
+
+
+def compile_expression(instruction, always:bool=False, name:str='<template>'):
+    """
+    Компилирует инструкцию в Template.
+
+    :param instruction: Инструкция (строка). Уже скомпилированные инструкции и нестроковые значения возвращаются без изменений.
+    :param always: Компилировать любую строку как выражение Python (filenames); иначе компилируются только f-строки.
+    :param name: Имя инструкции, отображаемое в трассировке ошибок.
+    """
+    if not isinstance(instruction, str):
+        return instruction
+    if always:
+        # Заменяем {{ и }} на { и }
+        source = instruction.replace('{{', '{').replace('}}', '}')
+        return Template(instruction, compile(source, name, 'eval'))
+    if instruction.startswith(("f'", 'f"')):
+        return Template(instruction, compile(instruction, name, 'eval'))
+    return Template(instruction)
+
+
+def compile_filenames(filenames:dict) -> dict:
+    """
+    Компилирует инструкции filenames модуля.
+
+    :return: Словарь {ключ: Template}.
+    """
+    return {key: compile_expression(instruction, always=True, name=f'<filenames:{key}>')
+            for key, instruction in filenames.items()}
+
+
+def compile_commands(commands:dict, cmd_list:list) -> dict:
+    """
+    Компилирует инструкции команд из cmds_template, сохраняя форму записи (строка, [таймаут, строка] либо словарь).
+
+    :param commands: Шаблоны команд.
+    :param cmd_list: Названия команд, которые нужно скомпилировать.
+    :return: Словарь {название: инструкция}, где строки заменены на Template.
+    """
+    return {key: compile_command(commands[key], name=f'<cmds_template:{key}>') for key in cmd_list}
+
+
+def compile_command(cmd_instructions, name:str='<template>'):
+    """
+    Компилирует инструкцию одной команды. Уже скомпилированная инструкция возвращается без изменений.
+    """
+    if type(cmd_instructions) == list:
+        if isinstance(cmd_instructions[1], Template):
+            return cmd_instructions
+        return [cmd_instructions[0], compile_expression(cmd_instructions[1], name=name)]
+    if type(cmd_instructions) == dict:
+        if isinstance(cmd_instructions['cmd'], Template):
+            return cmd_instructions
+        compiled = dict(cmd_instructions)
+        compiled['cmd'] = compile_expression(cmd_instructions['cmd'], name=name)
+        for opt in ['threads', 'memory', 'disk']:
+            if opt in compiled:
+                compiled[opt] = compile_expression(compiled[opt], name=name)
+        for files_key in ['inputs', 'outputs']:
+            if compiled.get(files_key):
+                compiled[files_key] = [compile_expression(item, name=name) for item in compiled[files_key]]
+        return compiled
+    return compile_expression(cmd_instructions, name=name)
+
+
+def set_dependencies(cmd_instructions, depends_on:list) -> dict:
+    """
+    Возвращает инструкцию команды в виде словаря с указанными зависимостями (depends_on). Исходная инструкция не изменяется.
+    """
+    if type(cmd_instructions) == list:
+        compiled = {'timeout': cmd_instructions[0], 'cmd': cmd_instructions[1]}
+    elif type(cmd_instructions) == dict:
+        compiled = dict(cmd_instructions)
+    else:
+        compiled = {'cmd': cmd_instructions}
+    compiled['depends_on'] = list(depends_on or [])
+    return compiled
+
+
+def render(value, context:dict):
+    """
+    Вычисляет значение, если это Template, иначе возвращает его без изменений.
+    """
+    if isinstance(value, Template):
+        return value.render(context)
+    return value
@@ -1,8 +1,46 @@
 import yaml
+import json
 import os
 import time
 from datetime import datetime
+import shutil
 import subprocess
+import select
+import signal
+import tempfile
+import threading
+import contextvars
+import re
+import fnmatch
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from src.templates import compile_command, compile_commands, compile_expression, compile_filenames, render, set_dependencies
+from src.sharding import SHARD_MODES, whole_shard, plan_shards, read_regions, split_records_cmd, remove_shards_cmd
+from src.staging import plan_staging, stage_in_cmd, stage_out_cmd, cleanup_cmd
+
+# Загрузчик и генератор YAML на libyaml, если PyYAML собран с ним (в разы быстрее реализации на Python)
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YamlDumper = getattr(yaml, 'CDumper', yaml.Dumper)
+
+# Флаг прерывания пайплайна, общий для всех потоков, выполняющих команды
+INTERRUPT_EVENT = threading.Event()
+# Запущенные в данный момент процессы (нужны для их остановки при прерывании из главного потока)
+RUNNING_PROCESSES = set()
+RUNNING_PROCESSES_LOCK = threading.Lock()
+# Область выполнения команд (threading.Event; например, задача рабочего очереди): команды области можно остановить, \
+#   не прерывая остальные (см. interrupt_scope)
+CMD_SCOPE = contextvars.ContextVar('cmd_scope', default=None)
+
+
+class DiskSpaceError(RuntimeError):
+    """
+    Объём, объявленный образцом либо командой, не помещается на файловую систему, и место не может освободиться \
+        за счёт завершения других образцов пайплайна (см. DiskAdmission).
+    """
+# Поля лога команды с затраченными ресурсами (см. get_resource_usage)
+RESOURCE_FIELDS = ['user_cpu_sec', 'system_cpu_sec', 'max_rss_bytes', 'read_bytes', 'write_bytes',
+                   'voluntary_ctx_switches', 'involuntary_ctx_switches']
 
 def load_yaml(file_path:str, critical:bool = False, subsection:str = ''):
     """
@@ -20,7 +58,7 @@ def load_yaml(file_path:str, critical:bool = False, subsection:str = ''):
     # Открываем YAML-файл для чтения
     try:
         with open(file_path, 'r') as file:
-            data = yaml.safe_load(file)  # Загружаем содержимое файла в словарь с помощью safe_load
+            data = yaml.load(file, Loader=YamlLoader)  # Загружаем содержимое файла в словарь безопасным загрузчиком
         
         # Если subsection не указан, возвращаем весь YAML-файл
         if subsection == '':
@@ -51,63 +89,58 @@ def save_yaml(filename, path, data):
 
     # Записываем данные в YAML-файл
     with open(file_path, 'w') as yaml_file:
-        yaml.dump(data, yaml_file, default_flow_style=False, sort_keys=False)
-
-
-def update_yaml(file_path: str, new_data: dict):
-    """
-    Обновляет YAML-файл, считывая и перезаписывая его новыми данными
-    :param file_path: путь к файлу в виде строки
-    :param new_data: данные в виде словаря
-    """
-    # Шаг 1: Загрузить текущие данные из YAML
-    try:
-        with open(file_path, 'r') as file:
-            current_data = yaml.safe_load(file) or {}
-    except FileNotFoundError:
-        current_data = {}  # Если файл не найден, создаём пустой словарь
-
-    # Шаг 2: Обновить значения существующих ключей
-    for key, value in new_data.items():
-        if key in current_data:
-            current_data[key].update(value)  # Обновляем только значения
-        else:
-            current_data[key] = value  # Добавляем новый ключ, если его нет
-
-    # Шаг 3: Записать обновлённые данные обратно в YAML
-    with open(file_path, 'w') as file:
-        yaml.dump(current_data, file, default_flow_style=False)
+        yaml.dump(data, yaml_file, Dumper=YamlDumper, default_flow_style=False, sort_keys=False)
 
 
-def load_templates(path: str, required_files:list) -> dict:
+def load_templates(path: str, required_files:list, cache=None) -> dict:
     """
     Загружает конфигурационные файлы из указанной директории.
     Выдаёт ошибку в случае отсутствия файла или проблем с его загрузкой.
 
     :param path: Путь к директории, где хранятся конфигурационные YAML-файлы.
     :param required_files: Конфигурационные YAML-файлы.
+    :param cache: Кэш (PlanCache); если содержимое файлов не изменилось, шаблоны загружаются из него без разбора YAML.
     """
     loaded_configs = {}
+    file_paths = [os.path.join(path, f'{req_file}.yaml') for req_file in required_files]
 
     # Проходим по списку обязательных файлов
-    for req_file in required_files:
-        file_path = os.path.join(path, f'{req_file}.yaml')
-        
+    for req_file, file_path in zip(required_files, file_paths):
         # Проверяем наличие файла
         if not os.path.isfile(file_path):
             raise FileNotFoundError(f"Файл {req_file}.yaml не найден в директории {path}")
-        
+
+    key = cache.file_digest(file_paths) if cache else None
+    name = f'templates-{"-".join(required_files)}'
+    cached = cache.load(name=name, key=key) if cache else None
+    if cached is not None:
+        return cached
+
+    for req_file, file_path in zip(required_files, file_paths):
         # Пытаемся загрузить файл
         try:
             with open(file_path, 'r') as f:
-                loaded_configs[req_file] = yaml.safe_load(f)  # Загружаем содержимое файла
+                loaded_configs[req_file] = yaml.load(f, Loader=YamlLoader)  # Загружаем содержимое файла
         except yaml.YAMLError as e:
             raise ValueError(f"Ошибка загрузки файла {req_file}.yaml: {e}")
-    
+    if cache:
+        cache.store(name=name, key=key, value=loaded_configs)
+
     # Возвращаем загруженные конфигурации
-    return loaded_configs    
+    return loaded_configs
 
         
+def write_json_atomic(file_path:str, data):
+    """
+    Записывает данные в JSON-файл атомарно: через временный файл в той же папке и переименование, \
+        поэтому читатели (в том числе на других узлах общей файловой системы) не видят частично записанный файл.
+    """
+    tmp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, file_path)
+
+
 def get_paths(folders: dict, input_dir: str, output_dir: str) -> dict:
     """
     Создаёт словарь с путями для всех директорий, указанных в словаре 'folders',
@@ -135,7 +168,8 @@ def get_paths(folders: dict, input_dir: str, output_dir: str) -> dict:
 def generate_cmd_data(args:dict, folders:dict,
                         executables:dict, 
                         filenames:dict, commands:dict,
-                        cmds_dict:dict, samples:list):
+                        cmds_dict:dict, samples:list, depends_on:dict=None, sources:dict=None, shards:dict=None,
+                        staging:dict=None, read_files:set=None, part_filenames:dict=None, shards_folder:str=''):
     """
     Генерирует команды для каждого образца на основе аргументов, файлов и шаблонов команд.
     
@@ -146,15 +180,21 @@ def generate_cmd_data(args:dict, folders:dict,
     :param commands: Шаблоны команд для выполнения.
     :param cmds_dict: Список команд, которые нужно сгенерировать.
     :param samples: Список образцов для обработки.
+    :param depends_on: Зависимости команд, заданные в шаблоне модуля.
+    :param sources: Если указан, заполняется путями к файлам образцов: {имя образца: путь}.
+    :param shards: Настройки разбиения образцов на части (см. generate_sharded_cmds).
+    :param staging: Настройки размещения образцов на локальном диске узла (см. src.staging.staging_options).
+    :param read_files: Если указан, заполняется путями к файлам, прочитанным при генерации команд (например, regions_file).
+    :param part_filenames: Если указан, заполняется файлами частей разбитых образцов: {имя образца: [filenames частей]}.
+    :param shards_folder: Папка файлов частей модуля (см. generate_sample_cmds).
     :return: Словарь с командами для каждого образца.
     """
     # Объединяем все переменные в один словарь для подстановки в eval()
-    context = {
-            'programms': executables,
-            'folders': folders,
-            'args': args,
-            'os': os  # Добавляем os в контекст, чтобы os.path был доступен
-        }
+    context = make_context(args=args, folders=folders, executables=executables)
+
+    # Компилируем шаблоны файлов и команд один раз на модуль; для образцов выполняется только подстановка значений
+    filenames, commands = compile_module_templates(filenames=filenames, commands=commands, cmds_dict=cmds_dict,
+                                                   depends_on=depends_on, shards=shards)
 
     cmd_data = {}
     # Создаём набор команд, которые выполнятся однократно перед прогоном по образцам
@@ -162,16 +202,17 @@ def generate_cmd_data(args:dict, folders:dict,
     # Создаём набор команд для каждого образца
     cmd_data['batch'] = {}
     for sample in samples:
-        sample = sample.replace('//', '/')
-        # Генерируем файлы для конкретного образца
-        sample_filenames = generate_sample_filenames(sample=sample, folders=folders, filenames=filenames)
-        # Объединяем все переменные в один словарь для подстановки в eval()
-        context['filenames'] = sample_filenames
-        # Генерируем команды для образцов на основе аргументов, файлов и шаблонов команд
-        cmds = generate_commands(context=context, cmd_list=cmds_dict['sample_level'], commands=commands)
-        
+        parts = [] if part_filenames is not None else None
+        sample_filenames, cmds = generate_sample_cmds(context=context, sample=sample, folders=folders, filenames=filenames,
+                                                      commands=commands, cmd_list=cmds_dict['sample_level'], shards=shards,
+                                                      staging=staging, read_files=read_files, part_filenames=parts,
+                                                      shards_folder=shards_folder)
         # Добавляем сгенерированные команды в словарь для текущего образца
         cmd_data['batch'][sample_filenames['basename']] = cmds
+        if sources is not None:
+            sources[sample_filenames['basename']] = sample
+        if parts:
+            part_filenames[sample_filenames['basename']] = parts
 
     # Создаём набор команд, которые выполнятся однократно после прогона по образцам
     cmd_data['after_batch'] = generate_commands(context=context, cmd_list=cmds_dict['after_batch'], commands=commands)
@@ -179,8 +220,240 @@ def generate_cmd_data(args:dict, folders:dict,
     return cmd_data
 
 
+def make_context(args:dict, folders:dict, executables:dict) -> dict:
+    """
+    Создаёт контекст подстановки значений в шаблоны команд модуля.
+    """
+    return {
+            'programms': executables,
+            'folders': folders,
+            'args': args,
+            'os': os  # Добавляем os в контекст, чтобы os.path был доступен
+        }
+
+
+def compile_module_templates(filenames:dict, commands:dict, cmds_dict:dict, depends_on:dict=None,
+                             shards:dict=None) -> tuple:
+    """
+    Компилирует шаблоны файлов и команд модуля. При синтаксической ошибке в шаблоне либо ошибке \
+        в зависимостях команд или настройках разбиения образцов завершает программу.
+
+    :param depends_on: Зависимости команд, заданные в шаблоне модуля: {название: [команды]}; \
+                       переопределяют depends_on из cmds_template.
+    :param shards: Настройки разбиения образцов на части; команды split и gather компилируются вместе с остальными.
+    :return: Кортеж (скомпилированные filenames, скомпилированные команды).
+    """
+    shard_cmds = [shards[key] for key in ['split', 'gather'] if shards and shards.get(key)]
+    if shards:
+        if shards.get('by', 'records') not in SHARD_MODES:
+            print(f"Ошибка в настройках shards: by должен быть одним из {', '.join(SHARD_MODES)}")
+            exit(code=1)
+        for key in shard_cmds:
+            if key not in commands:
+                print(f"Ошибка в настройках shards: команды {key} нет в cmds_template")
+                exit(code=1)
+    try:
+        filenames = compile_filenames(filenames)
+        commands = compile_commands(commands, [key for cmd_list in cmds_dict.values() for key in cmd_list] + shard_cmds)
+    except SyntaxError as e:
+        print(f"Ошибка в шаблоне {e.filename}: {e}")
+        exit(code=1)
+    for key, dependencies in (depends_on or {}).items():
+        if key in commands:
+            commands[key] = set_dependencies(commands[key], dependencies)
+    errors = 0
+    for stage, cmd_list in cmds_dict.items():
+        for i, key in enumerate(cmd_list):
+            dependencies = commands[key].get('depends_on') or [] if type(commands[key]) == dict else []
+            # Зависимости указываются только на команды той же стадии, перечисленные раньше, поэтому циклы невозможны
+            for dependency in dependencies:
+                if dependency not in cmd_list[:i]:
+                    print(f"Ошибка в зависимостях команды {key} ({stage}): команда {dependency} должна быть указана раньше")
+                    errors += 1
+    if errors > 0:
+        exit(code=1)
+    return (filenames, commands)
+
+
+def generate_sample_cmds(context:dict, sample:str, folders:dict, filenames:dict, commands:dict, cmd_list:list,
+                         shards:dict=None, staging:dict=None, read_files:set=None, part_filenames:list=None,
+                         shards_folder:str='') -> tuple:
+    """
+    Генерирует файлы и команды одного образца.
+
+    :param context: Контекст подстановки значений (см. make_context); ключи 'filenames', 'shard' и 'shards' перезаписываются.
+    :param sample: Путь к файлу образца.
+    :param shards: Настройки разбиения образца на части (см. generate_sharded_cmds).
+    :param staging: Настройки размещения образца на локальном диске узла (см. add_staging_cmds).
+    :param read_files: Если указан, заполняется путями к прочитанным файлам (см. generate_cmd_data).
+    :param part_filenames: Если указан, дополняется файлами частей образца, если образец разбит на части.
+    :param shards_folder: Папка файлов частей, если в shards не указана папка модуля (по умолчанию <output_dir>/shards); \
+                          для образца, размещённого на scratch, - папка shards в папке образца.
+    :return: Кортеж (файлы образца, команды образца). Файлы образца - итоговые пути, без учёта размещения на scratch.
+    """
+    sample = sample.replace('//', '/')
+    # Генерируем файлы для конкретного образца
+    sample_filenames = generate_sample_filenames(sample=sample, folders=folders, filenames=filenames)
+    # Команды образца, размещённого на scratch, получают пути на scratch
+    stage = plan_staging(sample=sample, folders=folders, options=staging) if staging else None
+    work_sample, work_folders = (stage['sample'], stage['folders']) if stage else (sample, folders)
+    work_filenames = generate_sample_filenames(sample=work_sample, folders=work_folders, filenames=filenames) \
+        if stage else sample_filenames
+    # Объединяем все переменные в один словарь для подстановки в eval()
+    context['folders'] = work_folders
+    context['filenames'] = work_filenames
+    context['shard'] = whole_shard(work_sample)
+    context['shards'] = []
+    parts = []
+    if shards:
+        shards_folder = os.path.join(stage['root'], 'shards') if stage else \
+            shards_folder or os.path.join(context['args']['output_dir'], 'shards')
+        parts = plan_sample_shards(context=context, sample=sample, shards=shards, folder=shards_folder,
+                                   read_files=read_files)
+        for shard in parts:
+            if shard['input'] == sample:
+                shard['input'] = work_sample
+    if len(parts) > 1:
+        cmds = generate_sharded_cmds(context=context, sample=work_sample, folders=work_folders, filenames=filenames,
+                                     commands=commands, cmd_list=cmd_list, shards=shards, parts=parts)
+        if part_filenames is not None:
+            part_filenames.extend(shard['filenames'] for shard in parts)
+    else:
+        # Генерируем команды для образцов на основе аргументов, файлов и шаблонов команд
+        cmds = generate_commands(context=context, cmd_list=cmd_list, commands=commands)
+    context['folders'] = folders
+    if stage:
+        cmds = add_staging_cmds(cmds=cmds, stage=stage, staging=staging, sample=sample,
+                                sample_filenames=sample_filenames, work_filenames=work_filenames)
+    return (sample_filenames, cmds)
+
+
+def add_staging_cmds(cmds:dict, stage:dict, staging:dict, sample:str, sample_filenames:dict, work_filenames:dict) -> dict:
+    """
+    Дополняет команды образца размещением на scratch (см. src.staging): stage_in выполняется перед командами, \
+        не зависящими от других, stage_out - после всех команд, cleanup - после успешного stage_out. Папка образца, \
+        команды которого завершились с ошибкой либо были прерваны, остаётся на scratch: возобновлённый запуск \
+        (--resume) пропускает выполненные команды, и их промежуточные файлы должны оставаться на месте.
+    Команды образца не кэшируются (опция cache отключается): файлы на scratch удаляются после выполнения, \
+        поэтому результат не может быть найден в кэше в следующих запусках.
+
+    :param stage: Размещение образца (см. src.staging.plan_staging).
+    :param sample_filenames: Итоговые файлы образца.
+    :param work_filenames: Файлы образца на scratch; объявленные в staging.outputs копируются в итоговые пути.
+    :return: Команды образца в виде графа зависимостей.
+    """
+    options = dict(staging, min_free=parse_size(staging['min_free']))
+    inputs = [(sample, stage['sample'])] if stage['sample'] != sample else []
+    outputs = [(work_filenames[key], sample_filenames[key]) for key in staging['outputs']
+               if key in work_filenames and work_filenames[key] != sample_filenames[key]]
+    dependencies = get_cmd_dependencies(cmds)
+    required = {dep for deps in dependencies.values() for dep in deps}
+    staged = {'stage_in': [stage_in_cmd(plan=stage, options=options, inputs=inputs,
+                                        need=get_input_size(sample) if inputs else 0), 0, {'depends_on': []}]}
+    for title, cmd_opts in cmds.items():
+        cmd_options = cmd_opts[2] if len(cmd_opts) > 2 else {}
+        staged[title] = [cmd_opts[0], cmd_opts[1],
+                         dict(cmd_options, depends_on=dependencies[title] or ['stage_in'], cache=False)]
+    staged['stage_out'] = [stage_out_cmd(outputs=outputs), 0,
+                           {'depends_on': [title for title in cmds if title not in required] or ['stage_in']}]
+    if not staging['keep']:
+        staged['cleanup'] = [cleanup_cmd(plan=stage), 0, {'depends_on': ['stage_out']}]
+    return staged
+
+
+def plan_sample_shards(context:dict, sample:str, shards:dict, folder:str, read_files:set=None) -> list:
+    """
+    Описывает части образца по настройкам разбиения модуля.
+    Количество частей задаётся count либо shard_size (размер части); образцы меньше min_size не разбиваются.
+
+    :param folder: Папка файлов частей, если в настройках не указана папка модуля.
+    :param read_files: Если указан, в него добавляется путь к прочитанному файлу регионов (regions_file).
+    """
+    by = shards.get('by', 'records')
+    if by == 'regions':
+        regions = shards.get('regions')
+        if not regions:
+            regions_file = render(compile_expression(shards['regions_file']), context)
+            if read_files is not None:
+                read_files.add(regions_file)
+            regions = read_regions(regions_file)
+        return plan_shards(sample=sample, by=by, regions=regions)
+    size = get_input_size(sample)
+    if size < parse_size(shards.get('min_size', 0)):
+        return [whole_shard(sample)]
+    count = int(shards.get('count', 0))
+    if not count and shards.get('shard_size'):
+        count = -(-size // max(1, parse_size(shards['shard_size'])))
+    if shards.get('folder'):
+        folder = context['folders'][shards['folder']]
+    return plan_shards(sample=sample, by=by, count=count or 1, folder=folder)
+
+
+def generate_sharded_cmds(context:dict, sample:str, folders:dict, filenames:dict, commands:dict, cmd_list:list,
+                          shards:dict, parts:list) -> dict:
+    """
+    Генерирует команды образца, разбитого на части (scatter-gather), в виде графа зависимостей (см. run_cmd_graph):
+        - split: разделитель (команда из cmds_template либо встроенный разделитель по записям для by: records);
+        - команды sample_level для каждой части под названиями <команда>@<часть>; цепочки частей выполняются \
+          параллельно, depends_on команд указывает на команды той же части;
+        - gather: команда из cmds_template, выполняемая после всех частей;
+        - remove_shards: удаление входных файлов частей (by: records) после успешного gather \
+          (либо после всех частей, если gather не задан); keep: true в настройках сохраняет их.
+    filenames вычисляются для каждой части с переменной shard (suffix, input, start, end, region - см. plan_shards); \
+        для split и gather filenames - файлы образца целиком, а shards - список частей с их filenames.
+
+    :param shards: Настройки разбиения: by, count, shard_size, min_size, record_lines, regions, regions_file, \
+                   folder, split, gather, keep.
+    :param parts: Части образца (см. plan_sample_shards).
+    :return: Команды образца {название: [команда, таймаут, опции]}.
+    """
+    sample_filenames = context['filenames']
+    for shard in parts:
+        shard['filenames'] = generate_sample_filenames(sample=sample, folders=folders, filenames=filenames, shard=shard)
+    context['shards'] = parts
+    cmds = {}
+    roots = []
+    if shards.get('split'):
+        cmds.update(generate_commands(context=context, commands=commands, cmd_list=[shards['split']]))
+        roots = [shards['split']]
+    elif shards.get('by', 'records') == 'records':
+        cmds['split'] = [split_records_cmd(sample=sample, shards=parts, record_lines=int(shards.get('record_lines', 4))), 0]
+        roots = ['split']
+    for title in roots:
+        cmds[title] = cmds[title][:2] + [dict(cmds[title][2] if len(cmds[title]) > 2 else {}, depends_on=[])]
+
+    shard_titles = []
+    for shard in parts:
+        context['filenames'] = shard['filenames']
+        context['shard'] = shard
+        previous = roots
+        for title, cmd_opts in generate_commands(context=context, commands=commands, cmd_list=cmd_list).items():
+            options = cmd_opts[2] if len(cmd_opts) > 2 else {}
+            if 'depends_on' in options:
+                dependencies = [f'{dep}@{shard["name"]}' for dep in options['depends_on']] or roots
+            else:
+                dependencies = previous
+            shard_title = f'{title}@{shard["name"]}'
+            cmds[shard_title] = [cmd_opts[0], cmd_opts[1], dict(options, depends_on=dependencies)]
+            shard_titles.append(shard_title)
+            previous = [shard_title]
+
+    context['filenames'] = sample_filenames
+    context['shard'] = whole_shard(sample)
+    gathered = shard_titles
+    if shards.get('gather'):
+        for title, cmd_opts in generate_commands(context=context, commands=commands, cmd_list=[shards['gather']]).items():
+            options = cmd_opts[2] if len(cmd_opts) > 2 else {}
+            cmds[title] = [cmd_opts[0], cmd_opts[1], dict(options, depends_on=shard_titles)]
+            gathered = [title]
+    # Входные файлы частей создаются разделителем и больше не нужны, когда результаты частей собраны
+    if shards.get('by', 'records') == 'records' and not shards.get('keep', False):
+        cmds['remove_shards'] = [remove_shards_cmd(parts), 0, {'depends_on': gathered}]
+    return cmds
+
+
 def generate_sample_list(in_samples: list, ex_samples: list,
-                         input_dir: str, extensions: tuple, subfolders:bool=False) -> list:
+                         input_dir: str, extensions: tuple, subfolders:bool=False, index=None) -> list:
     """
     В зависимости от значения subfolders возвращает список файлов с указанным расширением только из указанной директории либо \
     и из подпапок тоже. При наличии включающих/исключающих паттернов фильтрует список образцов по ним.\n
@@ -191,23 +464,19 @@ def generate_sample_list(in_samples: list, ex_samples: list,
     :param input_dir: Директория, где искать файлы.
     :param extensions: Расширения файлов для поиска.
     :param subdirs: поиск в подпапках.
+    :param index: Индекс содержимого папок (DiscoveryIndex); если указан, неизменившиеся папки не перечитываются.
     :return: Список путей к файлам.
     """
-    if subfolders:
+    if index:
+        samples = index.find_samples(dir=input_dir, extensions=extensions, subfolders=subfolders)
+    elif subfolders:
         # Ищем все файлы в дереве папок с указанными расширениями
         samples = get_samples_in_dir_tree(dir=input_dir, extensions=extensions)
     else:
         # Ищем все файлы в одной папке с указанными расширениями
         samples = get_samples_in_dir(dir=input_dir, extensions=extensions)
     found_samples = len(samples)
-    # Если список включающих образцов непустой, фильтруем по нему
-    if in_samples:
-        samples = [s for s in samples if 
-                 any(inclusion in os.path.basename(s) for inclusion in in_samples)]
-    # Если список исключающих образцов непустой, фильтруем по нему перед выдачей итогового списка образцов
-    if ex_samples:
-        samples = [s for s in samples if 
-                 not any(exclusion in os.path.basename(s) for exclusion in ex_samples)]
+    samples = filter_samples(samples=samples, in_samples=in_samples, ex_samples=ex_samples)
     len_samples = len(samples)
     # Если итоговый список пустой, выдаём ошибку
     if not samples:
@@ -217,6 +486,41 @@ def generate_sample_list(in_samples: list, ex_samples: list,
     return samples
 
 
+def filter_samples(samples:list, in_samples:list, ex_samples:list) -> list:
+    """
+    Фильтрует список образцов по включающим и исключающим паттернам имени файла (см. compile_sample_patterns).
+    """
+    # Если список включающих образцов непустой, фильтруем по нему
+    if in_samples:
+        inclusion = compile_sample_patterns(tuple(in_samples))
+        samples = [s for s in samples if inclusion.search(os.path.basename(s))]
+    # Если список исключающих образцов непустой, фильтруем по нему перед выдачей итогового списка образцов
+    if ex_samples:
+        exclusion = compile_sample_patterns(tuple(ex_samples))
+        samples = [s for s in samples if not exclusion.search(os.path.basename(s))]
+    return samples
+
+
+@lru_cache(maxsize=64)
+def compile_sample_patterns(patterns:tuple) -> re.Pattern:
+    """
+    Компилирует паттерны образцов в одно регулярное выражение, проверяемое для имени файла:
+        - 're:<выражение>' - регулярное выражение (поиск в любой части имени);
+        - паттерн с * или ? - glob (совпадение со всем именем);
+        - остальные - подстрока имени.
+    """
+    parts = []
+    for pattern in patterns:
+        pattern = str(pattern)
+        if pattern.startswith('re:'):
+            parts.append(pattern[3:])
+        elif '*' in pattern or '?' in pattern:
+            parts.append(f'^{fnmatch.translate(pattern)}')
+        else:
+            parts.append(re.escape(pattern))
+    return re.compile('|'.join(f'(?:{part})' for part in parts))
+
+
 def get_samples_in_dir(dir:str, extensions:tuple):
     """
     Генерирует список файлов на основе включающих и исключающих образцов.
@@ -248,13 +552,31 @@ def get_samples_in_dir_tree(dir:str, extensions:tuple):
     return files
 
 
-def generate_sample_filenames(sample: str, folders: dict, filenames: dict) -> dict:
+def get_input_size(path:str) -> int:
+    """
+    Возвращает размер входных данных образца в байтах: размер файла либо суммарный размер файлов папки.
+    Для отсутствующего пути возвращает 0.
+    """
+    try:
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        size = 0
+        for root, _ds, fs in os.walk(path):
+            size += sum(os.path.getsize(os.path.join(root, f)) for f in fs)
+        return size
+    except OSError:
+        return 0
+
+
+def generate_sample_filenames(sample: str, folders: dict, filenames: dict, shard:dict=None) -> dict:
     """
     Генерирует словарь с путями к файлам для сэмпла на основе инструкций в filenames.
 
     :param sample: Имя сэмпла (строка).
     :param folders: Словарь с путями к директориям.
     :param filenames: Словарь с инструкциями для генерации файловых путей.
+    :param shard: Часть образца (см. src.sharding.plan_shards), доступная в инструкциях как shard; \
+                  по умолчанию - образец целиком (shard["suffix"] - пустая строка).
     :return: Словарь с результатами выполнения инструкций для файловых путей.
     """
     # Словарь для хранения сгенерированных путей
@@ -263,6 +585,7 @@ def generate_sample_filenames(sample: str, folders: dict, filenames: dict) -> di
     context = {
             'folders': folders,
             'sample': sample,
+            'shard': shard or whole_shard(sample),
             'filenames': generated_filenames,
             'os': os  # Добавляем os в контекст, чтобы os.path был доступен
             }
@@ -270,11 +593,10 @@ def generate_sample_filenames(sample: str, folders: dict, filenames: dict) -> di
     for key, instruction in filenames.items():
         # Используем eval() для вычисления выражений в строках
         try:
-            # Заменяем {{ и }} на { и }
-            instruction = instruction.replace('{{', '{').replace('}}', '}')
-            # Выполняем eval с корректной строкой
+            # Нескомпилированные инструкции компилируются на месте (скомпилированные возвращаются без изменений)
+            instruction = compile_expression(instruction, always=True, name=f'<filenames:{key}>')
             # Выполняем инструкцию, подставляя доступные переменные
-            context['filenames'][key] = eval(instruction, context)
+            context['filenames'][key] = instruction.render(context)
         except Exception as e:
             print(f"Ошибка при обработке {key}: {e}")
     
@@ -285,10 +607,21 @@ def generate_commands(context:dict,
                       commands:dict, cmd_list:list):
     """
     Генерирует словарь с командами для сэмпла на основе инструкций в cmds_template.
+    Инструкция команды может быть задана:
+        - строкой;
+        - списком [таймаут, строка];
+        - словарём {cmd: строка, timeout: таймаут, threads: потоки, memory: объём памяти, \
+          inputs: входные файлы, outputs: выходные файлы, cache: использование кэша}, где \
+          threads и memory - ресурсы, необходимые команде (используются планировщиком ресурсов), \
+          inputs и outputs - списки путей (f-строки, ключи filenames либо готовые пути), используемые кэшем результатов, \
+          depends_on - команды набора, после которых выполняется команда, always - выполнять команду, даже если \
+          команды из depends_on завершились с ошибкой (см. run_cmd_graph), disk - объём данных, записываемых командой \
+          (например, '20G', либо кратность размера входных данных образца - '3x'), io - команда с интенсивным \
+          вводом-выводом (см. DiskAdmission).
 
     :param context: Словарь с со словарями, содержащими подстроки.
     :param commands: Словарь с инструкциями для создания команд.
-    :return: Словарь с результатами выполнения инструкций для команд.
+    :return: Словарь с результатами выполнения инструкций для команд: {название: [команда, таймаут, (опции)]}.
     """
     instruction:str
 
@@ -300,31 +633,106 @@ def generate_commands(context:dict,
 
     #print(cmd_list)
     for key in cmd_list:
-        cmd_instructions = commands[key]
+        # Нескомпилированные инструкции (вызов вне generate_cmd_data) компилируются на месте
+        cmd_instructions = compile_command(commands[key], name=f'<cmds_template:{key}>')
+        options = {}
         if type(cmd_instructions) == list:
             timeout = cmd_instructions[0]
             instruction = cmd_instructions[1]
+        elif type(cmd_instructions) == dict:
+            timeout = cmd_instructions.get('timeout', 0)
+            instruction = cmd_instructions['cmd']
+            options = {opt:cmd_instructions[opt] for opt in ['threads', 'memory', 'inputs', 'outputs', 'cache', 'depends_on',
+                                                             'always', 'disk', 'io']
+                       if opt in cmd_instructions}
         else:
             timeout = 0
             instruction = cmd_instructions
 
         # Используем eval() для вычисления выражений в строках
         try:
-            # Если команда требует выполнения как Python-код (например, f-строки), используем eval(), подставляя доступные переменные
-            if instruction.startswith(("f'", 'f"')):
-                generated_cmds[key] = [eval(instruction, context), timeout]
-            else:
-                # Если это обычная строка, просто сохраняем её без eval
-                generated_cmds[key] = [instruction, timeout]
+            # f-строки вычисляются в контексте образца, обычные строки сохраняются без eval
+            generated_cmds[key] = [instruction.render(context), timeout]
+            if type(cmd_instructions) == dict:
+                generated_cmds[key].append(render_cmd_options(context=context, options=options))
         except Exception as e:
             print(f"Ошибка при обработке {key}: {e}")
-            print(instruction)
+            print(instruction.source)
             errors += 1
     if errors > 0:
         exit(code=1)
     return generated_cmds
 
 
+def render_cmd_options(context:dict, options:dict) -> dict:
+    """
+    Вычисляет опции команды, заданной словарём: ресурсы и списки входных/выходных файлов.
+    Значения могут быть f-строками; элементы inputs/outputs, совпадающие с ключами filenames, заменяются путями к файлам.
+    """
+    rendered = {'threads': int(render(options.get('threads', 1), context)),
+                'memory': parse_size(render(options.get('memory', 0), context))}
+    for files_key in ['inputs', 'outputs']:
+        if files_key in options:
+            filenames = context.get('filenames', {})
+            rendered[files_key] = [filenames.get(item, item) if isinstance(item, str) else item
+                                   for item in (render(item, context) for item in options[files_key] or [])]
+    if 'cache' in options:
+        rendered['cache'] = bool(options['cache'])
+    if 'depends_on' in options:
+        rendered['depends_on'] = list(options['depends_on'] or [])
+    if options.get('always'):
+        rendered['always'] = True
+    if options.get('disk') or options.get('io'):
+        # Объём записываемых данных и файловая система, на которую они записываются (папка первого выходного файла)
+        shard = context.get('shard') or {}
+        input_size = shard['end'] - shard['start'] if shard.get('end') else get_input_size(shard.get('input', ''))
+        rendered['disk'] = parse_footprint(render(options.get('disk', 0), context), input_size=input_size)
+        outputs = rendered.get('outputs') or []
+        rendered['disk_path'] = os.path.dirname(outputs[0]) if outputs else context['args']['output_dir']
+        if options.get('io'):
+            rendered['io'] = True
+    return rendered
+
+
+def parse_size(size) -> int:
+    """
+    Переводит объём памяти/диска в байты.
+
+    :param size: Число байт либо строка с суффиксом (K, M, G, T), например '64G' или '1.5T'.
+    :return: Объём в байтах.
+    """
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    if isinstance(size, (int, float)):
+        return int(size)
+    size = str(size).strip().upper().removesuffix('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size or 0))
+
+
+def parse_footprint(footprint, input_size:int=0) -> int:
+    """
+    Переводит объявленный объём записываемых данных в байты.
+
+    :param footprint: Объём (см. parse_size) либо кратность размера входных данных образца, например '3x'.
+    :param input_size: Размер входных данных образца в байтах.
+    """
+    if isinstance(footprint, str) and footprint.strip().lower().endswith('x'):
+        return int(float(footprint.strip()[:-1]) * (input_size or 0))
+    return parse_size(footprint or 0)
+
+
+def format_size(size:int) -> str:
+    """
+    Переводит число байт в строку с суффиксом (K, M, G, T), например '1.5G'.
+    """
+    for unit in ['', 'K', 'M', 'G']:
+        if abs(size) < 1024:
+            return f'{size:.1f}{unit}' if unit else f'{size}'
+        size /= 1024
+    return f'{size:.1f}T'
+
+
 def create_paths(paths: list):
     """
     Принимает список путей и пытается их создать.
@@ -340,11 +748,37 @@ def create_paths(paths: list):
             raise SystemExit(f"Невозможно создать путь: {path}")
 
 
-def run_cmds(cmds:dict, debug:str, timeout_behavior:str) -> tuple:
-    RED = "\033[31m"
-    GREEN = "\033[32m"
+def run_cmds(cmds:dict, debug:str, timeout_behavior:str, sample:str='', resources=None,
+             output_dir:str='', capture:dict=None, cache=None, checkpoint=None) -> tuple:
+    """
+    Выполняет набор команд (стадии модуля либо одного образца).
+    Команды выполняются последовательно, если ни для одной из них не указан depends_on; иначе - по графу зависимостей \
+        (см. run_cmd_graph). Последовательно выполняемые команды не останавливаются ошибкой предыдущей команды, \
+        таймаут (если timeout_behavior не 'next') останавливает выполнение следующих команд; в графе так же \
+        выполняются команды без depends_on, поэтому depends_on одной команды не меняет обработку ошибок остальных.
+
+    :param cmds: Словарь команд вида {название: [команда, таймаут, (опции)]}.
+    :param debug: Уровень вывода stdout/stderr программ в консоль.
+    :param timeout_behavior: Поведение при таймауте ('next' - продолжить выполнение следующих команд).
+    :param sample: Имя образца. Если указано, строки вывода печатаются целиком с префиксом образца \
+                   (режим параллельного выполнения образцов).
+    :param resources: Пул ресурсов машины (ResourcePool); если указан, перед запуском команда занимает \
+                      объявленные ею потоки и память.
+    :param output_dir: Папка, в которую пишутся файлы stdout/stderr команд.
+    :param capture: Настройки сохранения вывода команд (см. run_command).
+    :param cache: Кэш результатов (ResultCache); команды с совпадающим ключом и существующими выходными файлами не выполняются.
+    :param checkpoint: Журнал контрольных точек (UnitCheckpoint); команды, успешно выполненные в возобновляемом запуске, \
+                       не выполняются, результаты остальных записываются в журнал.
+    :return: Кортеж (результаты, коды выхода, статус, флаг прерывания).
+    """
+    YELLOW = "\033[33m"
     WHITE ="\033[37m"
-    
+
+    node_kwargs = {'debug': debug, 'resources': resources, 'output_dir': output_dir, 'capture': capture,
+                   'cache': cache, 'checkpoint': checkpoint}
+    if any('depends_on' in cmd_opts[2] for cmd_opts in cmds.values() if len(cmd_opts) > 2):
+        return run_cmd_graph(cmds=cmds, timeout_behavior=timeout_behavior, sample=sample, **node_kwargs)
+
     unit_result = {'log':{},
                     'stdout':{},
                     'stderr':{}}
@@ -352,30 +786,17 @@ def run_cmds(cmds:dict, debug:str, timeout_behavior:str) -> tuple:
     status = True
     interruption = False
     for title, cmd_opts in cmds.items():
-        cmd = cmd_opts[0]
-        timeout = cmd_opts[1]
-
-        print(f'\t\t\t{title}:', end='')
-
-        # Выполнение команды
-        run_result = run_command(cmd=cmd, timeout=timeout, debug=debug)
-
-        # Сохранение результатов
-        unit_result['log'][title] = run_result['log']
-        unit_result['stdout'][title] = run_result['stdout']
-        unit_result['stderr'][title] = run_result['stderr']
-        
-        # Логгирование результатов выполнения
-        r = unit_result['log'][title]
-
-        # Проверка успешности выполнения команды
-        if r['status'] == 'FAIL':
-            print(f' {RED}FAIL{WHITE}, exit code: {r["exit_code"]}. ', end='')
-            status = False
+        # При параллельном выполнении строка печатается целиком после завершения команды
+        if sample:
+            line = f'\t\t\t{YELLOW}{sample}{WHITE} | {title}:'
         else:
-            print(f' {GREEN}OK{WHITE}. ', end='')
-        exit_codes.update({title:r["exit_code"]})
-        print(f'Duration: {r["duration"]}.')
+            print(f'\t\t\t{title}:', end='')
+            line = ''
+
+        run_result, note = run_cmd_node(title=title, cmd_opts=cmd_opts, **node_kwargs)
+        status = save_cmd_result(unit_result=unit_result, exit_codes=exit_codes, title=title, run_result=run_result) and status
+        # Строка выводится одной записью, чтобы не перемешиваться с выводом других потоков
+        print(f'{line}{format_cmd_status(run_result, note)}\n', end='')
         for exit_code in exit_codes.values():
             if exit_code == 'INTERRUPTED':
                 interruption = True
@@ -387,100 +808,650 @@ def run_cmds(cmds:dict, debug:str, timeout_behavior:str) -> tuple:
     return (unit_result, exit_codes, status, interruption)
 
 
-def gather_logs(all_logs:dict, log_space:dict, log:dict, stdout:dict, stderr:dict, unit:str, unit_result:str) -> tuple:
-    # Обновляем логи для текущего образца
-    log.update({unit:unit_result['log']})
-    stdout.update({unit:unit_result['stdout']})
-    stderr.update({unit:unit_result['stderr']})
-    # Сохраняем обновлённые данные в YAML
-    update_yaml(file_path=log_space['log_data'], new_data=all_logs['log'])
-    update_yaml(file_path=log_space['stdout_log'], new_data=all_logs['stdout'])
-    update_yaml(file_path=log_space['stderr_log'], new_data=all_logs['stderr'])
+def run_cmd_graph(cmds:dict, timeout_behavior:str, sample:str='', **node_kwargs) -> tuple:
+    """
+    Выполняет набор команд по графу зависимостей: команда запускается, когда завершены все команды из её depends_on, \
+        независимые ветви выполняются одновременно (в пределах пула ресурсов).
+    Команда без depends_on выполняется после предыдущей команды набора, пустой depends_on - не зависит ни от чего.
+    Если команда завершилась с ошибкой (либо по таймауту, если timeout_behavior не 'next'), команды, явно зависящие \
+        от неё (depends_on), не выполняются и получают код SKIPPED; независимые ветви продолжают выполняться. \
+        Следующая команда без depends_on, как при последовательном выполнении, пропускается только после таймаута \
+        (см. get_failed_dependencies). Команды с опцией always выполняются после своих зависимостей при любом их \
+        результате (например, очистка).
+
+    :param cmds: Словарь команд вида {название: [команда, таймаут, (опции)]}.
+    :param timeout_behavior: Поведение при таймауте ('next' - таймаут не останавливает зависящие команды).
+    :param sample: Имя образца для префикса строк вывода.
+    :param node_kwargs: Параметры выполнения команд (см. run_cmd_node).
+    :return: Кортеж (результаты, коды выхода, статус, флаг прерывания).
+    """
+    RED = "\033[31m"
+    YELLOW = "\033[33m"
+    WHITE ="\033[37m"
 
-    return (log, stdout, stderr)
+    prefix = f'\t\t\t{YELLOW}{sample}{WHITE} | ' if sample else '\t\t\t'
+    dependencies = get_cmd_dependencies(cmds)
+    unit_result = {'log':{},
+                    'stdout':{},
+                    'stderr':{}}
+    exit_codes = {}
+    status = True
+    interruption = False
 
+    pending = list(cmds)
+    running = {}
+    with ThreadPoolExecutor(max_workers=len(cmds) or 1) as pool:
+        while pending or running:
+            # Запускаем команды, все зависимости которых завершены. Пропуск команды может сделать готовыми следующие
+            ready = True
+            while ready and not interruption:
+                ready = False
+                for title in list(pending):
+                    if not all(dep in exit_codes for dep in dependencies[title]):
+                        continue
+                    pending.remove(title)
+                    ready = True
+                    failed = get_failed_dependencies(cmds=cmds, title=title, dependencies=dependencies,
+                                                     exit_codes=exit_codes, timeout_behavior=timeout_behavior)
+                    if failed:
+                        run_result = {'log': {'status': 'SKIPPED', 'exit_code': 'SKIPPED', 'skipped_by': failed},
+                                      'stdout': '', 'stderr': ''}
+                        status = save_cmd_result(unit_result=unit_result, exit_codes=exit_codes,
+                                                 title=title, run_result=run_result) and status
+                        print(f'{prefix}{title}: {RED}SKIPPED{WHITE} ({", ".join(failed)} failed).\n', end='')
+                        continue
+                    # Команда выполняется в области выполнения набора (см. CMD_SCOPE)
+                    running[pool.submit(contextvars.copy_context().run, run_cmd_node, title=title, cmd_opts=cmds[title],
+                                        **node_kwargs)] = title
+            if not running:
+                break
+            try:
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            except KeyboardInterrupt:
+                print('INTERRUPTED')
+                interrupt_running_commands()
+                interruption = True
+                continue
+            for future in done:
+                title = running.pop(future)
+                run_result, note = future.result()
+                status = save_cmd_result(unit_result=unit_result, exit_codes=exit_codes,
+                                         title=title, run_result=run_result) and status
+                print(f'{prefix}{title}:{format_cmd_status(run_result, note)}\n', end='')
+                if exit_codes[title] == 'INTERRUPTED':
+                    interruption = True
+    return (unit_result, exit_codes, status, interruption)
 
-def run_command(cmd:str, timeout:int, debug:str) -> dict:
-    if timeout == 0:
-        timeout=None
-    # Время начала (общее)
-    start_time = time.time()
-    cpu_start_time = time.process_time()
-    start_datetime = datetime.now().strftime("%d.%m.%Y %H:%M:%S")
 
-    stdout, stderr = "", ""
+def get_cmd_dependencies(cmds:dict) -> dict:
+    """
+    Возвращает зависимости команд набора: {название: [названия команд, которые должны завершиться раньше]}.
+    """
+    dependencies = {}
+    previous = []
+    for title, cmd_opts in cmds.items():
+        options = cmd_opts[2] if len(cmd_opts) > 2 else {}
+        dependencies[title] = list(options['depends_on']) if 'depends_on' in options else previous
+        previous = [title]
+    return dependencies
 
-    result = subprocess.Popen(args=cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                universal_newlines=True, executable="/bin/bash", bufsize=1, cwd=None, env=None)
-    
 
-    try:       
-        # Ожидаем завершения с таймаутом
-        stdout, stderr = result.communicate(timeout=timeout)
-        # Построчно читаем стандартный вывод и ошибки в зависимости от уровня дебага
-        if debug:
-            streams = []
-            if debug in ['errors', 'all']:
-                streams.append(('STDERR', stderr.splitlines()))
-            if debug in ['info', 'all']:
-                streams.append(('STDOUT', stdout.splitlines()))
+def get_failed_dependencies(cmds:dict, title:str, dependencies:dict, exit_codes:dict, timeout_behavior:str) -> list:
+    """
+    Возвращает завершённые зависимости команды, результат которых не позволяет её запустить.
+    Явная зависимость (depends_on) не позволяет запустить команду, если завершилась с ошибкой, была пропущена либо \
+        завершилась по таймауту (если timeout_behavior не 'next'). Неявная (предыдущая команда набора) - только если \
+        остановила бы последовательное выполнение: завершилась по таймауту либо пропущена из-за такого таймаута.
+    Команды с опцией always запускаются при любом результате зависимостей.
+    """
+    options = cmds[title][2] if len(cmds[title]) > 2 else {}
+    if options.get('always'):
+        return []
 
-            for label, stream in streams:
-                for line in stream:
-                    print(f"{label}: {line.strip()}")
+    def stopped(dep:str) -> bool:
+        exit_code = exit_codes[dep]
+        if exit_code == 'TIMEOUT':
+            return timeout_behavior != 'next'
+        return exit_code == 'INTERRUPTED' or exit_code == 'SKIPPED' and any(stopped(item) for item in dependencies[dep])
+
+    def failed(dep:str) -> bool:
+        exit_code = exit_codes[dep]
+        return exit_code != 0 and not (exit_code == 'TIMEOUT' and timeout_behavior == 'next')
+
+    explicit = 'depends_on' in options
+    return [dep for dep in dependencies[title] if stopped(dep) or explicit and failed(dep)]
+
+
+def run_cmd_node(title:str, cmd_opts:list, debug:str, resources=None, output_dir:str='', capture:dict=None,
+                 cache=None, checkpoint=None) -> tuple:
+    """
+    Выполняет одну команду набора с учётом журнала контрольных точек, кэша результатов и пула ресурсов.
+
+    :return: Кортеж (результат в формате run_command, отметка о пропуске выполнения для строки вывода).
+    """
+    GREEN = "\033[32m"
+    WHITE ="\033[37m"
 
-        duration_sec, duration, cpu_duration, end_datetime = get_duration(start_time=start_time, cpu_start_time=cpu_start_time)
+    cmd = cmd_opts[0]
+    timeout = cmd_opts[1]
+    options = cmd_opts[2] if len(cmd_opts) > 2 else {}
+
+    # Команда уже успешно выполнена в возобновляемом запуске
+    if checkpoint and checkpoint.is_completed(title=title, cmd=cmd):
+        return (skipped_result(resumed=True), f' {GREEN}DONE{WHITE} (resumed).')
+    # Проверяем, есть ли в кэше успешный результат этой же команды с теми же входными файлами
+    cache_key = cache.key(cmd=cmd, options=options) if cache else None
+    run_result = cache.lookup(key=cache_key, options=options) if cache_key else None
+    if run_result:
+        if checkpoint:
+            checkpoint.record(title=title, cmd=cmd, run_result=run_result)
+        return (run_result, f' {GREEN}CACHED{WHITE}.')
+
+    # Место на диске резервируется до занятия потоков и памяти: ожидающая места команда не задерживает другие
+    disk = resources.disk if resources and (options.get('disk') or options.get('io')) else None
+    try:
+        reservation = disk.acquire(path=options['disk_path'], size=options['disk'], io=options.get('io', False),
+                                   label=title) if disk else None
+    except DiskSpaceError as e:
+        return (failed_result(exit_code='NO_SPACE', message=str(e)), '')
+    # Выполнение команды. Команды без объявленных ресурсов занимают один поток
+    demand = {'threads': options.get('threads', 1), 'memory': options.get('memory', 0)}
+    acquired = resources.acquire(**demand) if resources else False
+    try:
+        run_result = run_command(cmd=cmd, timeout=timeout, debug=debug, capture=capture,
+                                 output_prefix=os.path.join(output_dir, title) if output_dir else '')
+    finally:
+        if acquired:
+            resources.release(**demand)
+        if reservation:
+            disk.release(reservation)
+    if cache_key and run_result['log']['exit_code'] == 0:
+        cache.store(key=cache_key, cmd=cmd, run_result=run_result)
+    if checkpoint:
+        checkpoint.record(title=title, cmd=cmd, run_result=run_result)
+    return (run_result, '')
+
+
+def save_cmd_result(unit_result:dict, exit_codes:dict, title:str, run_result:dict) -> bool:
+    """
+    Сохраняет результат команды в результаты набора команд.
+
+    :return: Статус команды (False, если команда завершилась с ошибкой).
+    """
+    unit_result['log'][title] = run_result['log']
+    unit_result['stdout'][title] = run_result['stdout']
+    unit_result['stderr'][title] = run_result['stderr']
+    exit_codes.update({title:run_result['log']['exit_code']})
+    return run_result['log']['status'] != 'FAIL'
+
+
+def format_cmd_status(run_result:dict, note:str='') -> str:
+    """
+    Формирует строку статуса выполненной команды для вывода в консоль.
+
+    :param note: Отметка о пропуске выполнения (кэш, возобновление запуска); выводится вместо статуса и длительности.
+    """
+    RED = "\033[31m"
+    GREEN = "\033[32m"
+    WHITE ="\033[37m"
+    if note:
+        return note
+    r = run_result['log']
+    # Проверка успешности выполнения команды
+    if r['status'] == 'FAIL':
+        line = f' {RED}FAIL{WHITE}, exit code: {r["exit_code"]}. '
+    else:
+        line = f' {GREEN}OK{WHITE}. '
+    return f'{line}Duration: {r["duration"]}.'
+
+
+def gather_logs(log_sink, section:str, unit:str, unit_result:dict, sample:str='', input_size:int=None, job:dict=None):
+    """
+    Записывает результаты выполнения стадии (или образца в стадии batch) в журнал выполнения.
+
+    :param log_sink: Журнал выполнения (см. src.log_sink).
+    :param section: Раздел логов модуля.
+    :param unit: Стадия модуля.
+    :param unit_result: Результаты выполнения команд (log, stdout, stderr).
+    :param sample: Имя образца; для стадии batch логи хранятся отдельно для каждого образца.
+    :param input_size: Размер входных данных образца в байтах (используется для оценки длительности в следующих запусках).
+    :param job: Данные учёта задания планировщика кластера (состояние, длительность, память, узел).
+    """
+    record = {'type':'unit', 'section':section, 'unit':unit, 'sample':sample,
+              'log':unit_result['log'], 'stdout':unit_result['stdout'], 'stderr':unit_result['stderr']}
+    # Сводка ресурсов, затраченных командами стадии (образца)
+    resources = summarize_resources(unit_result['log'].values())
+    if resources:
+        record['resources'] = resources
+    if input_size is not None:
+        record['input_size'] = input_size
+    if job:
+        record['job'] = job
+    log_sink.write(record)
+
+
+def skipped_result(**marks) -> dict:
+    """
+    Результат команды, которая не выполнялась, так как её успешный результат уже есть (кэш, возобновление запуска).
+
+    :param marks: Дополнительные поля лога, указывающие причину пропуска.
+    """
+    now = datetime.now().strftime("%d.%m.%Y %H:%M:%S")
+    return {
+        'log': {
+            'status': 'OK',
+            'start_time': now,
+            'end_time': now,
+            'duration': '< 1s',
+            'duration_sec': 0,
+            'cpu_duration_sec': 0,
+            'exit_code': 0,
+            **marks
+        },
+        'stdout': '',
+        'stderr': ''
+    }
+
+
+def failed_result(exit_code:str, message:str) -> dict:
+    """
+    Результат команды, которая не запускалась из-за ошибки (например, нехватки места на диске).
+
+    :param exit_code: Отметка вместо кода выхода.
+    :param message: Описание ошибки (сохраняется как stderr команды).
+    """
+    now = datetime.now().strftime("%d.%m.%Y %H:%M:%S")
+    return {
+        'log': {
+            'status': 'FAIL',
+            'start_time': now,
+            'end_time': now,
+            'duration': '< 1s',
+            'duration_sec': 0,
+            'cpu_duration_sec': 0,
+            'exit_code': exit_code
+        },
+        'stdout': '',
+        'stderr': message
+    }
+
+
+def failed_unit(cmds:dict, exit_code:str, message:str) -> tuple:
+    """
+    Результат набора команд, который не запускался: все команды отмечаются как завершившиеся с ошибкой (см. failed_result).
+
+    :return: Кортеж в формате run_cmds.
+    """
+    print(f'\t\t\t{message}\n', end='')
+    unit_result = {'log': {}, 'stdout': {}, 'stderr': {}}
+    exit_codes = {}
+    for title in cmds:
+        save_cmd_result(unit_result=unit_result, exit_codes=exit_codes, title=title,
+                        run_result=failed_result(exit_code=exit_code, message=message))
+    return (unit_result, exit_codes, False, False)
+
+
+def interrupt_running_commands():
+    """
+    Выставляет флаг прерывания и останавливает все запущенные в данный момент команды.
+    Используется главным потоком при получении KeyboardInterrupt во время параллельного выполнения.
+    """
+    INTERRUPT_EVENT.set()
+    with RUNNING_PROCESSES_LOCK:
+        for process in RUNNING_PROCESSES:
+            kill_process(process)
+
+
+def interrupt_scope(scope:threading.Event):
+    """
+    Останавливает команды области выполнения (см. CMD_SCOPE); новые команды области не запускаются.
+    """
+    scope.set()
+    with RUNNING_PROCESSES_LOCK:
+        for process in RUNNING_PROCESSES:
+            if getattr(process, 'scope', None) is scope:
+                kill_process(process)
+
+
+def cmd_interrupted() -> bool:
+    """
+    Проверяет, прерван ли пайплайн либо область выполнения текущей команды.
+    """
+    scope = CMD_SCOPE.get()
+    return INTERRUPT_EVENT.is_set() or (scope is not None and scope.is_set())
+
+
+def kill_process(process:subprocess.Popen):
+    """
+    Завершает процесс вместе со всеми его потомками.
+    Команды запускаются в отдельной группе процессов, поэтому сигнал отправляется всей группе.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        process.kill()
 
+
+def run_command(cmd:str, timeout:int, debug:str, output_prefix:str='', capture:dict=None) -> dict:
+    """
+    Выполняет команду в bash. Потоки stdout и stderr программы пишутся на диск по мере поступления, \
+        в памяти сохраняется только ограниченный фрагмент вывода.
+
+    :param cmd: Команда.
+    :param timeout: Таймаут в секундах (0 - без ограничения).
+    :param debug: Уровень вывода stdout/stderr программы в консоль в реальном времени ('errors', 'info', 'all').
+    :param output_prefix: Префикс путей файлов вывода (<префикс>.stdout, <префикс>.stderr). Если не указан, \
+                          вывод пишется во временные файлы, которые удаляются после выполнения.
+    :param capture: Настройки сохранения вывода: max_bytes - максимальный размер файла вывода \
+                    (при превышении сохраняются начало и конец), excerpt_bytes - размер фрагмента вывода в логах.
+    :return: Словарь с логом выполнения и фрагментами stdout/stderr.
+    """
+    if timeout == 0:
+        timeout=None
+    # Время начала (общее)
+    started = (time.time(), time.process_time(), datetime.now().strftime("%d.%m.%Y %H:%M:%S"))
+
+    capture = capture or {}
+    max_bytes = parse_size(capture.get('max_bytes', 0))
+    excerpt_bytes = parse_size(capture.get('excerpt_bytes', 4096))
+    # Потоки, которые выводятся в консоль в реальном времени
+    echo = {'stdout': debug in ['info', 'all'], 'stderr': debug in ['errors', 'all']}
+    output_files, temporary = prepare_cmd_output(output_prefix)
+
+    def make_result(exit_code, rusage=None) -> dict:
+        return make_cmd_result(exit_code=exit_code, started=started, output_files=output_files,
+                               excerpt_bytes=excerpt_bytes, temporary=temporary, rusage=rusage)
+
+    # Если пайплайн уже прерван, новые команды не запускаем
+    if cmd_interrupted():
+        return make_result('INTERRUPTED')
+
+    # Потоки пишутся напрямую в файлы, если их не нужно ни ограничивать по размеру, ни выводить в консоль.
+    # В остальных случаях вывод читается из канала отдельным потоком
+    piped = {stream: bool(max_bytes or echo[stream]) for stream in output_files}
+    result = start_command(cmd=cmd, output_files=output_files, piped=piped)
+    readers = []
+    for stream in ['stdout', 'stderr']:
+        if piped[stream]:
+            reader = threading.Thread(target=pump_stream, daemon=True,
+                                      kwargs={'stream': getattr(result, stream), 'file_path': output_files[stream],
+                                              'max_bytes': max_bytes, 'echo_label': stream.upper() if echo[stream] else ''})
+            reader.start()
+            readers.append(reader)
+
+    try:       
+        # Ожидаем завершения с таймаутом
+        rusage = wait_process(result, timeout=timeout)
+        for reader in readers:
+            reader.join()
+
+        # Команда, остановленная из-за прерывания пайплайна в другом потоке, помечается как прерванная
+        exit_code = result.returncode
+        if exit_code != 0 and cmd_interrupted():
+            exit_code = 'INTERRUPTED'
         # Лог успешного выполнения
-        return {
-            'log': {
-                'status': 'OK' if result.returncode == 0 else 'FAIL',
-                'start_time': start_datetime,
-                'end_time': end_datetime,
-                'duration': duration,
-                'duration_sec': duration_sec,
-                'cpu_duration_sec': round(cpu_duration, 2),
-                'exit_code': result.returncode
-            },
-            'stderr': stderr.strip() if stderr else '',
-            'stdout': stdout.strip() if stdout else ''
-        }
+        return make_result(exit_code, rusage)
 
     except subprocess.TimeoutExpired:
-        result.kill()
-        stdout, stderr = result.communicate()
-        duration_sec, duration, cpu_duration, end_datetime = get_duration(start_time=start_time, cpu_start_time=cpu_start_time)
+        kill_process(result)
+        rusage = wait_process(result)
+        for reader in readers:
+            reader.join()
         # Лог при тайм-ауте
-        return {
-            'log': {
-                'status': 'FAIL',
-                'start_time': start_datetime,
-                'end_time': end_datetime,
-                'duration': duration,
-                'duration_sec': duration_sec,
-                'cpu_duration_sec': round(cpu_duration, 2),
-                'exit_code': "TIMEOUT"
-            },
-            'stderr': stderr.strip() if stderr else '',
-            'stdout': stdout.strip() if stdout else ''
-        }
+        return make_result('TIMEOUT', rusage)
     except KeyboardInterrupt:
-        result.kill()
+        INTERRUPT_EVENT.set()
+        kill_process(result)
+        rusage = wait_process(result)
+        for reader in readers:
+            reader.join()
         print('INTERRUPTED')
-        duration_sec, duration, cpu_duration, end_datetime = get_duration(start_time=start_time, cpu_start_time=cpu_start_time)
-        return {
-            'log':
-                {'status': 'FAIL',
-                'start_time':start_datetime,
-                'end_time':end_datetime,
-                'duration': duration,
-                'duration_sec': duration_sec,
-                'cpu_duration_sec': round(cpu_duration, 2),
-                'exit_code': 'INTERRUPTED'},
-            'stderr': stderr.strip() if stderr else '',
-            'stdout': stdout.strip() if stdout else ''   
-                }
-    
+        return make_result('INTERRUPTED', rusage)
+    finally:
+        with RUNNING_PROCESSES_LOCK:
+            RUNNING_PROCESSES.discard(result)
+
+
+def start_command(cmd:str, output_files:dict, piped:dict) -> subprocess.Popen:
+    """
+    Запускает команду в bash в отдельной группе процессов и регистрирует её среди запущенных (см. interrupt_running_commands).
+
+    :param output_files: Файлы вывода {поток: путь}.
+    :param piped: Потоки, которые читаются из канала {поток: флаг}; остальные пишутся напрямую в файлы.
+    """
+    handles = {}
+    for stream, file_path in output_files.items():
+        handles[stream] = subprocess.PIPE if piped[stream] else open(file_path, 'wb')
+    try:
+        process = subprocess.Popen(args=cmd, shell=True, stdout=handles['stdout'], stderr=handles['stderr'],
+                                   executable="/bin/bash", cwd=None, env=None, start_new_session=True)
+    finally:
+        for handle in handles.values():
+            if handle != subprocess.PIPE:
+                handle.close()
+    process.scope = CMD_SCOPE.get()
+    with RUNNING_PROCESSES_LOCK:
+        RUNNING_PROCESSES.add(process)
+    return process
+
+
+def prepare_cmd_output(output_prefix:str='') -> tuple:
+    """
+    Подготавливает файлы stdout/stderr команды.
+
+    :param output_prefix: Префикс путей файлов вывода; если не указан, используются временные файлы.
+    :return: Кортеж ({поток: путь к файлу}, флаг временных файлов).
+    """
+    temporary = not output_prefix
+    if temporary:
+        output_prefix = os.path.join(tempfile.mkdtemp(prefix='pipeline_cmd_'), 'cmd')
+    else:
+        create_paths([os.path.dirname(output_prefix)])
+    return ({stream: f'{output_prefix}.{stream}' for stream in ['stdout', 'stderr']}, temporary)
+
+
+def make_cmd_result(exit_code, started:tuple, output_files:dict, excerpt_bytes:int, temporary:bool, rusage=None) -> dict:
+    """
+    Формирует результат выполнения команды: лог и фрагменты stdout/stderr.
+
+    :param exit_code: Код выхода либо отметка (TIMEOUT, INTERRUPTED).
+    :param started: Кортеж (время начала, время CPU процесса пайплайна на момент начала, строка даты начала).
+    :param rusage: Ресурсы, затраченные командой (данные wait4).
+    """
+    start_time, cpu_start_time, start_datetime = started
+    duration_sec, duration, cpu_duration, end_datetime = get_duration(start_time=start_time, cpu_start_time=cpu_start_time)
+    # Ресурсы, затраченные самой командой и её потомками; без данных wait4 - время CPU драйвера, как раньше
+    usage = get_resource_usage(rusage) if rusage else {}
+    if usage:
+        cpu_duration = usage['user_cpu_sec'] + usage['system_cpu_sec']
+    run_result = {
+        'log': {
+            'status': 'OK' if exit_code == 0 else 'FAIL',
+            'start_time': start_datetime,
+            'end_time': end_datetime,
+            'duration': duration,
+            'duration_sec': duration_sec,
+            'cpu_duration_sec': round(cpu_duration, 2),
+            'exit_code': exit_code,
+            **usage
+        }
+    }
+    for stream, file_path in output_files.items():
+        run_result[stream] = read_excerpt(file_path=file_path, excerpt_bytes=excerpt_bytes)
+        if not temporary:
+            run_result['log'][f'{stream}_file'] = file_path
+    if temporary:
+        shutil.rmtree(os.path.dirname(output_files['stdout']), ignore_errors=True)
+    return run_result
+
+
+def wait_process(process:subprocess.Popen, timeout:float=None):
+    """
+    Ожидает завершения процесса через os.wait4, чтобы вместе с кодом выхода получить ресурсы, затраченные процессом \
+        и дождавшимися им потомками (для команды bash - всеми запущенными в ней программами).
+    Без таймаута процесс ожидается блокирующим os.wait4; с таймаутом - через pidfd (Linux 5.3+), \
+        без него - опросом с растущим интервалом.
+
+    :param process: Процесс.
+    :param timeout: Таймаут в секундах (None - без ограничения); по истечении выбрасывается subprocess.TimeoutExpired.
+    :return: Данные resource.struct_rusage либо None, если процесс уже был завершён и учтён в другом месте.
+    """
+    if timeout is None:
+        return reap_process(process, options=0)
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    if pidfd is not None:
+        try:
+            exited = select.select([pidfd], [], [], timeout)[0]
+        finally:
+            os.close(pidfd)
+        if not exited:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        return reap_process(process, options=0)
+    deadline = time.monotonic() + timeout
+    # Интервал опроса растёт, чтобы короткие команды завершались без задержки, а долгие не нагружали процессор
+    delay = 0.005
+    while True:
+        rusage = reap_process(process, options=os.WNOHANG)
+        if process.returncode is not None:
+            return rusage
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.5)
+
+
+def reap_process(process:subprocess.Popen, options:int):
+    """
+    Забирает завершившийся процесс через os.wait4 и сохраняет его код выхода в process.returncode.
+
+    :param options: Флаги os.wait4 (os.WNOHANG - не ждать, если процесс ещё выполняется).
+    :return: Данные resource.struct_rusage либо None (процесс ещё выполняется либо уже учтён в другом месте).
+    """
+    try:
+        pid, wait_status, rusage = os.wait4(process.pid, options)
+    except ChildProcessError:
+        process.wait()
+        return None
+    if not pid:
+        return None
+    process.returncode = os.waitstatus_to_exitcode(wait_status)
+    return rusage
+
+
+def get_resource_usage(rusage) -> dict:
+    """
+    Преобразует resource.struct_rusage в поля лога команды.
+    Объём чтения и записи - обращения к блочным устройствам (данные, прочитанные из кэша страниц, не учитываются).
+    """
+    return {
+        'user_cpu_sec': round(rusage.ru_utime, 2),
+        'system_cpu_sec': round(rusage.ru_stime, 2),
+        # В Linux ru_maxrss указывается в килобайтах
+        'max_rss_bytes': rusage.ru_maxrss * 1024,
+        'read_bytes': rusage.ru_inblock * 512,
+        'write_bytes': rusage.ru_oublock * 512,
+        'voluntary_ctx_switches': rusage.ru_nvcsw,
+        'involuntary_ctx_switches': rusage.ru_nivcsw
+    }
+
+
+def summarize_resources(logs) -> dict:
+    """
+    Суммирует ресурсы, затраченные командами: время CPU, объём ввода-вывода и переключения контекста складываются, \
+        для пиковой памяти берётся максимум.
+
+    :param logs: Логи команд (значения словаря log результатов) либо сводки, полученные этой же функцией.
+    :return: Сводка ресурсов (пустой словарь, если данных о ресурсах нет).
+    """
+    summary = {}
+    for log in logs:
+        for key in RESOURCE_FIELDS:
+            if key not in log:
+                continue
+            if key == 'max_rss_bytes':
+                summary[key] = max(summary.get(key, 0), log[key])
+            else:
+                summary[key] = summary.get(key, 0) + log[key]
+    for key in ['user_cpu_sec', 'system_cpu_sec']:
+        if key in summary:
+            summary[key] = round(summary[key], 2)
+    return summary
+
+
+def pump_stream(stream, file_path:str, max_bytes:int=0, echo_label:str=''):
+    """
+    Читает поток вывода программы и пишет его в файл (см. output_writer).
+
+    :param stream: Канал вывода процесса (в бинарном режиме).
+    """
+    writer = output_writer(file_path=file_path, max_bytes=max_bytes, echo_label=echo_label)
+    next(writer)
+    # Ограничиваем длину читаемой строки, чтобы бинарный вывод без переводов строк не копился в памяти
+    for line in iter(lambda: stream.readline(65536), b''):
+        writer.send(line)
+    writer.close()
+    stream.close()
+
+
+def output_writer(file_path:str, max_bytes:int=0, echo_label:str=''):
+    """
+    Генератор, записывающий получаемые через send() строки вывода программы в файл и при необходимости \
+        выводящий их в консоль. Файл дописывается и закрывается при закрытии генератора (close()).
+    Если задан max_bytes, в файле сохраняются первая и последняя половины вывода, а середина пропускается.
+
+    :param file_path: Файл, в который пишется вывод.
+    :param max_bytes: Максимальный размер сохраняемого вывода (0 - без ограничения).
+    :param echo_label: Метка для вывода строк в консоль (пустая строка - не выводить).
+    """
+    head_limit = max_bytes // 2
+    tail = deque()
+    tail_size = 0
+    written = 0
+    skipped = 0
+    with open(file_path, 'wb') as out:
+        try:
+            while True:
+                line = yield
+                if echo_label:
+                    print(f"{echo_label}: {line.decode(errors='replace').strip()}")
+                if not max_bytes or written + len(line) <= head_limit:
+                    out.write(line)
+                    written += len(line)
+                    continue
+                # Конец вывода храним в ограниченном буфере
+                tail.append(line)
+                tail_size += len(line)
+                while tail_size > max_bytes - head_limit:
+                    dropped = tail.popleft()
+                    tail_size -= len(dropped)
+                    skipped += len(dropped)
+        except GeneratorExit:
+            if skipped:
+                out.write(f'\n... [{skipped} bytes skipped] ...\n'.encode())
+            out.writelines(tail)
+
+
+def read_excerpt(file_path:str, excerpt_bytes:int) -> str:
+    """
+    Возвращает фрагмент файла вывода не больше excerpt_bytes: файл целиком либо его начало и конец.
+    """
+    try:
+        size = os.path.getsize(file_path)
+        with open(file_path, 'rb') as file:
+            if size <= excerpt_bytes:
+                data = file.read()
+            else:
+                head = file.read(excerpt_bytes // 2)
+                file.seek(size - excerpt_bytes // 2)
+                data = head + f'\n... [{size - excerpt_bytes} bytes, see file] ...\n'.encode() + file.read()
+    except FileNotFoundError:
+        return ''
+    return data.decode(errors='replace').strip()
+
 
 def get_duration(duration_sec:float=0, start_time:int=0, cpu_start_time:int=0, precision:str='s') -> tuple:
     # Время завершения (общее)
@@ -0,0 +1,160 @@
+import json
+import os
+import signal
+import threading
+import time
+from src.utils import get_input_size
+
+
+class InputWatcher:
+    """
+    Наблюдение за папкой входных данных в режиме --watch: отбирает новые входные файлы, запись которых завершена, \
+        и отслеживает запросы на выполнение after_batch и на остановку наблюдения.
+    Файл считается готовым, если его размер и время изменения не менялись settle секунд (и существует файл-метка \
+        <путь><marker>, если marker задан): секвенаторы и программы копирования дописывают файлы постепенно.
+    Запросы принимаются сигналами (SIGUSR1 - выполнить after_batch, SIGTERM - завершить наблюдение) либо файлами \
+        watch_after_batch и watch_stop в папке логов запуска (удаляются после обработки).
+    Входные файлы, успешно обработанные первым модулем цепочки, записываются в файл состояния: после перезапуска \
+        наблюдения они не обрабатываются повторно, пока не изменятся их размер либо время изменения.
+    """
+    def __init__(self, control_dir:str, poll:float=10, settle:float=60, marker:str='', after_batch_interval:float=0,
+                 state_path:str=''):
+        """
+        :param control_dir: Папка файлов запросов (папка логов запуска).
+        :param state_path: Файл состояния (JSONL) с обработанными входными файлами; пустая строка - без сохранения.
+        :param poll: Интервал проверки папки входных данных, в секундах.
+        :param settle: Сколько секунд файл должен оставаться неизменным, чтобы считаться готовым.
+        :param marker: Суффикс файла-метки завершения записи (например, '.done'); пустая строка - без метки.
+        :param after_batch_interval: Интервал периодического выполнения after_batch, в секундах (0 - только по запросу).
+        """
+        self.control_dir = control_dir
+        self.poll = poll
+        self.settle = settle
+        self.marker = marker
+        self.after_batch_interval = after_batch_interval
+        # Наблюдаемые файлы: {путь: (размер, время изменения, время последнего изменения этих значений)}
+        self.candidates = {}
+        self.emitted = set()
+        self.state_path = state_path
+        # Обработанные файлы из файла состояния: {путь: (размер, время изменения)}
+        self.processed = self.load_state()
+        self.last_scan = 0
+        self.last_after_batch = time.time()
+        self.after_batch_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.previous_handlers = {}
+
+    def load_state(self) -> dict:
+        processed = {}
+        if not self.state_path:
+            return processed
+        try:
+            with open(self.state_path, 'r') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                        processed[record['path']] = (record['size'], record['mtime'])
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        # Строка, не дописанная из-за остановки процесса
+                        continue
+        except FileNotFoundError:
+            pass
+        return processed
+
+    def mark_processed(self, path:str):
+        """
+        Записывает в файл состояния входной файл, успешно обработанный первым модулем цепочки.
+        """
+        if not self.state_path:
+            return
+        path = os.path.normpath(path)
+        try:
+            signature = (get_input_size(path), os.stat(path).st_mtime)
+        except OSError:
+            return
+        self.processed[path] = signature
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        with open(self.state_path, 'a') as file:
+            file.write(json.dumps({'path': path, 'size': signature[0], 'mtime': signature[1]}, ensure_ascii=False) + '\n')
+
+    def install_signals(self):
+        """
+        Устанавливает обработчики SIGUSR1 и SIGTERM (только из основного потока).
+        """
+        self.previous_handlers = {signal.SIGUSR1: signal.signal(signal.SIGUSR1, lambda *_: self.after_batch_event.set()),
+                                  signal.SIGTERM: signal.signal(signal.SIGTERM, lambda *_: self.stop_event.set())}
+
+    def restore_signals(self):
+        for signum, handler in self.previous_handlers.items():
+            signal.signal(signum, handler)
+        self.previous_handlers = {}
+
+    def scan_due(self) -> bool:
+        return time.time() - self.last_scan >= self.poll
+
+    def ready(self, paths:list) -> list:
+        """
+        Принимает текущий список входных файлов и возвращает файлы, ставшие готовыми с прошлой проверки.
+        """
+        self.last_scan = now = time.time()
+        ready = []
+        for path in paths:
+            if path in self.emitted:
+                continue
+            try:
+                signature = (get_input_size(path), os.stat(path).st_mtime)
+            except OSError:
+                # Файл удалён либо переименован после обнаружения
+                self.candidates.pop(path, None)
+                continue
+            if self.processed.get(os.path.normpath(path)) == signature:
+                # Обработан до перезапуска наблюдения
+                self.emitted.add(path)
+                continue
+            previous = self.candidates.get(path)
+            if previous is None or previous[:2] != signature:
+                # Файл, не изменявшийся дольше settle к моменту обнаружения, готов сразу
+                since = min(now, signature[1]) if previous is None else now
+                self.candidates[path] = (*signature, since)
+            if now - self.candidates[path][2] < self.settle:
+                continue
+            if self.marker and not os.path.exists(f'{path}{self.marker}'):
+                continue
+            del self.candidates[path]
+            self.emitted.add(path)
+            ready.append(path)
+        return ready
+
+    def after_batch_due(self) -> bool:
+        """
+        Проверяет, пора ли выполнить after_batch: по запросу либо по истечении интервала.
+        """
+        requested = self.after_batch_event.is_set() or self.consume_request('watch_after_batch')
+        if self.after_batch_interval and time.time() - self.last_after_batch >= self.after_batch_interval:
+            requested = True
+        if requested:
+            self.after_batch_event.clear()
+            self.last_after_batch = time.time()
+        return requested
+
+    def stop_requested(self) -> bool:
+        return self.stop_event.is_set() or self.consume_request('watch_stop')
+
+    def consume_request(self, name:str) -> bool:
+        try:
+            os.remove(os.path.join(self.control_dir, name))
+            return True
+        except FileNotFoundError:
+            return False
+
+
+def create_input_watcher(machine_data:dict, log_dir:str, state_path:str='') -> InputWatcher:
+    """
+    Создаёт наблюдателя по настройкам машины (ключ watch: poll, settle, marker, after_batch_interval).
+
+    :param state_path: Файл состояния с обработанными входными файлами (см. InputWatcher).
+    """
+    options = machine_data.get('watch') or {}
+    return InputWatcher(control_dir=log_dir, poll=float(options.get('poll', 10)), settle=float(options.get('settle', 60)),
+                        marker=options.get('marker', ''), after_batch_interval=float(options.get('after_batch_interval', 0)),
+                        state_path=state_path)
@@ -0,0 +1,335 @@
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.utils import (load_templates, parse_size, interrupt_running_commands, interrupt_scope, write_json_atomic,
+                       INTERRUPT_EVENT, CMD_SCOPE)
+from src.scheduler import ResourcePool, create_disk_admission
+from src.backends import BatchBackend, run_task
+
+
+class WorkQueue(BatchBackend):
+    """
+    Очередь задач в общей папке (NFS, Lustre) для выполнения стадии batch на нескольких узлах.
+    Координатор (процесс пайплайна) публикует набор команд каждого образца файлом задачи; рабочие процессы \
+        (pipeline.py --worker) забирают задачи атомарным переименованием, выполняют их и записывают результаты.
+
+    Структура папки модуля: tasks/ - задачи, ожидающие выполнения; claimed/<задача>@<рабочий>.json - взятые задачи, \
+        время изменения которых обновляется рабочим (heartbeat); results/ - результаты; cancel - отмена (прерывание \
+        либо ошибка координатора): рабочие останавливают задачи модуля и не берут новые.
+    Задача, heartbeat которой не обновлялся дольше stale_after секунд, возвращается в tasks/.
+    Папка модуля удаляется, когда результаты всех задач зафиксированы; папки отменённых модулей - при следующем \
+        открытии очереди, когда рабочие заведомо заметили отмену.
+    """
+    def __init__(self, queue_dir:str, heartbeat:float=10, stale_after:float=120, poll:float=1):
+        """
+        :param queue_dir: Папка очереди (должна быть доступна координатору и всем рабочим).
+        :param heartbeat: Интервал обновления взятых задач рабочими, в секундах.
+        :param stale_after: Через сколько секунд без обновления задача считается брошенной.
+        :param poll: Интервал опроса папки очереди, в секундах.
+        """
+        self.queue_dir = queue_dir
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self.poll = poll
+
+    def open(self):
+        """
+        Подготавливает очередь к новому запуску пайплайна.
+        """
+        os.makedirs(self.queue_dir, exist_ok=True)
+        try:
+            os.remove(os.path.join(self.queue_dir, 'closed'))
+        except FileNotFoundError:
+            pass
+        self.remove_cancelled()
+
+    def remove_cancelled(self):
+        """
+        Удаляет папки модулей, отменённых дольше stale_after секунд назад.
+        """
+        now = time.time()
+        for entry in os.scandir(self.queue_dir):
+            try:
+                if entry.is_dir() and now - os.path.getmtime(os.path.join(entry.path, 'cancel')) > self.stale_after:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except FileNotFoundError:
+                continue
+
+    def close(self):
+        """
+        Отмечает, что новых задач не будет: рабочие, у которых нет задач, завершаются.
+        """
+        with open(os.path.join(self.queue_dir, 'closed'), 'w'):
+            pass
+
+    def run_batch(self, executor, module_stage:str, module_result_dict:dict, timeout_behavior:str,
+                  max_parallel_samples:int=1, resources:ResourcePool=None) -> bool:
+        """
+        Публикует задачи образцов стадии batch и фиксирует результаты по мере их поступления.
+
+        :param executor: CommandExecutor модуля.
+        :return: Флаг прерывания.
+        """
+        samples = list(executor.cmd_data[module_stage].keys())
+        module_dir = os.path.join(self.queue_dir, executor.log_section.replace(':', '-'))
+        for folder in ['tasks', 'claimed', 'results']:
+            os.makedirs(os.path.join(module_dir, folder), exist_ok=True)
+        tasks = {}
+        done = set()
+        interruption = False
+        try:
+            for i, sample in enumerate(samples):
+                task = f'{i:06d}_{sample}'
+                tasks[task] = sample
+                write_json_atomic(os.path.join(module_dir, 'tasks', f'{task}.json'),
+                                  self.make_task(executor=executor, module_stage=module_stage, sample=sample,
+                                                 timeout_behavior=timeout_behavior))
+            print(f'\t\tSamples: {len(samples)}, queue: {module_dir}')
+
+            start_time = time.time()
+            while len(done) < len(tasks) and not interruption:
+                new_results = [task for task in self.list_results(module_dir) if task in tasks and task not in done]
+                for task in new_results:
+                    result = self.read_json(os.path.join(module_dir, 'results', f'{task}.json'))
+                    if result is None:
+                        continue
+                    done.add(task)
+                    interruption = self.commit_result(executor=executor, module_stage=module_stage, sample=tasks[task],
+                                                      module_result_dict=module_result_dict, result=result) or interruption
+                    executor.report_progress(sample=tasks[task], unit_result=result['unit_result'], k=len(done),
+                                             total=len(tasks), start_time=start_time)
+                if not new_results:
+                    reclaimed = self.reclaim_stale(module_dir)
+                    if reclaimed and executor.metrics:
+                        executor.metrics.record_retry(module=executor.module, count=reclaimed)
+                    time.sleep(self.poll)
+        except KeyboardInterrupt:
+            print('INTERRUPTED')
+            INTERRUPT_EVENT.set()
+            interruption = True
+        finally:
+            if interruption or len(done) < len(tasks):
+                # Рабочие прекращают выполнение задач этого модуля; оставшиеся задачи не выполняются. \
+                #   Координатор, завершившийся ошибкой, тоже отменяет задачи, иначе их некому было бы зафиксировать
+                with open(os.path.join(module_dir, 'cancel'), 'w'):
+                    pass
+            else:
+                shutil.rmtree(module_dir, ignore_errors=True)
+        self.order_results(module_stage=module_stage, module_result_dict=module_result_dict, samples=samples)
+        return interruption
+
+    def reclaim_stale(self, module_dir:str) -> int:
+        """
+        Возвращает в очередь задачи, рабочие которых перестали обновлять heartbeat (например, узел вышел из строя).
+
+        :return: Количество возвращённых задач.
+        """
+        claimed_dir = os.path.join(module_dir, 'claimed')
+        now = time.time()
+        reclaimed = 0
+        for name in os.listdir(claimed_dir):
+            path = os.path.join(claimed_dir, name)
+            try:
+                if now - os.path.getmtime(path) < self.stale_after:
+                    continue
+            except FileNotFoundError:
+                continue
+            task = name.rsplit('@', 1)[0]
+            if os.path.exists(os.path.join(module_dir, 'results', f'{task}.json')):
+                continue
+            try:
+                os.rename(path, os.path.join(module_dir, 'tasks', f'{task}.json'))
+                print(f'\t\tЗадача {task} возвращена в очередь: рабочий {name.rsplit("@", 1)[1][:-5]} не отвечает')
+                reclaimed += 1
+            except FileNotFoundError:
+                pass
+        return reclaimed
+
+    @staticmethod
+    def list_results(module_dir:str) -> list:
+        return [name[:-5] for name in os.listdir(os.path.join(module_dir, 'results')) if name.endswith('.json')]
+
+class QueueWorker:
+    """
+    Рабочий процесс: забирает задачи из очереди, выполняет их и записывает результаты.
+    """
+    def __init__(self, queue:WorkQueue, slots:int=1, resources:ResourcePool=None, idle_exit:float=0):
+        """
+        :param queue: Очередь задач.
+        :param slots: Количество одновременно выполняемых задач.
+        :param resources: Пул ресурсов узла.
+        :param idle_exit: Завершить работу после стольких секунд без задач (0 - работать, пока очередь не закрыта).
+        """
+        self.queue = queue
+        self.slots = max(1, int(slots))
+        self.resources = resources
+        self.idle_exit = idle_exit
+        self.worker_id = f'{socket.gethostname()}-{os.getpid()}'
+        self.start_time = time.time()
+        # Взятые задачи: {путь к файлу claimed: (папка модуля, область выполнения команд задачи)}
+        self.claimed = {}
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+
+    def run(self):
+        """
+        Основной цикл рабочего.
+        """
+        print(f'Рабочий {self.worker_id}: очередь {self.queue.queue_dir}, задач одновременно: {self.slots}')
+        os.makedirs(self.queue.queue_dir, exist_ok=True)
+        heartbeat = threading.Thread(target=self.send_heartbeats, daemon=True)
+        heartbeat.start()
+        pool = ThreadPoolExecutor(max_workers=self.slots)
+        running = set()
+        idle_since = time.time()
+        try:
+            while not self.stop.is_set():
+                running = {future for future in running if not future.done()}
+                claimed = None
+                if len(running) < self.slots:
+                    claimed = self.claim_task()
+                if claimed:
+                    running.add(pool.submit(self.run_task, *claimed))
+                    idle_since = time.time()
+                    continue
+                if running:
+                    idle_since = time.time()
+                elif self.is_closed() or (self.idle_exit and time.time() - idle_since > self.idle_exit):
+                    break
+                self.cancel_running()
+                time.sleep(self.queue.poll)
+        except KeyboardInterrupt:
+            print('INTERRUPTED')
+            interrupt_running_commands()
+        finally:
+            pool.shutdown(wait=True)
+            self.stop.set()
+        print(f'Рабочий {self.worker_id} завершён')
+
+    def claim_task(self):
+        """
+        Забирает первую доступную задачу. Задачу получает только тот рабочий, чьё переименование прошло успешно.
+
+        :return: Кортеж (папка модуля, путь к взятой задаче, имя задачи, область выполнения команд задачи) либо None.
+        """
+        for module_dir in sorted(self.module_dirs()):
+            tasks_dir = os.path.join(module_dir, 'tasks')
+            if os.path.exists(os.path.join(module_dir, 'cancel')) or not os.path.isdir(tasks_dir):
+                continue
+            for name in sorted(os.listdir(tasks_dir)):
+                if not name.endswith('.json'):
+                    continue
+                task = name[:-5]
+                claimed_path = os.path.join(module_dir, 'claimed', f'{task}@{self.worker_id}.json')
+                try:
+                    os.rename(os.path.join(tasks_dir, name), claimed_path)
+                except FileNotFoundError:
+                    # Задачу забрал другой рабочий
+                    continue
+                os.utime(claimed_path)
+                scope = threading.Event()
+                with self.lock:
+                    self.claimed[claimed_path] = (module_dir, scope)
+                return (module_dir, claimed_path, task, scope)
+        return None
+
+    def run_task(self, module_dir:str, claimed_path:str, task:str, scope:threading.Event):
+        """
+        Выполняет задачу и записывает результат.
+
+        :param scope: Область выполнения команд задачи: при отмене модуля останавливаются только его команды.
+        """
+        token = CMD_SCOPE.set(scope)
+        try:
+            with open(claimed_path, 'r') as file:
+                data = json.load(file)
+            result = run_task(task=data, resources=self.resources)
+            # Отменённые задачи не записываются: координатор их уже не ждёт. Папки модуля может уже не быть, \
+            #   если задача была возвращена в очередь и выполнена другим рабочим
+            if not scope.is_set() and not os.path.exists(os.path.join(module_dir, 'cancel')):
+                try:
+                    write_json_atomic(os.path.join(module_dir, 'results', f'{task}.json'), {'worker': self.worker_id, **result})
+                except FileNotFoundError:
+                    pass
+        finally:
+            CMD_SCOPE.reset(token)
+            with self.lock:
+                self.claimed.pop(claimed_path, None)
+            try:
+                os.remove(claimed_path)
+            except FileNotFoundError:
+                pass
+
+    def send_heartbeats(self):
+        """
+        Периодически обновляет время изменения взятых задач, чтобы координатор не счёл их брошенными.
+        """
+        while not self.stop.wait(self.queue.heartbeat):
+            with self.lock:
+                claimed = list(self.claimed)
+            for claimed_path in claimed:
+                try:
+                    os.utime(claimed_path)
+                except FileNotFoundError:
+                    # Задача уже завершена либо возвращена в очередь координатором
+                    pass
+
+    def cancel_running(self):
+        """
+        Останавливает команды задач отменённых модулей; задачи остальных модулей продолжают выполняться.
+        """
+        with self.lock:
+            claimed = list(self.claimed.values())
+        cancelled = {}
+        for module_dir, scope in claimed:
+            if scope.is_set():
+                continue
+            if module_dir not in cancelled:
+                cancelled[module_dir] = os.path.exists(os.path.join(module_dir, 'cancel'))
+            if cancelled[module_dir]:
+                print(f'Рабочий {self.worker_id}: задачи {os.path.basename(module_dir)} отменены')
+                interrupt_scope(scope)
+
+    def module_dirs(self) -> list:
+        return [entry.path for entry in os.scandir(self.queue.queue_dir) if entry.is_dir()]
+
+    def is_closed(self) -> bool:
+        """
+        Очередь закрыта координатором после начала работы рабочего.
+        """
+        try:
+            return os.path.getmtime(os.path.join(self.queue.queue_dir, 'closed')) >= self.start_time
+        except FileNotFoundError:
+            return False
+
+
+def create_work_queue(machine_data:dict, output_dir:str) -> WorkQueue:
+    """
+    Создаёт очередь задач по настройкам машины (ключ queue: dir, heartbeat, stale_after, poll).
+    """
+    options = machine_data.get('queue') or {}
+    return WorkQueue(queue_dir=options.get('dir', os.path.join(output_dir, '.pipeline_queue')),
+                     heartbeat=float(options.get('heartbeat', 10)), stale_after=float(options.get('stale_after', 120)),
+                     poll=float(options.get('poll', 1)))
+
+
+def run_worker(args:dict):
+    """
+    Запускает рабочий процесс с настройками проекта и машины (без создания папки логов запуска).
+    """
+    templates = load_templates(os.path.join(args['project_path'], 'config'), ['machines_template'])
+    machine_data = templates['machines_template'][args['machine']]
+    resources = None
+    disk = create_disk_admission(machine_data)
+    if machine_data.get('max_threads') or machine_data.get('max_memory') or disk:
+        resources = ResourcePool(threads=int(machine_data.get('max_threads', 0)),
+                                 memory=parse_size(machine_data.get('max_memory', 0)), disk=disk)
+    slots = machine_data.get('max_parallel_samples', machine_data.get('max_threads', 1))
+    options = machine_data.get('queue') or {}
+    worker = QueueWorker(queue=create_work_queue(machine_data=machine_data, output_dir=args['output_dir']),
+                         slots=slots, resources=resources, idle_exit=float(options.get('idle_exit', 0)))
+    worker.run()
@@ -0,0 +1,159 @@
+import json
+import os
+import signal
+import threading
+import time
+import pytest
+from src.async_engine import AsyncEngine
+from src.backends import run_task
+from src.command_executor import CommandExecutor
+from src.log_sink import JsonlLogSink
+from src.scheduler import ResourcePool, DiskAdmission
+from src.utils import INTERRUPT_EVENT, RUNNING_PROCESSES, run_cmds
+
+
+def wait_for(condition, timeout:float=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'условие не выполнено за отведённое время'
+        time.sleep(0.05)
+
+
+def make_task(tmp_path, cmds:dict, disk_footprint:dict=None) -> dict:
+    return {'module': 'work', 'stage': 'batch', 'sample': 's1', 'cmds': cmds, 'timeout_behavior': 'next',
+            'debug': '', 'capture': {}, 'output_dir': str(tmp_path), 'cache': None, 'completed': {},
+            'disk_footprint': disk_footprint}
+
+
+def test_run_task_reserves_disk_footprint(tmp_path):
+    disk = DiskAdmission(poll=0.1)
+    reserved = []
+    acquire = disk.acquire
+
+    def record(**kwargs):
+        reservation = acquire(**kwargs)
+        reserved.append(dict(disk.reserved))
+        return reservation
+
+    disk.acquire = record
+    task = make_task(tmp_path, cmds={'noop': ['true', 0, {}]}, disk_footprint={'path': str(tmp_path), 'size': 1024})
+    result = run_task(task, resources=ResourcePool(disk=disk))
+
+    assert result['status'] and result['exit_codes'] == {'noop': 0}
+    assert list(reserved[0].values()) == [1024]
+    # После выполнения резерв снят
+    assert set(disk.reserved.values()) == {0}
+
+
+def test_run_task_footprint_that_cannot_fit(tmp_path):
+    task = make_task(tmp_path, cmds={'noop': ['true', 0, {}], 'next': ['true', 0, {}]},
+                     disk_footprint={'path': str(tmp_path), 'size': 2 ** 70})
+    result = run_task(task, resources=ResourcePool(disk=DiskAdmission(poll=0.1)))
+
+    assert not result['status'] and not result['interruption']
+    assert result['exit_codes'] == {'noop': 'NO_SPACE', 'next': 'NO_SPACE'}
+    assert 'недостаточно места' in result['unit_result']['stderr']['noop']
+
+
+@pytest.fixture
+def interrupt_event():
+    # Прерывание пайплайна - общий флаг процесса; тесты прерывания не должны влиять на следующие тесты
+    INTERRUPT_EVENT.clear()
+    yield INTERRUPT_EVENT
+    INTERRUPT_EVENT.clear()
+
+
+def run_async_batch(tmp_path, batch:dict, timeout_behavior:str='', parallel:int=1) -> tuple:
+    log_sink = JsonlLogSink(str(tmp_path / 'log.jsonl'))
+    executor = CommandExecutor(cmd_data={'before_batch': {}, 'batch': batch, 'after_batch': {}},
+                               log_space={'log_dir': str(tmp_path)}, log_sink=log_sink, module='work', debug='')
+    result = {'status': True, 'batch': {}}
+    try:
+        interruption = AsyncEngine(max_commands=4).run_batch(executor=executor, module_stage='batch',
+                                                             module_result_dict=result, timeout_behavior=timeout_behavior,
+                                                             max_parallel_samples=parallel)
+    finally:
+        log_sink.close()
+    return (result, interruption)
+
+
+@pytest.mark.parametrize('timeout_behavior, exit_codes', [('', {'slow': 'TIMEOUT'}),
+                                                          ('next', {'slow': 'TIMEOUT', 'next': 0})])
+def test_async_engine_timeout(tmp_path, interrupt_event, timeout_behavior, exit_codes):
+    batch = {'s1': {'slow': ['sleep 10', 1, {}], 'next': ['true', 0, {}]}, 's2': {'fast': ['true', 0, {}]}}
+    started = time.monotonic()
+    result, interruption = run_async_batch(tmp_path, batch, timeout_behavior=timeout_behavior, parallel=2)
+
+    assert time.monotonic() - started < 5
+    assert not interruption
+    assert not result['batch']['s1']['status']
+    assert result['batch']['s1']['programms'] == exit_codes
+    assert result['batch']['s2']['programms'] == {'fast': 0}
+
+
+def test_async_engine_sigint_skips_unstarted_samples(tmp_path, interrupt_event):
+    batch = {f's{i}': {'slow': ['sleep 10', 0, {}]} for i in range(3)}
+
+    def interrupt():
+        wait_for(lambda: RUNNING_PROCESSES)
+        os.kill(os.getpid(), signal.SIGINT)
+
+    threading.Thread(target=interrupt, daemon=True).start()
+    started = time.monotonic()
+    result, interruption = run_async_batch(tmp_path, batch)
+
+    assert time.monotonic() - started < 5
+    assert interruption
+    assert list(result['batch']) == ['s0']
+    assert result['batch']['s0']['programms'] == {'slow': 'INTERRUPTED'}
+    assert not RUNNING_PROCESSES
+
+
+@pytest.mark.parametrize('pidfd', [True, False])
+def test_async_engine_exit_codes_and_resources(tmp_path, interrupt_event, monkeypatch, pidfd):
+    # Ожидание процессов через pidfd и без него (опрос os.wait4) даёт одинаковые коды выхода и ресурсы
+    if not pidfd:
+        monkeypatch.delattr(os, 'pidfd_open', raising=False)
+    batch = {'s1': {'ok': ['sleep 0.2', 0, {}], 'fail': ['sleep 0.1; exit 3', 0, {}]}}
+    result, interruption = run_async_batch(tmp_path, batch, timeout_behavior='next')
+
+    assert not interruption
+    assert result['batch']['s1']['programms'] == {'ok': 0, 'fail': 3}
+    with open(tmp_path / 'log.jsonl') as file:
+        logs = [json.loads(line) for line in file]
+    commands = next(record['log'] for record in logs if record['type'] == 'unit' and record['sample'] == 's1')
+    assert commands['fail']['exit_code'] == 3
+    # Ресурсы команды получены через os.wait4
+    assert commands['ok']['exit_code'] == 0 and commands['ok']['max_rss_bytes'] > 0
+
+
+def run_unit_cmds(tmp_path, engine:str, cmds:dict, timeout_behavior:str='') -> dict:
+    if engine == 'async':
+        result, _ = run_async_batch(tmp_path, {'s1': cmds}, timeout_behavior=timeout_behavior)
+        return result['batch']['s1']['programms']
+    _, exit_codes, _, _ = run_cmds(cmds=cmds, debug='', timeout_behavior=timeout_behavior, sample='s1')
+    return exit_codes
+
+
+@pytest.mark.parametrize('engine', ['local', 'async'])
+def test_cmd_graph_dependencies(tmp_path, interrupt_event, engine):
+    # depends_on одной команды не меняет обработку ошибок остальных: ошибка не останавливает следующую команду \
+    #   без depends_on, как при последовательном выполнении; явно зависящие команды пропускаются, always - выполняются
+    cmds = {'fail': ['exit 1', 0, {}], 'next': ['true', 0, {}], 'needs_fail': ['true', 0, {'depends_on': ['fail']}],
+            'after_skipped': ['true', 0, {}], 'cleanup': ['true', 0, {'depends_on': ['needs_fail'], 'always': True}],
+            'needs_skipped': ['true', 0, {'depends_on': ['needs_fail']}]}
+    assert run_unit_cmds(tmp_path, engine, cmds) == {'fail': 1, 'next': 0, 'needs_fail': 'SKIPPED', 'after_skipped': 0,
+                                                     'cleanup': 0, 'needs_skipped': 'SKIPPED'}
+    sequential = {title: cmd_opts for title, cmd_opts in cmds.items() if 'depends_on' not in cmd_opts[2]}
+    assert run_unit_cmds(tmp_path, engine, sequential) == {'fail': 1, 'next': 0, 'after_skipped': 0}
+
+
+@pytest.mark.parametrize('engine', ['local', 'async'])
+def test_cmd_graph_timeout_stops_following_commands(tmp_path, interrupt_event, engine):
+    # Таймаут останавливает следующие команды так же, как при последовательном выполнении; независимая ветвь выполняется
+    cmds = {'slow': ['sleep 10', 1, {}], 'next': ['true', 0, {}], 'after_next': ['true', 0, {}],
+            'independent': ['true', 0, {'depends_on': []}]}
+    assert run_unit_cmds(tmp_path, engine, cmds) == {'slow': 'TIMEOUT', 'next': 'SKIPPED', 'after_next': 'SKIPPED',
+                                                     'independent': 0}
+    assert run_unit_cmds(tmp_path, engine, cmds, timeout_behavior='next') == {'slow': 'TIMEOUT', 'next': 0,
+                                                                              'after_next': 0, 'independent': 0}
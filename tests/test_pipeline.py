@@ -0,0 +1,524 @@
+import glob
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import pytest
+import yaml
+from src.log_sink import read_records
+from src.pipeline_manager import PipelineManager
+from src.utils import INTERRUPT_EVENT
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ARG_PARSER = """import argparse
+def parse_cli_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-pp', '--project_path', required=True)
+    parser.add_argument('-m', '--modules', nargs='+', default={modules!r})
+    parser.add_argument('-i', '--input_dir', default={input_dir!r})
+    parser.add_argument('-o', '--output_dir', default={output_dir!r})
+    parser.add_argument('--machine', default='test')
+    parser.add_argument('--include_samples', nargs='*', default=[])
+    parser.add_argument('--exclude_samples', nargs='*', default=[])
+    parser.add_argument('--debug', nargs='*', default=[])
+    parser.add_argument('--subfolders', action='store_true')
+    return vars(parser.parse_args())
+"""
+
+
+def write_project(path, machine:dict, modules:dict, commands:dict, samples:list):
+    """
+    Создаёт проект: конфиги машины test, модулей и команд, парсер аргументов (для запуска pipeline.py) \
+        и папку входных данных in с пустыми образцами.
+    """
+    config = os.path.join(path, 'config')
+    os.makedirs(config)
+    os.makedirs(os.path.join(path, 'in'))
+    os.makedirs(os.path.join(path, 'src'))
+    with open(os.path.join(path, 'src', 'arg_parser.py'), 'w') as file:
+        file.write(ARG_PARSER.format(modules=modules['sequence'], input_dir=os.path.join(path, 'in'),
+                                     output_dir=os.path.join(path, 'out')))
+    machines = {'test': {'binaries': {}, 'cache': False, 'history_runs': 0, **machine}}
+    for name, data in [('machines_template', machines), ('modules_template', modules), ('cmds_template', commands)]:
+        with open(os.path.join(config, f'{name}.yaml'), 'w') as file:
+            yaml.safe_dump(data, file, sort_keys=False)
+    for sample in samples:
+        open(os.path.join(path, 'in', sample), 'w').close()
+
+
+def make_module(result_dir:str, extensions:list, module_before:str='', sample_level:list=None, filenames:dict=None,
+                **options) -> dict:
+    return {'folders': {'input_dir': {}, 'output_dir': {result_dir: result_dir}}, 'source_extensions': extensions,
+            'subfolders': False, 'module_before': module_before, 'result_dir': result_dir,
+            'filenames': {'basename': "f'{os.path.basename(sample).split(\".\")[0]}'", **(filenames or {})},
+            'commands': {'before_batch': [], 'sample_level': sample_level or [], 'after_batch': []}, **options}
+
+
+def run_pipeline(path, modules:list, resume:str='') -> PipelineManager:
+    args = {'project_path': str(path), 'modules': modules, 'input_dir': os.path.join(path, 'in'),
+            'output_dir': os.path.join(path, 'out'), 'machine': 'test', 'include_samples': [], 'exclude_samples': [],
+            'debug': [], 'subfolders': False, 'resume': resume, 'worker': False, 'watch': False}
+    pipeline = PipelineManager(args)
+    pipeline.run_pipeline()
+    return pipeline
+
+
+def read_status(pipeline:PipelineManager) -> dict:
+    with open(pipeline.status_log) as file:
+        return yaml.safe_load(file)
+
+
+def test_stream_chain_after_barrier(tmp_path):
+    # Цепочка check -> check2 начинается модулем с барьером: его входные данные - результаты prepare из предыдущей цепочки
+    modules = {
+        'sequence': ['prepare', 'check', 'check2'],
+        'prepare': make_module('prepared', ['.fastq'], sample_level=['make_txt'],
+                               filenames={'txt': "f'{folders[\"prepared\"]}{filenames[\"basename\"]}.txt'"}),
+        'check': make_module('checked', ['.txt'], module_before='prepare', stream_barrier=True, sample_level=['make_csv'],
+                             filenames={'csv': "f'{folders[\"checked\"]}{filenames[\"basename\"]}.csv'"}),
+        'check2': make_module('checked2', ['.csv'], module_before='check', sample_level=['noop']),
+    }
+    commands = {'make_txt': "f'touch {filenames[\"txt\"]}'", 'make_csv': "f'touch {filenames[\"csv\"]}'", 'noop': 'true'}
+    write_project(tmp_path, machine={'stream_modules': True, 'max_parallel_samples': 2}, modules=modules,
+                  commands=commands, samples=['s1.fastq', 's2.fastq'])
+    pipeline = run_pipeline(tmp_path, ['prepare', 'check', 'check2'])
+
+    status = read_status(pipeline)
+    assert status['status']
+    assert sorted(status['modules']['check']['batch']) == ['s1', 's2']
+    assert sorted(status['modules']['check2']['batch']) == ['s1', 's2']
+
+
+def test_stream_chain_limits_samples_per_module(tmp_path):
+    # Модуль check обрабатывает по одному образцу, хотя prepare и пул потоков цепочки - по четыре
+    lock = os.path.join(tmp_path, 'out', 'check.lock')
+    modules = {
+        'sequence': ['prepare', 'check'],
+        'prepare': make_module('prepared', ['.fastq'], sample_level=['make_txt'],
+                               filenames={'txt': "f'{folders[\"prepared\"]}{filenames[\"basename\"]}.txt'"}),
+        'check': make_module('checked', ['.txt'], module_before='prepare', sample_level=['exclusive'],
+                             max_parallel_samples=1),
+    }
+    commands = {'make_txt': "f'touch {filenames[\"txt\"]}'", 'exclusive': f'mkdir {lock} && sleep 0.2 && rmdir {lock}'}
+    write_project(tmp_path, machine={'stream_modules': True, 'max_parallel_samples': 4}, modules=modules,
+                  commands=commands, samples=[f's{i}.fastq' for i in range(4)])
+    pipeline = run_pipeline(tmp_path, ['prepare', 'check'])
+
+    status = read_status(pipeline)
+    assert status['status']
+    assert sorted(status['modules']['check']['batch']) == [f's{i}' for i in range(4)]
+
+
+def test_parallel_samples_commit_in_sample_order(tmp_path):
+    # Образцы завершаются в обратном порядке, но результаты и логи фиксируются в порядке образцов
+    order = os.path.join(tmp_path, 'order.txt')
+    commands = {'first': f"f'sleep {{0.2 * (3 - int(filenames[\"basename\"][1:]))}} && echo {{filenames[\"basename\"]}} first >> {order}'",
+                'second': f"f'echo {{filenames[\"basename\"]}} second >> {order}'"}
+    modules = {'sequence': ['work'], 'work': make_module('done', ['.fastq'], sample_level=['first', 'second'])}
+    write_project(tmp_path, machine={'max_parallel_samples': 4, 'sample_order': 'discovery'}, modules=modules,
+                  commands=commands, samples=[f's{i}.fastq' for i in range(4)])
+    pipeline = run_pipeline(tmp_path, ['work'])
+
+    samples = [f's{i}' for i in range(4)]
+    assert list(read_status(pipeline)['modules']['work']['batch']) == samples
+    with open(order) as file:
+        lines = file.read().split('\n')[:-1]
+    # Образцы выполнялись одновременно: первым завершился последний
+    assert lines[0] == 's3 first'
+    assert all(lines.index(f'{sample} first') < lines.index(f'{sample} second') for sample in samples)
+    units = [record['sample'] for record in read_records(pipeline.log_records)
+             if record.get('type') == 'unit' and record['unit'] == 'batch']
+    assert units == samples
+
+
+def test_result_cache_hit_and_invalidation(tmp_path):
+    # Команда пропускается, пока не изменились её строка, входной файл и на месте выходной файл
+    runs = os.path.join(tmp_path, 'runs.txt')
+    commands = {'make_txt': {'cmd': f"f'cat {{filenames[\"input\"]}} > {{filenames[\"txt\"]}} && echo run >> {runs}'",
+                             'inputs': ['input'], 'outputs': ['txt']}}
+    filenames = {'input': "f'{sample}'", 'txt': "f'{folders[\"done\"]}{filenames[\"basename\"]}.txt'"}
+    modules = {'sequence': ['work'], 'work': make_module('done', ['.fastq'], sample_level=['make_txt'], filenames=filenames)}
+    write_project(tmp_path, machine={'cache': True}, modules=modules, commands=commands, samples=['s1.fastq'])
+    sample, output = os.path.join(tmp_path, 'in', 's1.fastq'), os.path.join(tmp_path, 'out', 'done', 's1.txt')
+
+    def run() -> dict:
+        pipeline = run_pipeline(tmp_path, ['work'])
+        assert read_status(pipeline)['status']
+        with open(runs) as file:
+            executions = len(file.readlines())
+        log = [record for record in read_records(pipeline.log_records) if record.get('unit') == 'batch'][-1]['log']
+        return executions, log['make_txt'].get('cache')
+
+    assert run() == (1, None)
+    assert run() == (1, 'HIT')
+    with open(sample, 'w') as file:
+        file.write('@r\nACGT\n+\nIIII\n')
+    assert run() == (2, None)
+    assert run() == (2, 'HIT')
+    os.remove(output)
+    assert run() == (3, None) and os.path.exists(output)
+
+
+def test_resume_runs_only_unfinished_commands(tmp_path):
+    # s2 падает на второй команде; при возобновлении выполняется только она
+    runs = os.path.join(tmp_path, 'runs.txt')
+    ready = os.path.join(tmp_path, 'ready')
+    commands = {'first': f"f'echo {{filenames[\"basename\"]}} first >> {runs}'",
+                'second': f"f'test {{filenames[\"basename\"]}} = s1 -o -e {ready} && echo {{filenames[\"basename\"]}} second >> {runs}'"}
+    modules = {'sequence': ['work'], 'work': make_module('done', ['.fastq'], sample_level=['first', 'second'])}
+    write_project(tmp_path, machine={}, modules=modules, commands=commands, samples=['s1.fastq', 's2.fastq'])
+    pipeline = run_pipeline(tmp_path, ['work'])
+    assert read_status(pipeline)['modules']['work']['batch']['s2']['programms']['second'] != 0
+
+    open(ready, 'w').close()
+    pipeline = run_pipeline(tmp_path, ['work'], resume=pipeline.log_dir)
+    status = read_status(pipeline)
+    assert status['status'] and status['modules']['work']['batch']['s2']['programms'] == {'first': 0, 'second': 0}
+    with open(runs) as file:
+        assert file.read().split('\n')[:-1] == ['s1 first', 's1 second', 's2 first', 's2 second']
+    logs = {record['sample']: record['log'] for record in read_records(pipeline.log_records) if record.get('unit') == 'batch'}
+    assert logs['s1']['first'].get('resumed') and logs['s1']['second'].get('resumed')
+    assert logs['s2']['first'].get('resumed') and not logs['s2']['second'].get('resumed')
+
+
+def test_plan_cache_disabled_by_default(tmp_path):
+    modules = {'sequence': ['work'], 'work': make_module('done', ['.fastq'], sample_level=['noop'])}
+    write_project(tmp_path, machine={}, modules=modules, commands={'noop': 'true'}, samples=['s1.fastq'])
+    pipeline = run_pipeline(tmp_path, ['work'])
+
+    assert read_status(pipeline)['status']
+    assert not os.path.exists(os.path.join(tmp_path, 'out', '.pipeline_plan_cache'))
+
+
+def test_logs_exported_on_error(tmp_path):
+    # Второй модуль не находит образцов и прерывает запуск исключением; логи первого модуля должны быть сформированы
+    modules = {
+        'sequence': ['prepare', 'check'],
+        'prepare': make_module('prepared', ['.fastq'], sample_level=['noop']),
+        'check': make_module('checked', ['.txt'], module_before='prepare', sample_level=['noop']),
+    }
+    write_project(tmp_path, machine={'max_parallel_samples': 2}, modules=modules, commands={'noop': 'true'},
+                  samples=['s1.fastq'])
+    with pytest.raises(ValueError):
+        run_pipeline(tmp_path, ['prepare', 'check'])
+
+    log_dir = next(os.scandir(os.path.join(tmp_path, 'out', 'Logs'))).path
+    for name in ['log.yaml', 'stdout_log.txt', 'stderr_log.txt']:
+        assert os.path.isfile(os.path.join(log_dir, name))
+    with open(os.path.join(log_dir, 'log.yaml')) as file:
+        logs = yaml.safe_load(file)
+    assert any(section.startswith('prepare_') and 's1' in data['batch'] for section, data in logs.items())
+
+
+def start_pipeline(path, *args, output=None) -> subprocess.Popen:
+    """
+    Запускает pipeline.py проекта отдельным процессом (в своей группе процессов).
+    """
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, 'pipeline.py'), '-pp', str(path), *args], cwd=ROOT,
+                            stdout=output or subprocess.DEVNULL, stderr=subprocess.STDOUT, start_new_session=True)
+
+
+def wait_for(condition, timeout:float=30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'условие не выполнено за отведённое время'
+        time.sleep(0.05)
+
+
+def queue_machine(path, slots:int) -> dict:
+    return {'executor': 'queue', 'max_parallel_samples': slots,
+            'queue': {'dir': os.path.join(path, 'queue'), 'heartbeat': 0.2, 'stale_after': 2, 'poll': 0.1}}
+
+
+def queue_log_dir(path) -> str:
+    return glob.glob(os.path.join(path, 'out', 'Logs', '*'))[0]
+
+
+def test_work_queue_workers_reclaim_killed_worker(tmp_path):
+    modules = {'sequence': ['work'], 'work': make_module('done', ['.fastq'], sample_level=['work'])}
+    write_project(tmp_path, machine=queue_machine(tmp_path, slots=1), modules=modules, commands={'work': 'sleep 1'},
+                  samples=[f's{i}.fastq' for i in range(6)])
+    queue_dir = os.path.join(tmp_path, 'queue')
+    # Первый рабочий берёт задачу и "выходит из строя" вместе со своими командами
+    failed = start_pipeline(tmp_path, '--worker')
+    coordinator = start_pipeline(tmp_path)
+    wait_for(lambda: glob.glob(os.path.join(queue_dir, '*', 'claimed', '*')))
+    os.killpg(failed.pid, signal.SIGKILL)
+    failed.wait()
+    outputs = [open(os.path.join(tmp_path, f'worker{i}.txt'), 'w') for i in range(2)]
+    workers = [start_pipeline(tmp_path, '--worker', output=output) for output in outputs]
+
+    assert coordinator.wait(timeout=60) == 0
+    # Закрытая очередь завершает простаивающих рабочих
+    for worker in workers:
+        assert worker.wait(timeout=10) == 0
+    log_dir = queue_log_dir(tmp_path)
+    with open(os.path.join(log_dir, 'status_log.yaml')) as file:
+        status = yaml.safe_load(file)
+    assert status['status']
+    assert sorted(status['modules']['work']['batch']) == [f's{i}' for i in range(6)]
+    with open(os.path.join(log_dir, 'status.json')) as file:
+        assert json.load(file)['metrics']['commands']['retries'] >= 1
+    # Задачи распределены между рабочими, папка модуля удалена после фиксации результатов
+    for output in outputs:
+        output.close()
+        with open(output.name) as file:
+            assert 'work:' in file.read()
+    assert [entry.name for entry in os.scandir(queue_dir) if entry.is_dir()] == []
+
+
+def test_work_queue_cancel_stops_only_cancelled_module(tmp_path):
+    modules = {'sequence': ['work'], 'work': make_module('done', ['.fastq'], sample_level=['work'])}
+    write_project(tmp_path, machine=queue_machine(tmp_path, slots=3), modules=modules, commands={'work': 'sleep 30'},
+                  samples=['s1.fastq', 's2.fastq'])
+    # Задача другого запуска в той же очереди: отмена модуля не должна её затронуть
+    other_dir = os.path.join(tmp_path, 'queue', 'aaa_other')
+    for folder in ['tasks', 'claimed', 'results']:
+        os.makedirs(os.path.join(other_dir, folder))
+    task = {'module': 'other', 'stage': 'batch', 'sample': 'x', 'cmds': {'other': ['sleep 3', 0]}, 'timeout_behavior': '',
+            'debug': '', 'capture': {}, 'output_dir': '', 'cache': None, 'completed': {}}
+    with open(os.path.join(other_dir, 'tasks', '000000_x.json'), 'w') as file:
+        json.dump(task, file)
+
+    worker = start_pipeline(tmp_path, '--worker')
+    coordinator = start_pipeline(tmp_path)
+    claimed = lambda: glob.glob(os.path.join(tmp_path, 'queue', '*', 'claimed', '*'))
+    wait_for(lambda: len(claimed()) == 3)
+    start = time.monotonic()
+    coordinator.send_signal(signal.SIGINT)
+    coordinator.wait(timeout=30)
+
+    # Команды отменённого модуля остановлены, задача другого запуска выполнена тем же рабочим
+    wait_for(lambda: [path for path in claimed() if 'aaa_other' not in path] == [], timeout=10)
+    wait_for(lambda: os.path.exists(os.path.join(other_dir, 'results', '000000_x.json')), timeout=10)
+    with open(os.path.join(other_dir, 'results', '000000_x.json')) as file:
+        assert json.load(file)['status']
+    assert worker.wait(timeout=10) == 0
+    assert time.monotonic() - start < 20
+    module_dirs = [path for path in glob.glob(os.path.join(tmp_path, 'queue', '*')) if os.path.isdir(path) and path != other_dir]
+    assert all(os.path.exists(os.path.join(path, 'cancel')) for path in module_dirs)
+    assert os.listdir(os.path.join(module_dirs[0], 'results')) == []
+
+
+def slurm_machine(**options) -> dict:
+    return {'executor': 'slurm', 'slurm': {'fake': True, 'poll': 0.2, **options}}
+
+
+def test_slurm_fake_job_states(tmp_path, monkeypatch):
+    monkeypatch.setenv('FAKE_SLURM_DIR', str(tmp_path / 'slurm_state'))
+    # ok - задание завершается; crash - процесс задания падает, не записав результат; slow - превышает лимит времени
+    command = ("f'case {filenames[\"basename\"]} in crash) kill -9 $PPID;; slow) sleep 30;; esac; "
+               "touch {folders[\"done\"]}{filenames[\"basename\"]}'")
+    modules = {'sequence': ['work'], 'work': make_module('done', ['.fastq'], sample_level=['work'])}
+    write_project(tmp_path, machine=slurm_machine(time='0:03'), modules=modules, commands={'work': command},
+                  samples=['ok.fastq', 'crash.fastq', 'slow.fastq'])
+    # Сбой sacct при первом опросе не прерывает модуль
+    from src.slurm import SlurmBackend
+    query = SlurmBackend.query
+    calls = []
+    def failing_query(self, job_ids):
+        calls.append(job_ids)
+        if len(calls) == 1:
+            raise RuntimeError('sacct: error: Slurm controller not responding')
+        return query(self, job_ids)
+    monkeypatch.setattr(SlurmBackend, 'query', failing_query)
+
+    pipeline = run_pipeline(tmp_path, ['work'])
+    batch = read_status(pipeline)['modules']['work']['batch']
+    assert len(calls) > 1
+    assert batch['ok']['status'] and batch['ok']['job']['state'] == 'COMPLETED'
+    assert batch['crash']['job']['state'] == 'FAILED'
+    assert batch['crash']['programms']['work'] == 'SLURM_FAILED'
+    assert batch['slow']['job']['state'] == 'TIMEOUT'
+    assert batch['slow']['programms']['work'] == 'SLURM_TIMEOUT'
+    job = batch['ok']['job']
+    assert set(job) == {'job_id', 'state', 'exit_code', 'elapsed_sec', 'max_rss_bytes', 'total_cpu_sec', 'node'}
+    assert job['exit_code'] == '0:0' and job['node'] and job['max_rss_bytes'] > 0
+    assert batch['slow']['job']['elapsed_sec'] >= 3
+
+
+def test_slurm_job_missing_from_accounting_fails(tmp_path, monkeypatch):
+    # Задание, которого нет в sacct дольше missing_timeout, не опрашивается бесконечно, а отмечается ошибкой
+    monkeypatch.setenv('FAKE_SLURM_DIR', str(tmp_path / 'slurm_state'))
+    command = "f'case {filenames[\"basename\"]} in lost) sleep 3;; esac; touch {folders[\"done\"]}{filenames[\"basename\"]}'"
+    modules = {'sequence': ['work'], 'work': make_module('done', ['.fastq'], sample_level=['work'])}
+    write_project(tmp_path, machine=slurm_machine(missing_timeout=0.5), modules=modules, commands={'work': command},
+                  samples=['ok.fastq', 'lost.fastq'])
+    from src.slurm import SlurmBackend
+    submit, query = SlurmBackend.submit, SlurmBackend.query
+    lost = []
+    def lost_submit(self, sample, **kwargs):
+        job_id = submit(self, sample=sample, **kwargs)
+        if sample == 'lost':
+            lost.append(job_id)
+        return job_id
+    def lost_query(self, job_ids):
+        return {job_id: job for job_id, job in query(self, job_ids).items() if job_id not in lost}
+    monkeypatch.setattr(SlurmBackend, 'submit', lost_submit)
+    monkeypatch.setattr(SlurmBackend, 'query', lost_query)
+
+    start = time.monotonic()
+    pipeline = run_pipeline(tmp_path, ['work'])
+    batch = read_status(pipeline)['modules']['work']['batch']
+    assert time.monotonic() - start < 3
+    assert batch['ok']['status'] and batch['ok']['job']['state'] == 'COMPLETED'
+    assert not batch['lost']['status'] and batch['lost']['job']['state'] == 'MISSING'
+    assert batch['lost']['programms']['work'] == 'SLURM_MISSING'
+
+
+def test_slurm_fake_scancel_on_interrupt(tmp_path, monkeypatch):
+    state_dir = tmp_path / 'slurm_state'
+    monkeypatch.setenv('FAKE_SLURM_DIR', str(state_dir))
+    modules = {'sequence': ['work'], 'work': make_module('done', ['.fastq'], sample_level=['work'])}
+    write_project(tmp_path, machine=slurm_machine(), modules=modules, commands={'work': 'sleep 30'},
+                  samples=['s1.fastq', 's2.fastq'])
+    coordinator = start_pipeline(tmp_path)
+
+    def job_states() -> list:
+        states = []
+        for path in glob.glob(str(state_dir / 'jobs' / '*.json')):
+            with open(path) as file:
+                states.append(json.load(file)['state'])
+        return states
+    wait_for(lambda: job_states() == ['RUNNING', 'RUNNING'])
+    coordinator.send_signal(signal.SIGINT)
+    coordinator.wait(timeout=30)
+    assert job_states() == ['CANCELLED', 'CANCELLED']
+
+
+@pytest.mark.parametrize('executor', ['local', 'async'])
+def test_disk_footprint_that_cannot_fit_fails_sample(tmp_path, executor):
+    # Объём образца больше диска, и его не освободит ни один образец пайплайна: образец завершается ошибкой, а не ждёт
+    modules = {'sequence': ['work'], 'work': make_module('done', ['.fastq'], sample_level=['noop'],
+                                                         disk_footprint='1000000T')}
+    machine = {'executor': executor, 'max_parallel_samples': 2, 'disk': {'min_free': 0, 'poll': 0.1}}
+    write_project(tmp_path, machine=machine, modules=modules, commands={'noop': 'true'}, samples=['s1.fastq'])
+    pipeline = run_pipeline(tmp_path, ['work'])
+
+    sample = read_status(pipeline)['modules']['work']['batch']['s1']
+    assert not sample['status']
+    assert sample['programms'] == {'noop': 'NO_SPACE'}
+
+
+@pytest.mark.parametrize('executor', ['local', 'async'])
+def test_command_disk_beyond_sample_reservation_fails(tmp_path, executor):
+    # Единственный образец держит резерв своего объёма; команда, которой не хватает места сверх него, \
+    #   завершается ошибкой, а не ждёт освобождения резерва собственного образца
+    modules = {'sequence': ['work'], 'work': make_module('done', ['.fastq'], sample_level=['small', 'huge'],
+                                                         disk_footprint='1M')}
+    commands = {'small': {'cmd': 'true', 'disk': '512K'}, 'huge': {'cmd': 'true', 'disk': '1000000T'}}
+    machine = {'executor': executor, 'disk': {'min_free': 0, 'poll': 0.1}}
+    write_project(tmp_path, machine=machine, modules=modules, commands=commands, samples=['s1.fastq'])
+    # Без исправления команда ждала бы бесконечно: прерываем запуск по истечении времени
+    watchdog = threading.Timer(30, INTERRUPT_EVENT.set)
+    watchdog.start()
+    try:
+        pipeline = run_pipeline(tmp_path, ['work'])
+    finally:
+        watchdog.cancel()
+        INTERRUPT_EVENT.clear()
+
+    sample = read_status(pipeline)['modules']['work']['batch']['s1']
+    assert not sample['status']
+    assert sample['programms'] == {'small': 0, 'huge': 'NO_SPACE'}
+
+
+def test_plan_cache_tracks_regions_file(tmp_path):
+    # Команды модуля берутся из кэша, пока не изменился файл регионов, прочитанный при их генерации
+    regions_file = os.path.join(tmp_path, 'regions.txt')
+    with open(regions_file, 'w') as file:
+        file.write('chr1\nchr2\n')
+    modules = {'sequence': ['work'], 'work': make_module('done', ['.bam'], sample_level=['work'],
+                                                         shards={'by': 'regions', 'regions_file': regions_file})}
+    write_project(tmp_path, machine={'plan_cache': True}, modules=modules,
+                  commands={'work': "f'echo {shard[\"region\"]}'"}, samples=['s1.bam'])
+
+    def shard_cmds() -> list:
+        pipeline = run_pipeline(tmp_path, ['work'])
+        return sorted(cmd_opts[0] for cmd_opts in pipeline.cmd_data['batch']['s1'].values())
+
+    assert shard_cmds() == ['echo chr1', 'echo chr2']
+    cache_dir = os.path.join(tmp_path, 'out', '.pipeline_plan_cache')
+    assert os.path.isfile(os.path.join(cache_dir, 'cmd_data_work.marshal'))
+    assert os.path.isfile(os.path.join(cache_dir, 'templates-modules_template-cmds_template.marshal'))
+    assert not glob.glob(os.path.join(cache_dir, '*.pickle'))
+    with open(regions_file, 'w') as file:
+        file.write('chr3\nchr4\n')
+    assert shard_cmds() == ['echo chr3', 'echo chr4']
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_temp_files_of_shards_removed_after_after_batch(tmp_path, stream):
+    # Временные файлы частей (ключ с shard["suffix"]) нужны команде after_batch и удаляются после неё
+    modules = {'sequence': ['work'], 'work': make_module(
+        'done', ['.fastq'], sample_level=['make_part'], temp=['part'], shards={'by': 'records', 'count': 2},
+        filenames={'part': "f'{folders[\"done\"]}{filenames[\"basename\"]}{shard[\"suffix\"]}.part'"})}
+    modules['work']['commands']['after_batch'] = ['check_parts']
+    done = os.path.join(tmp_path, 'out', 'done')
+    write_project(tmp_path, machine={'max_parallel_samples': 2, 'stream_modules': stream}, modules=modules,
+                  commands={'make_part': "f'touch {filenames[\"part\"]}'",
+                            'check_parts': f"test $(ls {done} | grep -c '.part$') -eq 4"},
+                  samples=['s1.fastq', 's2.fastq'])
+    for sample in ['s1', 's2']:
+        with open(os.path.join(tmp_path, 'in', f'{sample}.fastq'), 'w') as file:
+            file.write('@r\nACGT\n+\nIIII\n' * 4)
+    pipeline = run_pipeline(tmp_path, ['work'])
+
+    status = read_status(pipeline)
+    assert status['modules']['work']['after_batch']['status']
+    assert not glob.glob(os.path.join(done, '*.part'))
+
+
+def test_shard_inputs_removed_after_gather(tmp_path):
+    # Части пишутся в папку модуля и удаляются после успешного gather
+    modules = {'sequence': ['work'], 'work': make_module(
+        'done', ['.fastq'], sample_level=['count'], shards={'by': 'records', 'count': 2, 'gather': 'gather'},
+        filenames={'count': "f'{folders[\"done\"]}{filenames[\"basename\"]}{shard[\"suffix\"]}.count'"})}
+    commands = {'count': "f'wc -l < {shard[\"input\"]} > {filenames[\"count\"]}'",
+                'gather': "f'cat {\" \".join(shard[\"filenames\"][\"count\"] for shard in shards)} "
+                          "> {filenames[\"count\"]}'"}
+    write_project(tmp_path, machine={}, modules=modules, commands=commands, samples=['s1.fastq'])
+    with open(os.path.join(tmp_path, 'in', 's1.fastq'), 'w') as file:
+        file.write('@r\nACGT\n+\nIIII\n' * 3)
+    pipeline = run_pipeline(tmp_path, ['work'])
+
+    cmds = pipeline.cmd_data['batch']['s1']
+    assert os.path.join(tmp_path, 'out', 'shards', 'work', 's1.shard0000.fastq') in cmds['split'][0]
+    assert cmds['remove_shards'][2]['depends_on'] == ['gather']
+    assert read_status(pipeline)['modules']['work']['batch']['s1']['status']
+    with open(os.path.join(tmp_path, 'out', 'done', 's1.count')) as file:
+        assert file.read().split() == ['8', '4']
+    assert not os.path.exists(os.path.join(tmp_path, 'out', 'shards', 'work'))
+
+
+def test_watch_restart_skips_processed_inputs(tmp_path):
+    # Входные файлы, обработанные до перезапуска --watch, не обрабатываются повторно
+    modules = {'sequence': ['work'], 'work': make_module('done', ['.fastq'], sample_level=['noop'])}
+    write_project(tmp_path, machine={'watch': {'poll': 0.1, 'settle': 0}}, modules=modules, commands={'noop': 'true'},
+                  samples=['s1.fastq'])
+    state = os.path.join(tmp_path, 'out', '.pipeline_watch_work.jsonl')
+
+    def watch(stop_when) -> dict:
+        args = {'project_path': str(tmp_path), 'modules': ['work'], 'input_dir': os.path.join(tmp_path, 'in'),
+                'output_dir': os.path.join(tmp_path, 'out'), 'machine': 'test', 'include_samples': [],
+                'exclude_samples': [], 'debug': [], 'subfolders': False, 'resume': '', 'worker': False, 'watch': True}
+        pipeline = PipelineManager(args)
+
+        def stop():
+            try:
+                wait_for(stop_when, timeout=10)
+            finally:
+                open(os.path.join(pipeline.log_dir, 'watch_stop'), 'w').close()
+
+        stopper = threading.Thread(target=stop)
+        stopper.start()
+        pipeline.run_pipeline()
+        stopper.join()
+        return read_status(pipeline)['modules']['work']['batch']
+
+    assert list(watch(lambda: os.path.exists(state))) == ['s1']
+    started = time.monotonic()
+    assert watch(lambda: time.monotonic() - started > 1) == {}
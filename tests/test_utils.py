@@ -0,0 +1,343 @@
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+import pytest
+import yaml
+from src import sharding
+from src.discovery import DiscoveryIndex
+from src.eta import EtaTracker
+from src.history import RunHistory
+from src.metrics import RunMetrics
+from src.result_cache import ResultCache
+from src.scheduler import ResourcePool
+from src.simulator import ReplaySimulator, load_workload
+from src.staging import staging_options
+from src.utils import add_staging_cmds, generate_cmd_data, plan_staging, run_command, wait_process
+
+
+def test_staged_commands_are_not_cached(tmp_path):
+    # Файлы размещённого образца удаляются со scratch после выполнения, поэтому его команды не кэшируются
+    sample = os.path.join(tmp_path, 's1.fastq')
+    open(sample, 'w').close()
+    staging = staging_options(scratch={'dir': str(tmp_path / 'scratch')}, staging={'outputs': ['txt']},
+                              run=str(tmp_path / 'Logs' / 'run1'), module='align')
+    stage = plan_staging(sample=sample, folders={}, options=staging)
+    cmds = {'make_txt': ['touch out.txt', 0, {'inputs': [sample], 'outputs': [str(tmp_path / 'out.txt')]}]}
+    staged = add_staging_cmds(cmds=cmds, stage=stage, staging=staging, sample=sample,
+                              sample_filenames={'txt': str(tmp_path / 'out.txt')},
+                              work_filenames={'txt': os.path.join(stage['root'], 'out.txt')})
+
+    cache = ResultCache(cache_dir=str(tmp_path / 'cache'))
+    assert all(cache.key(cmd=cmd_opts[0], options=cmd_opts[2]) is None for cmd_opts in staged.values())
+    assert staged['make_txt'][2]['depends_on'] == ['stage_in']
+    # Папка образца, завершившегося с ошибкой, остаётся на scratch для возобновления запуска
+    assert staged['cleanup'][2] == {'depends_on': ['stage_out']}
+
+
+def test_staging_root_depends_on_run_module_and_sample(tmp_path):
+    # Возобновлённый запуск (--resume) пишет логи в ту же папку и получает те же пути на scratch
+    sample = os.path.join(tmp_path, 's1.fastq')
+
+    def root(run:str, module:str='align', path:str=sample) -> str:
+        options = staging_options(scratch={'dir': str(tmp_path / 'scratch')}, staging={'inputs': True},
+                                  run=str(tmp_path / 'Logs' / run), module=module)
+        return plan_staging(sample=path, folders={}, options=options)['root']
+
+    assert root('run1') == root('run1')
+    run_root, module, name = root('run1').rsplit('/', 2)
+    assert os.path.basename(run_root).startswith('pipeline-run1-') and module == 'align' and name.startswith('s1.fastq-')
+    assert len({root('run1'), root('run2'), root('run1', module='call'),
+                root('run1', path=os.path.join(tmp_path, 's2.fastq'))}) == 4
+
+
+def test_sharding_cli_requires_outputs(tmp_path):
+    source = os.path.join(tmp_path, 's1.fastq')
+    with open(source, 'w') as file:
+        file.write('@r\nACGT\n+\nIIII\n' * 3)
+    for argv in [[], ['split-records', source], ['split-records', '--record-lines', '4', source],
+                 ['split-records', '--record-lines', '0', source, str(tmp_path / 'a.fastq')]]:
+        with pytest.raises(SystemExit) as error:
+            sharding.main(argv)
+        assert error.value.code == 2
+
+    outputs = [str(tmp_path / 'parts' / f'{i}.fastq') for i in range(2)]
+    sharding.main(['split-records', '--record-lines', '4', source, *outputs])
+    assert [os.path.getsize(path) for path in outputs] == [30, 15]
+    sharding.main(['remove', *outputs])
+    assert not os.path.exists(tmp_path / 'parts')
+
+
+@pytest.mark.parametrize('timeout, pidfd', [(None, True), (5, True), (5, False)])
+def test_wait_process_returns_promptly(monkeypatch, timeout, pidfd):
+    if not pidfd:
+        monkeypatch.delattr(os, 'pidfd_open', raising=False)
+    process = subprocess.Popen(['bash', '-c', 'sleep 0.65; exit 3'])
+    started = time.monotonic()
+    rusage = wait_process(process, timeout=timeout)
+    elapsed = time.monotonic() - started
+    assert process.returncode == 3 and rusage is not None
+    # Опрос с растущим интервалом (до 0.5 с) замечал бы завершение с задержкой
+    assert elapsed < 0.9 if pidfd else elapsed < 1.5
+
+
+def test_wait_process_timeout():
+    process = subprocess.Popen(['sleep', '5'])
+    with pytest.raises(subprocess.TimeoutExpired):
+        wait_process(process, timeout=0.2)
+    process.kill()
+    assert wait_process(process) is not None and process.returncode == -9
+
+
+def test_run_command_keeps_head_and_tail_of_output(tmp_path):
+    # 1000 строк по 10 байт: в файле остаются первые и последние 500 байт, в логе - фрагмент не больше 200 байт
+    prefix = str(tmp_path / 'out' / 'work')
+    result = run_command(cmd='for i in $(seq 1000 1999); do echo "line $i"; done; echo oops >&2', timeout=10,
+                         debug='', output_prefix=prefix, capture={'max_bytes': 1000, 'excerpt_bytes': 200})
+
+    assert result['log']['exit_code'] == 0
+    assert result['log']['stdout_file'] == f'{prefix}.stdout' and result['log']['stderr_file'] == f'{prefix}.stderr'
+    with open(f'{prefix}.stdout') as file:
+        lines = file.read().split('\n')
+    assert lines[:3] == ['line 1000', 'line 1001', 'line 1002'] and lines[-2:] == ['line 1999', '']
+    assert '... [9000 bytes skipped] ...' in lines
+    assert os.path.getsize(f'{prefix}.stdout') < 1100
+    assert result['stdout'].startswith('line 1000') and result['stdout'].endswith('line 1999')
+    assert 'bytes, see file' in result['stdout'] and len(result['stdout']) < 300
+    assert result['stderr'] == 'oops'
+
+
+def test_compiled_templates_match_eval_of_source():
+    # Скомпилированные шаблоны дают те же файлы и команды, что eval() исходных строк для каждого образца
+    folders = {'input_dir': '/data/in/', 'output_dir': '/data/out/', 'bam': '/data/out/bam/'}
+    filenames = {'basename': "f'{os.path.basename(sample).split(\".\")[0]}'",
+                 'bam': "f'{folders[\"bam\"]}{filenames[\"basename\"]}.bam'",
+                 'braces': "f'{filenames[\"basename\"]}.{{{{x}}}}'",
+                 'fixed': "'/data/ref.fa'"}
+    commands = {'align': "f'bwa mem {folders[\"input_dir\"]}ref.fa {filenames[\"basename\"]}.fq > {filenames[\"bam\"]}'",
+                'index': [3600, "f'samtools index {filenames[\"bam\"]} && echo {{done}}'"],
+                'plain': 'echo {not a template}'}
+    samples = [f'/data/in/s{i}.fastq.gz' for i in range(3)]
+    batch = generate_cmd_data(args={}, folders=folders, executables={}, filenames=filenames, commands=commands,
+                              cmds_dict={'before_batch': [], 'sample_level': list(commands), 'after_batch': []},
+                              samples=samples)['batch']
+
+    expected = {}
+    for sample in samples:
+        context = {'folders': folders, 'sample': sample, 'filenames': {}, 'os': os}
+        for key, instruction in filenames.items():
+            context['filenames'][key] = eval(instruction.replace('{{', '{').replace('}}', '}'), context)
+        context['programms'], context['args'] = {}, {}
+        expected[context['filenames']['basename']] = {
+            'align': [eval(commands['align'], context), 0],
+            'index': [eval(commands['index'][1], context), 3600],
+            'plain': [commands['plain'], 0]}
+    assert batch == expected
+    assert batch['s0']['index'] == ['samtools index /data/out/bam/s0.bam && echo {done}', 3600]
+
+
+def test_samples_ordered_by_expected_duration(tmp_path):
+    # Без истории образцы упорядочиваются по размеру входных данных
+    sizes = {'small': 100, 'large': 1000, 'medium': 500, 'new': 2000}
+    assert RunHistory(logs_dir=str(tmp_path), max_runs=10).order_samples('work', sizes) == ['new', 'large', 'medium', 'small']
+
+    # История прошлого запуска: small обрабатывался дольше всех; длительность из кэша не учитывается
+    run_dir = tmp_path / 'run1'
+    run_dir.mkdir()
+    records = [{'type': 'section', 'section': 'work:1', 'module': 'work'}]
+    for sample, size, duration, log in [('small', 100, 150, {}), ('large', 1000, 10, {}), ('medium', 500, 40, {}),
+                                         ('new', 2000, 1, {'cache': 'HIT'})]:
+        records.append({'type': 'unit', 'section': 'work:1', 'unit': 'batch', 'sample': sample, 'input_size': size,
+                        'log': {'work': {'status': 'OK', 'duration_sec': duration, **log}}})
+    with open(run_dir / 'log_records.jsonl', 'w') as file:
+        file.writelines(json.dumps(record) + '\n' for record in records)
+    history = RunHistory(logs_dir=str(tmp_path), max_runs=10)
+    assert history.module_rate('work') == pytest.approx(200 / 1600)
+    # new - 2000 байт по скорости модуля (250 с), остальные - по своей истории
+    assert history.order_samples('work', sizes) == ['new', 'small', 'medium', 'large']
+
+
+def test_discovery_index_rereads_only_changed_dirs(tmp_path, monkeypatch):
+    root = tmp_path / 'in'
+    for folder in ['a', 'b']:
+        (root / folder).mkdir(parents=True)
+        (root / folder / f'{folder}1.fastq').touch()
+    old = time.time_ns() - 10**11
+
+    def set_mtime(path, mtime_ns:int):
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    for path in [root, root / 'a', root / 'b']:
+        set_mtime(path, old)
+    index_path = str(tmp_path / 'index.json')
+    assert sorted(DiscoveryIndex(index_path).find_samples(str(root), ('.fastq',), subfolders=True)) == \
+        [str(root / 'a' / 'a1.fastq'), str(root / 'b' / 'b1.fastq')]
+
+    scanned = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: scanned.append(path) or scandir(path))
+    def find() -> list:
+        scanned.clear()
+        return sorted(os.path.basename(path) for path in
+                      DiscoveryIndex(index_path).find_samples(str(root), ('.fastq',), subfolders=True))
+
+    # Неизменившееся дерево не перечитывается; файл, появившийся без изменения mtime папки, не виден
+    (root / 'a' / 'a2.fastq').touch()
+    set_mtime(root / 'a', old)
+    assert find() == ['a1.fastq', 'b1.fastq'] and scanned == []
+    # Изменилось время изменения папки - перечитывается только она
+    set_mtime(root / 'a', old + 10**9)
+    assert find() == ['a1.fastq', 'a2.fastq', 'b1.fastq'] and scanned == [os.path.normpath(root / 'a')]
+    # Удалённая папка убирается из индекса вместе с поддеревом
+    (root / 'b' / 'b1.fastq').unlink()
+    (root / 'b').rmdir()
+    set_mtime(root, old + 10**9)
+    assert find() == ['a1.fastq', 'a2.fastq'] and scanned == [os.path.normpath(root)]
+    with open(index_path) as file:
+        assert os.path.normpath(root / 'b') not in json.load(file)['dirs']
+
+
+def test_prometheus_textfile_format(tmp_path):
+    textfile = str(tmp_path / 'pipeline.prom')
+    metrics = RunMetrics(textfile=textfile, interval=0, labels={'output_dir': '/data/"out"'})
+    metrics.track('work', {'batch': {'s1': {'a': [], 'b': []}, 's2': {'a': [], 'b': []}}})
+    metrics.record_unit('work', {'log': {'a': {'status': 'OK', 'duration_sec': 2},
+                                         'b': {'status': 'FAIL', 'duration_sec': 4}}})
+    metrics.write({'metrics': metrics.status(),
+                   'modules': {'work': {'done': 1, 'total': 2, 'eta_sec': 30, 'throughput_samples_per_hour': None}},
+                   'pipeline': {'eta_sec': 30, 'low_sec': 20, 'high_sec': 60}})
+
+    assert os.listdir(tmp_path) == ['pipeline.prom']
+    with open(textfile) as file:
+        text = file.read()
+    assert text.endswith('\n')
+    lines = text.splitlines()
+    sample = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_]+="([^"\\]|\\.)*",?)+\})? -?[0-9.]+(e[+-]?[0-9]+)?$')
+    typed = set()
+    for i, line in enumerate(lines):
+        if line.startswith('# TYPE '):
+            name, kind = line.split()[2:]
+            assert lines[i - 1].startswith(f'# HELP {name} ') and kind in ('gauge', 'counter', 'summary')
+            typed.add(name)
+        elif not line.startswith('# HELP '):
+            assert sample.match(line), line
+            assert line.split('{')[0].removesuffix('_sum').removesuffix('_count') in typed, line
+    labels = 'output_dir="/data/\\"out\\"",module="work"'
+    for line in [f'pipeline_commands_finished_total{{{labels}}} 2', f'pipeline_commands_failed_total{{{labels}}} 1',
+                 f'pipeline_command_duration_seconds{{{labels},quantile="0.5"}} 2',
+                 f'pipeline_command_duration_seconds_sum{{{labels}}} 2', f'pipeline_command_duration_seconds_count{{{labels}}} 1',
+                 f'pipeline_module_samples_done{{{labels}}} 1', 'pipeline_eta_seconds{output_dir="/data/\\"out\\"",bound="high"} 60']:
+        assert line in lines
+    # Неизвестные значения (пропускная способность до первого образца) не выводятся
+    assert not any(line.startswith('pipeline_module_throughput_samples_per_hour{') for line in lines)
+
+
+def unit_result(duration:float) -> dict:
+    return {'log': {'work': {'status': 'OK', 'duration_sec': duration}}}
+
+
+def test_eta_estimates_from_history_and_run(tmp_path, monkeypatch):
+    history = RunHistory(logs_dir=str(tmp_path), max_runs=0)
+    history.samples = {'work': {f's{i}': {'size': size, 'durations': {'work': size / 10}}
+                                for i, size in enumerate([100, 100, 200])}}
+    writes = []
+    monkeypatch.setattr('src.eta.write_json_atomic', lambda path, data: writes.append(data))
+    eta = EtaTracker(history=history, modules=['work', 'next'], status_file=str(tmp_path / 'status.json'))
+    # s1 - по истории образца (10 с), s3 и s4 - по скорости модуля (0.1 с/байт); два образца одновременно
+    eta.start_module(module='work', sample_sizes={'s1': 100, 's3': 300, 's4': 100}, concurrency=2)
+    assert eta.module_eta('work') == pytest.approx((25, 25, 25))
+    assert eta.pipeline_eta() == (pytest.approx((25, 25, 25)), ['next'])
+
+    # Наблюдение текущего запуска меняет скорость (100 с на 700 байт) и её разброс
+    eta.sample_done(module='work', sample='s3', unit_result=unit_result(60))
+    remaining = 10 + 100 / 7
+    assert eta.module_eta('work') == pytest.approx((remaining / 2, remaining / 2 * 0.7, remaining / 2 * 1.75))
+    assert eta.format_progress(module='work', done=1, total=3).endswith('pipeline: < 1m (< 1m - < 1m) + next')
+    eta.sample_done(module='work', sample='s1', unit_result=unit_result(10))
+    # Один оставшийся образец не делится между потоками
+    assert eta.module_eta('work')[0] == pytest.approx(100 / 7)
+
+    # Обработанные образцы не перезаписывают файл состояния чаще STATUS_INTERVAL, завершение модуля - записывается
+    assert len(writes) == 1
+    eta.finish_module('work')
+    assert len(writes) == 2 and writes[-1]['modules']['work']['state'] == 'done'
+    assert writes[-1]['modules']['work']['eta_sec'] == 0 and writes[-1]['pipeline']['unknown_modules'] == ['next']
+
+
+def acquire_in_thread(pool:ResourcePool, threads:int, memory:int=0) -> threading.Event:
+    acquired = threading.Event()
+    threading.Thread(target=lambda: pool.acquire(threads, memory) and acquired.set(), daemon=True).start()
+    return acquired
+
+
+def test_resource_pool_limits_threads_and_memory():
+    pool = ResourcePool(threads=4, memory=1000)
+    assert pool.acquire(threads=2, memory=400) and pool.acquire(threads=2, memory=400)
+    # Потоки заняты полностью
+    by_threads = acquire_in_thread(pool, threads=1)
+    assert not by_threads.wait(0.3)
+    pool.release(threads=2, memory=400)
+    assert by_threads.wait(5)
+    # Потоки есть (3 из 4 заняты), памяти нет (400 + 700 > 1000)
+    by_memory = acquire_in_thread(pool, threads=1, memory=700)
+    assert not by_memory.wait(0.3)
+    pool.release(threads=2, memory=400)
+    assert by_memory.wait(5)
+    assert (pool.used_threads, pool.used_memory) == (2, 700)
+    pool.release(threads=1)
+    pool.release(threads=1, memory=700)
+    # Запрос больше машины ограничивается её лимитами и выполняется в одиночку
+    assert pool.acquire(threads=16, memory=10**6) and (pool.used_threads, pool.used_memory) == (4, 1000)
+
+
+def test_resource_pool_aging_stops_overtaking(monkeypatch):
+    monkeypatch.setattr(ResourcePool, 'AGING_SEC', 0.3)
+    pool = ResourcePool(threads=4)
+    assert pool.acquire(threads=3)
+    # Пока заявка на 4 потока ждёт меньше AGING_SEC, мелкие заявки её обгоняют
+    large = acquire_in_thread(pool, threads=4)
+    assert acquire_in_thread(pool, threads=1).wait(5)
+    pool.release(threads=1)
+    time.sleep(0.5)
+    # После AGING_SEC самая старая заявка получает приоритет: свободный поток не достаётся новой заявке
+    small = acquire_in_thread(pool, threads=1)
+    assert not small.wait(0.5)
+    pool.release(threads=3)
+    assert large.wait(5) and not small.is_set()
+    pool.release(threads=4)
+    assert small.wait(5)
+
+
+def test_simulator_makespan(tmp_path):
+    # Образцы: a - 10 + 5 с, b - 4 + 1 с, c - 6 с; команда x объявляет 2 потока, y выполняется после x
+    durations = {'a': (10, 5), 'b': (4, 1), 'c': (6, 0)}
+    records = [{'type': 'section', 'section': 'work:1', 'module': 'work'}]
+    cmd_data = {'before_batch': {}, 'batch': {}, 'after_batch': {}}
+    for sample, (x, y) in durations.items():
+        records.append({'type': 'unit', 'section': 'work:1', 'unit': 'batch', 'sample': sample,
+                        'log': {'x': {'status': 'OK', 'duration_sec': x, 'start_time': '01.01.2026 10:00:00',
+                                      'end_time': '01.01.2026 10:00:10'},
+                                'y': {'status': 'OK', 'duration_sec': y, 'start_time': '01.01.2026 10:00:10',
+                                      'end_time': '01.01.2026 10:00:20'}}})
+        cmd_data['batch'][sample] = {'x': ['run x', 0, {'threads': 2}], 'y': ['run y', 0, {'threads': 1}]}
+    with open(tmp_path / 'log_records.jsonl', 'w') as file:
+        file.writelines(json.dumps(record) + '\n' for record in records)
+    with open(tmp_path / 'cmd_data_work.yaml', 'w') as file:
+        yaml.safe_dump(cmd_data, file)
+    with open(tmp_path / 'init_configs.yaml', 'w') as file:
+        yaml.safe_dump({'machine': 'test', 'machines_template': {'test': {'max_parallel_samples': 2}}}, file)
+    workload = load_workload(str(tmp_path))
+    assert workload['recorded'] == 20
+
+    def makespan(**settings) -> float:
+        return ReplaySimulator(workload=workload, **settings).run()['makespan']
+    # Слоты образцов как в запуске (2): a и b, затем c после b
+    assert makespan() == 15
+    assert makespan(parallel=1) == 26
+    # Сначала самые короткие: a начинается последним и определяет время выполнения
+    assert makespan(order='shortest') == 20
+    # Лимит 2 потока: команды x занимают все потоки и выполняются по одной, команды y - после них
+    result = ReplaySimulator(workload=workload, parallel=3, threads=2).run()
+    assert result['makespan'] == 25 and result['thread_utilization'] == pytest.approx((20 * 2 + 6) / 25 / 2)
+    assert [(step['sample'], step['command']) for step in result['critical_path']][-1] == ('a', 'y')